@@ -8,22 +8,90 @@ import json
 import pkg_resources
 import pkgutil
 import random
+import re
+import shlex
 import socket
 import string
-import struct
+import subprocess
 import sys
+import tempfile
 import yaml
 import uuid
 import copy
 import os.path
-import functools
+import glob
+import hashlib
+import threading
+import time
 
 from OpenSSL import crypto
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+import fleet
+import profiling
+import server
+import snapshot
+import tracing
+import watcher
+import apic_provision
 from apic_provision import Apic, ApicKubeConfig
+import logs
+from logs import log, log_context
 from jinja2 import Environment, PackageLoader
+from multiprocessing.pool import ThreadPool
 from os.path import exists
 
+try:
+    # libyaml is much faster, when available
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 DEFAULT_FLAVOR = "kubernetes-1.8"
+DEFAULT_CACHE_DIR = "~/.cache/acc-provision"
+DEFAULT_RUN_DIR = "~/.local/share/acc-provision/runs"
+DEFAULT_FLEET_STATE = "~/.local/share/acc-provision/fleet.json"
+
+TEMPLATES = [
+    "aci-containers.yaml",
+    "aci-cf-containers.yaml",
+]
+
+# The version label of the generated kubernetes objects
+VERSION_LABEL_RE = re.compile(
+    r'(?m)^(\s*aci-containers-config-version: )"[^"\n]*"')
+
+DEFAULT_WATCH_INTERVAL = 2.0
+# Seconds to wait for the controller to restart with a rotated key
+ROTATE_TIMEOUT = 300
+ROTATE_POLL = 2.0
+# Pod template annotation changed to restart the controller
+ROTATE_ANNOTATION = "aci-containers-cert-rotated"
+
+# Bytes added to pod packets by the vxlan encapsulation on the uplinks
+VXLAN_OVERHEAD = 50
+# Containers whose resources can be set in the performance section
+RESOURCE_CONTAINERS = {"controller", "host_agent", "opflex_agent",
+                       "openvswitch"}
+
+DEFAULT_KEY_TYPE = "rsa-2048"
+KEY_TYPES = ["rsa-2048", "rsa-4096", "ecdsa-p256"]
+
+# State shared by all clusters provisioned by this process
+jinja_env = None
+# Validation rules of config_validate, built on first use
+config_rules = None
+apic_sessions = {}
+apic_sessions_lock = threading.Lock()
+# Objects already posted to each APIC by a batch, None outside of batches
+apic_shared_objects = None
+# Results of the APIC lookups made before provisioning, kept for
+# PREFLIGHT_TTL seconds by the server; None disables the cache
+apic_preflight = None
+PREFLIGHT_TTL = 300
+# APIC session used by a thread instead of logging in, when set
+apic_context = threading.local()
 
 VERSION_FIELDS = [
     "cnideploy_version",
@@ -60,6 +128,8 @@ VERSIONS = {
 # Known Flavor options:
 # - template_generator: Function that generates the output config
 #       file. Default: generate_kube_yaml.
+# - template: Name of the template rendered for the output config file.
+#       Default: aci-containers.yaml.
 # - version_fields: List of config options that must be specified for
 #       the specific version of deployment. Default: VERSION_FIELDS.
 # - apic: Dict that is used for configuring ApicKubeConfig
@@ -69,9 +139,13 @@ VERSIONS = {
 #             Default: kube_tn.
 #       - associate_aep_to_nested_inside_domain: Whether AEP should be attached
 #             to nested_inside domain. Default: False.
+# - performance: Whether the template uses the performance section.
+#       Default: True.
 KubeFlavorOptions = {}
 
 CfFlavorOptions = {
+    'template': 'aci-cf-containers.yaml',
+    'performance': False,
     'apic': {
         'use_kubeapi_vlan': False,
         'tenant_generator': 'cloudfoundry_tn',
@@ -156,15 +230,15 @@ FLAVORS = {
 
 
 def info(msg):
-    print("INFO: " + msg, file=sys.stderr)
+    log("INFO: " + msg)
 
 
 def warn(msg):
-    print("WARN: " + msg, file=sys.stderr)
+    log("WARN: " + msg)
 
 
 def err(msg):
-    print("ERR:  " + msg, file=sys.stderr)
+    log("ERR:  " + msg)
 
 
 def json_indent(s):
@@ -253,6 +327,26 @@ def config_default():
             "hostagent_log_level": "info",
             "opflexagent_log_level": "info",
         },
+        "performance": {
+            "mtu": None,
+            "opflex": {
+                "prr_timer": None,
+            },
+            "resources": {},
+        },
+        "rollout": {
+            "max_unavailable": None,
+            "max_surge": None,
+            "min_ready_seconds": None,
+            "readiness_gates": [],
+            "prepull_images": False,
+            "controller": {
+                "strategy": "Recreate",
+                "max_unavailable": None,
+                "max_surge": None,
+                "min_ready_seconds": None,
+            },
+        },
     }
     return default_config
 
@@ -262,11 +356,11 @@ def config_user(config_file):
     if config_file:
         if config_file == "-":
             info("Loading configuration from \"STDIN\"")
-            config = yaml.load(sys.stdin)
+            config = yaml.load(sys.stdin, Loader=YamlLoader)
         else:
             info("Loading configuration from \"%s\"" % config_file)
             with open(config_file, 'r') as file:
-                config = yaml.load(file)
+                config = yaml.load(file, Loader=YamlLoader)
     if config is None:
         config = {}
     return config
@@ -283,7 +377,7 @@ def config_discover(config, prov_apic):
         }
     }
     if apic:
-        infra_vlan = apic.get_infravlan()
+        infra_vlan = apic_lookup(apic, apic.get_infravlan)
         ret["net_config"]["infra_vlan"] = infra_vlan
         orig_infra_vlan = config["net_config"].get("infra_vlan")
         if orig_infra_vlan is not None and orig_infra_vlan != infra_vlan:
@@ -295,27 +389,84 @@ def config_discover(config, prov_apic):
     return ret
 
 
+def cidr_ints(cidr):
+    # (family, address bits, gateway, host mask) of an IPv4 or IPv6
+    # gateway/prefix-length subnet, the addresses as integers
+    rtr, mask = cidr.split('/')
+    family, bits, rtri = fleet.ip_int(rtr)
+    if not 0 <= int(mask) <= bits:
+        raise ValueError("Invalid prefix length in %s" % cidr)
+    return family, bits, rtri, (1 << (bits - int(mask))) - 1
+
+
 def cidr_split(cidr):
-    ip2int = lambda a: struct.unpack("!I", socket.inet_aton(a))[0]
-    int2ip = lambda a: socket.inet_ntoa(struct.pack("!I", a))
+    family, bits, rtri, maskbits = cidr_ints(cidr)
+    int2ip = lambda a: fleet.int_ip(family, a)
     rtr, mask = cidr.split('/')
-    maskbits = int('1' * (32 - int(mask)), 2)
-    rtri = ip2int(rtr)
     starti = rtri + 1
     endi = (rtri | maskbits) - 1
-    subi = (rtri & (0xffffffff ^ maskbits))
+    subi = rtri & ~maskbits
     return int2ip(starti), int2ip(endi), rtr, int2ip(subi), mask
 
 
+def cidr_list(cidrs):
+    # A subnet option is one subnet or a list of them
+    if isinstance(cidrs, list):
+        return cidrs
+    return [cidrs] if cidrs else []
+
+
+def cidr_overlaps(cidrs):
+    # Returns the pairs of overlapping subnets of cidrs
+    ranges = []
+    for cidr in cidrs:
+        family, bits, rtri, maskbits = cidr_ints(cidr)
+        ranges.append((family, rtri & ~maskbits, rtri | maskbits, cidr))
+    ranges.sort()
+    return [(a[3], b[3]) for a, b in zip(ranges, ranges[1:])
+            if a[0] == b[0] and b[1] <= a[2]]
+
+
+def pool_size(cidrs):
+    # Number of IPv4 pod addresses in cidrs, those the controller hands
+    # out to the nodes in chunks
+    size = 0
+    for cidr in cidrs:
+        family, bits, rtri, maskbits = cidr_ints(cidr)
+        if family == socket.AF_INET:
+            size += (rtri | maskbits) - rtri - 1
+    return size
+
+
+def propose_chunk_size(size, nodes, pods_per_node):
+    # The controller gives a node another chunk when it has half a chunk
+    # or less left. Among the chunk sizes for which a pool of size has
+    # room for every node, prefers the fewest chunks per node, then the
+    # smallest chunk. Returns (chunk size, addresses used) or (None, None)
+    best = None
+    for chunk in [2 ** i for i in range(4, 13)]:
+        chunks = (pods_per_node + chunk // 2 + chunk - 1) // chunk
+        used = nodes * chunks * chunk
+        if used <= size and (best is None or chunks < best[0]):
+            best = (chunks, chunk, used)
+    if best is None:
+        return None, None
+    return best[1], best[2]
+
+
 def config_adjust(args, config, prov_apic, no_random):
     system_id = config["aci_config"]["system_id"]
     infra_vlan = config["net_config"]["infra_vlan"]
     node_subnet = config["net_config"]["node_subnet"]
-    pod_subnet = config["net_config"]["pod_subnet"]
+    pod_subnets = cidr_list(config["net_config"]["pod_subnet"])
     extern_dynamic = config["net_config"]["extern_dynamic"]
     extern_static = config["net_config"]["extern_static"]
     node_svc_subnet = config["net_config"]["node_svc_subnet"]
     encap_type = config["aci_config"]["vmm_domain"]["encap_type"]
+    mtu = config["performance"]["mtu"]
+    chunk_size = config["performance"].get("pod_ip_pool_chunk_size")
+    nodes = config["performance"].get("expected_nodes")
+    pods_per_node = config["performance"].get("pods_per_node")
     tenant = system_id
     token = str(uuid.uuid4())
     if args.version_token:
@@ -369,6 +520,7 @@ def config_adjust(args, config, prov_apic, no_random):
                     "start": cidr_split(pod_subnet)[0],
                     "end": cidr_split(pod_subnet)[1],
                 }
+                for pod_subnet in pod_subnets
             ],
             "pod_network": [
                 {
@@ -376,11 +528,13 @@ def config_adjust(args, config, prov_apic, no_random):
                     "gateway": cidr_split(pod_subnet)[2],
                     "routes": [
                         {
-                            "dst": "0.0.0.0/0",
+                            "dst": ("::/0" if ":" in pod_subnet
+                                    else "0.0.0.0/0"),
                             "gw": cidr_split(pod_subnet)[2],
                         }
                     ],
-                },
+                }
+                for pod_subnet in pod_subnets
             ],
             "service_ip_pool": [
                 {
@@ -403,6 +557,12 @@ def config_adjust(args, config, prov_apic, no_random):
             "node_service_gw_subnets": [
                 node_svc_subnet,
             ],
+            "pod_subnets": pod_subnets,
+        },
+        "performance": {
+            # Pod traffic is encapsulated on the node uplinks with vxlan
+            "interface_mtu": (mtu - VXLAN_OVERHEAD
+                              if mtu and encap_type == "vxlan" else mtu),
         },
         "cf_config": {
             "default_endpoint_group": {
@@ -417,8 +577,9 @@ def config_adjust(args, config, prov_apic, no_random):
                     "start": cidr_split(pod_subnet)[0],
                     "end": cidr_split(pod_subnet)[1],
                 }
+                for pod_subnet in pod_subnets
             ],
-            "app_subnet": "%s/%s" % cidr_split(pod_subnet)[2::2],
+            "app_subnet": "%s/%s" % cidr_split(pod_subnets[0])[2::2],
             "dynamic_ext_ip_pool": [
                 {
                     "start": cidr_split(extern_dynamic)[0],
@@ -446,6 +607,21 @@ def config_adjust(args, config, prov_apic, no_random):
             "configuration_version": token,
         }
     }
+    if nodes and pods_per_node:
+        size = pool_size(pod_subnets)
+        proposed, used = propose_chunk_size(size, nodes, pods_per_node)
+        if proposed is None:
+            warn("The pod subnets have %d addresses, too few for %d nodes "
+                 "with %d pods each" % (size, nodes, pods_per_node))
+        elif not chunk_size:
+            info("Using a pod IP chunk size of %d, %d nodes with %d pods "
+                 "each use %d of %d pod addresses" %
+                 (proposed, nodes, pods_per_node, used, size))
+            adj_config["performance"]["pod_ip_pool_chunk_size"] = proposed
+        elif chunk_size != proposed:
+            info("A pod IP chunk size of %d is proposed for %d nodes with "
+                 "%d pods each" % (proposed, nodes, pods_per_node))
+
     adj_config["cf_config"]["node_network"] = (
         "%s|%s|%s" % (
             tenant,
@@ -455,118 +631,297 @@ def config_adjust(args, config, prov_apic, no_random):
     return adj_config
 
 
-def config_validate(flavor_opts, config):
-    def Raise(exception):
-        raise exception
-    required = lambda x: True if x else Raise(Exception("Missing option"))
-    lower_in = lambda y: (
-        lambda x: (
-            (True if str(x).lower() in y
-             else Raise(Exception("Invalid value: %s; "
-                                  "Expected one of: {%s}" %
-                                  (x, ','.join(y)))))))
-    get = lambda t: functools.reduce(lambda x, y: x and x.get(y), t, config)
-
-    checks = {
+def check_required(x):
+    if not x:
+        return "Missing option"
+
+
+def check_one_of(values, lower=False):
+    def check(x):
+        if x and (str(x).lower() if lower else x) not in values:
+            return ("Invalid value: %s; Expected one of: {%s}" %
+                    (x, ','.join(values)))
+    return check
+
+
+def check_int_in(lo, hi):
+    def check(x):
+        if x is not None and not (isinstance(x, int) and lo <= x <= hi):
+            return ("Invalid value: %s; Expected an integer in [%d, %d]" %
+                    (x, lo, hi))
+    return check
+
+
+def check_count(x):
+    if not (x is None or (isinstance(x, int) and x >= 0) or
+            re.match(r"^[0-9]+%$", str(x))):
+        return "Invalid value: %s; Expected a count or a percentage" % x
+
+
+def check_str_list(x):
+    if x and not (isinstance(x, list) and
+                  all(isinstance(v, basestring) for v in x)):
+        return "Invalid value: %s; Expected a list of strings" % x
+
+
+def check_keys_in(keys, optional=True):
+    def check(x):
+        if (x or not optional) and not (isinstance(x, dict) and
+                                        set(x).issubset(keys)):
+            return ("Invalid value: %s; Expected a map of: {%s}" %
+                    (x, ','.join(sorted(keys))))
+    return check
+
+
+def check_subnets(x):
+    if not x:
+        return "Missing option"
+    for cidr in cidr_list(x):
+        try:
+            cidr_ints(str(cidr))
+        except (ValueError, socket.error):
+            return ("Invalid value: %s; Expected a subnet like "
+                    "10.2.0.1/16 or fd00::1/64" % cidr)
+    for a, b in cidr_overlaps(cidr_list(x)):
+        return "Subnets %s and %s overlap" % (a, b)
+
+
+def config_get(config, path):
+    # The value at path, None if missing
+    for k in path:
+        if not isinstance(config, dict):
+            return None
+        config = config.get(k)
+    return config
+
+
+def config_schema():
+    # The validation rules, built once: (name, path, check, when) rules
+    # and the (path, keys) of the maps that can only have those keys.
+    # check(value) returns the error for name, or for the path if None,
+    # "*" matching every key of a map; the rule only applies if
+    # when(flavor_opts, config) is true.
+    global config_rules
+    if config_rules is not None:
+        return config_rules
+
+    always = None
+    get = config_get
+    kube_vlan = lambda opts, config: (
+        opts.get("apic", {}).get("use_kubeapi_vlan", True))
+    nested_aep = lambda opts, config: (
+        opts.get("apic", {}).get("associate_aep_to_nested_inside_domain",
+                                 False))
+    vlan = lambda opts, config: (
+        get(config, ("aci_config", "vmm_domain", "encap_type")) == "vlan")
+    nested = lambda opts, config: bool(
+        get(config, ("aci_config", "vmm_domain", "nested_inside", "type")))
+    prov_apic = lambda opts, config: (
+        get(config, ("provision", "prov_apic")) is not None)
+
+    rules = [
         # ACI config
-        "aci_config/system_id": (get(("aci_config", "system_id")), required),
-        "aci_config/apic_host": (get(("aci_config", "apic_hosts")), required),
-        "aci_config/aep": (get(("aci_config", "aep")), required),
-        "aci_config/vrf/name": (get(("aci_config", "vrf", "name")), required),
-        "aci_config/vrf/tenant": (get(("aci_config", "vrf", "tenant")),
-                                  required),
-        "aci_config/l3out/name": (get(("aci_config", "l3out", "name")),
-                                  required),
-        "aci_config/l3out/external-networks":
-        (get(("aci_config", "l3out", "external_networks")), required),
+        ("aci_config/system_id", ("aci_config", "system_id"),
+         check_required, always),
+        ("aci_config/apic_host", ("aci_config", "apic_hosts"),
+         check_required, always),
+        ("aci_config/aep", ("aci_config", "aep"), check_required, always),
+        ("aci_config/vrf/name", ("aci_config", "vrf", "name"),
+         check_required, always),
+        ("aci_config/vrf/tenant", ("aci_config", "vrf", "tenant"),
+         check_required, always),
+        ("aci_config/l3out/name", ("aci_config", "l3out", "name"),
+         check_required, always),
+        ("aci_config/l3out/external-networks",
+         ("aci_config", "l3out", "external_networks"),
+         check_required, always),
+        ("aci_config/vmm_domain/vlan_range/start",
+         ("aci_config", "vmm_domain", "vlan_range", "start"),
+         check_required, vlan),
+        ("aci_config/vmm_domain/vlan_range/end",
+         ("aci_config", "vmm_domain", "vlan_range", "end"),
+         check_required, vlan),
+        ("aci_config/vmm_domain/nested_inside/type",
+         ("aci_config", "vmm_domain", "nested_inside", "type"),
+         check_required, nested_aep),
+        ("aci_config/vmm_domain/nested_inside/type",
+         ("aci_config", "vmm_domain", "nested_inside", "type"),
+         check_one_of(["vmware"], lower=True), nested),
+        ("aci_config/vmm_domain/nested_inside/name",
+         ("aci_config", "vmm_domain", "nested_inside", "name"),
+         check_required, nested),
+        # auth for API access
+        ("aci_config/apic_login/username",
+         ("aci_config", "apic_login", "username"), check_required, prov_apic),
+        ("aci_config/apic_login/password",
+         ("aci_config", "apic_login", "password"), check_required, prov_apic),
 
         # Network Config
-        "net_config/infra_vlan": (get(("net_config", "infra_vlan")),
-                                  required),
-        "net_config/service_vlan": (get(("net_config", "service_vlan")),
-                                    required),
-        "net_config/node_subnet": (get(("net_config", "node_subnet")),
-                                   required),
-        "net_config/pod_subnet": (get(("net_config", "pod_subnet")),
-                                  required),
-        "net_config/extern_dynamic": (get(("net_config", "extern_dynamic")),
-                                      required),
-        "net_config/extern_static": (get(("net_config", "extern_static")),
-                                     required),
-        "net_config/node_svc_subnet": (get(("net_config", "node_svc_subnet")),
-                                       required),
-    }
-
-    if flavor_opts.get("apic", {}).get("use_kubeapi_vlan", True):
-        checks["net_config/kubeapi_vlan"] = (
-            get(("net_config", "kubeapi_vlan")), required)
+        ("net_config/infra_vlan", ("net_config", "infra_vlan"),
+         check_required, always),
+        ("net_config/service_vlan", ("net_config", "service_vlan"),
+         check_required, always),
+        ("net_config/kubeapi_vlan", ("net_config", "kubeapi_vlan"),
+         check_required, kube_vlan),
+        ("net_config/node_subnet", ("net_config", "node_subnet"),
+         check_required, always),
+        ("net_config/pod_subnet", ("net_config", "pod_subnet"),
+         check_subnets, always),
+        ("net_config/extern_dynamic", ("net_config", "extern_dynamic"),
+         check_required, always),
+        ("net_config/extern_static", ("net_config", "extern_static"),
+         check_required, always),
+        ("net_config/node_svc_subnet", ("net_config", "node_svc_subnet"),
+         check_required, always),
+
+        # Size of the APIC POSTs, all optional
+        ("aci_config/apic_post", ("aci_config", "apic_post"),
+         check_keys_in({"max_bytes", "max_objects", "jobs"}), always),
+        ("aci_config/apic_post/max_bytes",
+         ("aci_config", "apic_post", "max_bytes"),
+         check_int_in(1024, 16 * 1024 * 1024), always),
+        ("aci_config/apic_post/max_objects",
+         ("aci_config", "apic_post", "max_objects"),
+         check_int_in(1, 1000000), always),
+        ("aci_config/apic_post/jobs", ("aci_config", "apic_post", "jobs"),
+         check_int_in(1, 64), always),
+
+        # Performance tuning, all optional
+        ("performance/mtu", ("performance", "mtu"),
+         check_int_in(1280, 9216), always),
+        ("performance/interface_mtu", ("performance", "interface_mtu"),
+         check_int_in(1280, 9216), always),
+        ("performance/pod_ip_pool_chunk_size",
+         ("performance", "pod_ip_pool_chunk_size"),
+         check_int_in(1, 65536), always),
+        ("performance/expected_nodes", ("performance", "expected_nodes"),
+         check_int_in(1, 100000), always),
+        ("performance/pods_per_node", ("performance", "pods_per_node"),
+         check_int_in(1, 10000), always),
+        ("performance/opflex/prr_timer", ("performance", "opflex",
+                                          "prr_timer"),
+         check_int_in(1, 86400), always),
+        ("performance/resources", ("performance", "resources"),
+         check_keys_in(RESOURCE_CONTAINERS), always),
+        (None, ("performance", "resources", "*"),
+         check_keys_in({"requests", "limits"}, optional=False), always),
+        (None, ("performance", "resources", "*", "*"),
+         check_keys_in({"cpu", "memory"}, optional=False), always),
+
+        # Rollout, all optional
+        ("rollout/max_unavailable", ("rollout", "max_unavailable"),
+         check_count, always),
+        ("rollout/max_surge", ("rollout", "max_surge"), check_count, always),
+        ("rollout/min_ready_seconds", ("rollout", "min_ready_seconds"),
+         check_int_in(0, 3600), always),
+        ("rollout/readiness_gates", ("rollout", "readiness_gates"),
+         check_str_list, always),
+        ("rollout/controller/strategy", ("rollout", "controller", "strategy"),
+         check_one_of(["Recreate", "RollingUpdate"]), always),
+        ("rollout/controller/max_unavailable",
+         ("rollout", "controller", "max_unavailable"), check_count, always),
+        ("rollout/controller/max_surge",
+         ("rollout", "controller", "max_surge"), check_count, always),
+        ("rollout/controller/min_ready_seconds",
+         ("rollout", "controller", "min_ready_seconds"),
+         check_int_in(0, 3600), always),
+    ]
 
     # Versions
-    for field in flavor_opts.get('version_fields', VERSION_FIELDS):
-        checks[field] = (get(("registry", field)), required)
-
-    if flavor_opts.get("apic", {}).get("associate_aep_to_nested_inside_domain",
-                                       False):
-        checks["aci_config/vmm_domain/nested_inside/type"] = (
-            get(("aci_config", "vmm_domain", "nested_inside", "type")),
-            required)
-
-    if get(("aci_config", "vmm_domain", "encap_type")) == "vlan":
-        checks["aci_config/vmm_domain/vlan_range/start"] = \
-            (get(("aci_config", "vmm_domain", "vlan_range", "start")),
-             required)
-        checks["aci_config/vmm_domain/vlan_range/end"] = \
-            (get(("aci_config", "vmm_domain", "vlan_range", "end")),
-             required)
-
-    if get(("aci_config", "vmm_domain", "nested_inside", "type")):
-        checks["aci_config/vmm_domain/nested_inside/type"] = \
-            (get(("aci_config", "vmm_domain", "nested_inside", "type")),
-             lower_in({"vmware"}))
-        checks["aci_config/vmm_domain/nested_inside/name"] = \
-            (get(("aci_config", "vmm_domain", "nested_inside", "name")),
-             required)
-
-    if get(("provision", "prov_apic")) is not None:
-        checks.update({
-            # auth for API access
-            "aci_config/apic_login/username":
-            (get(("aci_config", "apic_login", "username")), required),
-            "aci_config/apic_login/password":
-            (get(("aci_config", "apic_login", "password")), required),
-        })
-
-    ret = True
-    for k in sorted(checks.keys()):
-        value, validator = checks[k]
-        try:
-            if not validator(value):
-                raise Exception(k)
-        except Exception as e:
-            err("Invalid configuration for %s: %s"
-                % (k, e.message))
-            ret = False
+    fields = list(VERSION_FIELDS)
+    for flavor in FLAVORS.values():
+        for field in flavor.get("options", {}).get("version_fields", []):
+            if field not in fields:
+                fields.append(field)
+    for field in fields:
+        rules.append((field, ("registry", field), check_required,
+                      lambda opts, config, field=field: field in opts.get(
+                          "version_fields", VERSION_FIELDS)))
+
+    closed = [
+        ((), {"aci_config", "net_config", "node_config", "kube_config",
+              "cf_config", "registry", "logging", "performance", "rollout",
+              "provision"}),
+        (("performance",), {"mtu", "interface_mtu", "pod_ip_pool_chunk_size",
+                            "expected_nodes", "pods_per_node", "opflex",
+                            "resources"}),
+        (("performance", "opflex"), {"prr_timer"}),
+        (("rollout",), {"max_unavailable", "max_surge", "min_ready_seconds",
+                        "readiness_gates", "prepull_images", "controller"}),
+        (("rollout", "controller"), {"strategy", "max_unavailable",
+                                     "max_surge", "min_ready_seconds"}),
+    ]
+    config_rules = (rules, closed)
+    return config_rules
+
+
+def schema_values(config, path):
+    # (path, value) of the values at path, "*" matching every key of a map
+    ret = [((), config)]
+    for k in path:
+        matches = []
+        for p, v in ret:
+            if k != "*":
+                v = v.get(k) if isinstance(v, dict) else None
+                matches.append((p + (k,), v))
+            elif isinstance(v, dict):
+                matches.extend((p + (kk,), v[kk]) for kk in sorted(v))
+        ret = matches
     return ret
 
 
+def config_validate(flavor_opts, config):
+    get = lambda t: config_get(config, t)
+    if (get(("rollout", "max_surge")) is not None and
+            get(("kube_config", "use_apps_api")) != "apps/v1"):
+        warn("rollout/max_surge is only used for DaemonSets with the "
+             "apps/v1 API, not %s" % get(("kube_config", "use_apps_api")))
+
+    if not flavor_opts.get("performance", True) and any(
+            get(("performance", k)) for k in
+            ["mtu", "interface_mtu", "pod_ip_pool_chunk_size", "resources"]):
+        warn("The performance section is not used by this flavor")
+
+    # Every error is reported, sorted by name
+    rules, closed = config_schema()
+    errors = []
+    for name, path, check, when in rules:
+        if when is not None and not when(flavor_opts, config):
+            continue
+        for p, value in schema_values(config, path):
+            error = check(value)
+            if error:
+                errors.append((name or "/".join(p), error))
+    for path, keys in closed:
+        value = get(path)
+        for k in sorted(value) if isinstance(value, dict) else []:
+            if k not in keys:
+                errors.append(("/".join(path + (k,)), "Unknown option"))
+
+    for name, error in sorted(errors, key=lambda e: e[0]):
+        err("Invalid configuration for %s: %s" % (name, error))
+    return not errors
+
+
 def config_advise(config, prov_apic):
     try:
         if prov_apic is not None:
             apic = get_apic(config)
 
             aep_name = config["aci_config"]["aep"]
-            aep = apic.get_aep(aep_name)
+            aep = apic_lookup(apic, apic.get_aep, aep_name)
             if aep is None:
                 warn("AEP not defined in the APIC: %s" % aep_name)
 
             vrf_tenant = config["aci_config"]["vrf"]["tenant"]
             vrf_name = config["aci_config"]["vrf"]["name"]
             l3out_name = config["aci_config"]["l3out"]["name"]
-            vrf = apic.get_vrf(vrf_tenant, vrf_name)
+            vrf = apic_lookup(apic, apic.get_vrf, vrf_tenant, vrf_name)
             if vrf is None:
                 warn("VRF not defined in the APIC: %s/%s" %
                      (vrf_tenant, vrf_name))
-            l3out = apic.get_l3out(vrf_tenant, l3out_name)
+            l3out = apic_lookup(apic, apic.get_l3out, vrf_tenant,
+                                l3out_name)
             if l3out is None:
                 warn("L3out not defined in the APIC: %s/%s" %
                      (vrf_tenant, l3out_name))
@@ -576,6 +931,23 @@ def config_advise(config, prov_apic):
     return True
 
 
+def config_hash(config):
+    # Stable token for the effective configuration: the generated
+    # password, the APIC login and run time options don't end up in the
+    # kubernetes objects and must not change the token
+    data = copy.deepcopy(config)
+    data.pop("provision", None)
+    data["aci_config"].pop("apic_login", None)
+    data["aci_config"]["sync_login"].pop("password", None)
+    data["registry"].pop("configuration_version", None)
+
+    h = hashlib.sha1()
+    h.update(json.dumps(data, sort_keys=True))
+    for template in TEMPLATES:
+        h.update(pkgutil.get_data('acc_provision', 'templates/' + template))
+    return h.hexdigest()
+
+
 def generate_sample(filep):
     data = pkgutil.get_data('acc_provision', 'templates/provision-config.yaml')
     filep.write(data)
@@ -590,15 +962,155 @@ def generate_password(no_random):
     return ret
 
 
-def generate_cert(username, cert_file, key_file):
+class BackgroundTask(object):
+    """Run fn(*args) in a thread, result() waits for it to complete.
+
+    The thread runs with the log, APIC and tracing context of the caller.
+    Its log lines are held back and logged by result(), so that they come
+    out at the same place whatever the timing of the threads.
+    """
+
+    def __init__(self, fn, *args):
+        self.value = None
+        self.error = None
+        self.lines = []
+        self.context = (
+            [(log_context, k, getattr(log_context, k, None))
+             for k in ["messages", "quiet"]] +
+            [(apic_context, "apic", getattr(apic_context, "apic", None))] +
+            [(tracing.context, k, getattr(tracing.context, k, None))
+             for k in ["label", "tracer"]])
+        self.thread = threading.Thread(target=self.run, args=(fn, args))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, fn, args):
+        for ctx, k, v in self.context:
+            setattr(ctx, k, v)
+        log_context.buffer = self.lines
+        try:
+            self.value = fn(*args)
+        except Exception as e:
+            self.error = e
+
+    def join(self):
+        self.thread.join()
+        lines, self.lines = self.lines, []
+        for msg in lines:
+            log(msg)
+
+    def wait(self):
+        # Like result(), but logs the error instead of raising it
+        self.join()
+        if self.error is not None:
+            err("%s: %s" % (self.error.__class__.__name__, self.error))
+
+    def result(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def sync_login_files(config):
+    system_id = config["aci_config"]["system_id"]
+    sync_login = config["aci_config"].get("sync_login", {})
+    certfile = sync_login.get("certfile", "user-%s.crt" % system_id)
+    keyfile = sync_login.get("keyfile", "user-%s.key" % system_id)
+    return certfile, keyfile
+
+
+def generate_key(key_type, key_pool=None):
+    if key_type not in KEY_TYPES:
+        raise Exception("Unknown key type %s; Expected one of: {%s}" %
+                        (key_type, ','.join(KEY_TYPES)))
+    if key_pool:
+        k = key_pool_take(key_pool, key_type)
+        if k is not None:
+            return k
+
+    if key_type == "ecdsa-p256":
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        pem = key.private_bytes(serialization.Encoding.PEM,
+                                serialization.PrivateFormat.PKCS8,
+                                serialization.NoEncryption())
+        return crypto.load_privatekey(crypto.FILETYPE_PEM, pem)
+    k = crypto.PKey()
+    k.generate_key(crypto.TYPE_RSA, int(key_type.split("-")[1]))
+    return k
+
+
+def key_pool_take(key_pool, key_type):
+    # Keys are claimed by renaming them so that concurrent runs sharing
+    # the pool never use the same key
+    for fname in sorted(glob.glob(os.path.join(key_pool,
+                                               key_type + "-*.pem"))):
+        claimed = "%s.%d" % (fname, os.getpid())
+        try:
+            os.rename(fname, claimed)
+        except OSError:
+            continue
+        with open(claimed, "r") as fp:
+            k = crypto.load_privatekey(crypto.FILETYPE_PEM, fp.read())
+        os.remove(claimed)
+        info("Using pre-generated key %s" % fname)
+        return k
+    return None
+
+
+def key_pool_put(key_pool, key_type, k):
+    if not os.path.isdir(key_pool):
+        os.makedirs(key_pool, 0o700)
+    fname = os.path.join(key_pool, "%s-%s.pem" % (key_type, uuid.uuid4()))
+    tmpname = fname + ".tmp"
+    fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as fp:
+        fp.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, k))
+    os.rename(tmpname, fname)
+
+
+def key_pool_release(key_pool, key_type, key_task):
+    # Puts the key of a background task that won't be used in the pool
+    if key_task is None or not key_pool:
+        return
+    try:
+        k = key_task.result()
+    except Exception:
+        return
+    key_pool_put(key_pool, key_type, k)
+    info("Returned the unused key to %s" % key_pool)
+
+
+def key_pool_fill(key_pool, key_type, count, jobs=1):
+    if not os.path.isdir(key_pool):
+        os.makedirs(key_pool, 0o700)
+
+    def add_key(i):
+        key_pool_put(key_pool, key_type, generate_key(key_type))
+
+    info("Generating %d %s keys in %s" % (count, key_type, key_pool))
+    pool = ThreadPool(max(jobs, 1))
+    try:
+        pool.map(add_key, range(count))
+    finally:
+        pool.close()
+
+
+def generate_cert(username, cert_file, key_file, key=None, save=True):
+    # Creates the files unless they exist; with save False, a new key and
+    # certificate are returned but not saved
     if not exists(cert_file) or not exists(key_file):
         info("Generating certs for kubernetes controller")
-        info("  Private key file: \"%s\"" % key_file)
-        info("  Certificate file: \"%s\"" % cert_file)
+        if save:
+            info("  Private key file: \"%s\"" % key_file)
+            info("  Certificate file: \"%s\"" % cert_file)
+        else:
+            info("  Not saved, the APIC is only read")
 
-        # create a key pair
-        k = crypto.PKey()
-        k.generate_key(crypto.TYPE_RSA, 1024)
+        # create a key pair, unless already generated by the caller
+        k = key
+        if k is None:
+            k = generate_key(DEFAULT_KEY_TYPE)
 
         # create a self-signed cert
         cert = crypto.X509()
@@ -610,10 +1122,12 @@ def generate_cert(username, cert_file, key_file):
         cert.gmtime_adj_notAfter(10 * 365 * 24 * 60 * 60)
         cert.set_issuer(cert.get_subject())
         cert.set_pubkey(k)
-        cert.sign(k, 'sha1')
+        cert.sign(k, 'sha256')
 
         cert_data = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
         key_data = crypto.dump_privatekey(crypto.FILETYPE_PEM, k)
+        if not save:
+            return key_data, cert_data
         with open(cert_file, "wt") as certp:
             certp.write(cert_data)
         with open(key_file, "wt") as keyp:
@@ -631,22 +1145,109 @@ def generate_cert(username, cert_file, key_file):
 
 
 def get_jinja_template(file):
-    env = Environment(
-        loader=PackageLoader('acc_provision', 'templates'),
-        trim_blocks=True,
-        lstrip_blocks=True,
-    )
-    env.filters['base64enc'] = base64.b64encode
-    env.filters['json'] = json_indent
-    env.filters['yaml'] = yaml_indent
-    env.filters['yaml_quote'] = yaml_quote
-    env.filters['yaml_list_dict'] = yaml_list_dict
-    template = env.get_template(file)
+    # The environment caches compiled templates, create it only once
+    global jinja_env
+    if jinja_env is None:
+        env = Environment(
+            loader=PackageLoader('acc_provision', 'templates'),
+            trim_blocks=True,
+            lstrip_blocks=True,
+        )
+        env.filters['base64enc'] = base64.b64encode
+        env.filters['json'] = json_indent
+        env.filters['yaml'] = yaml_indent
+        env.filters['yaml_quote'] = yaml_quote
+        env.filters['yaml_list_dict'] = yaml_list_dict
+        jinja_env = env
+    template = jinja_env.get_template(file)
     return template
 
 
-def generate_kube_yaml(config, output):
-    template = get_jinja_template('aci-containers.yaml')
+def split_kube_objects(data):
+    # Split a rendered multi-document YAML stream into (filename, text)
+    # pairs, one per kubernetes object
+    ret = []
+    for doc in re.split(r"(?m)^---\n", data):
+        if not doc.strip():
+            continue
+        obj = yaml.load(doc, Loader=YamlLoader)
+        name = "%s-%s.yaml" % (obj["kind"].lower(),
+                               obj["metadata"]["name"].replace(":", "-"))
+        if not doc.endswith("\n"):
+            doc += "\n"
+        ret.append((name, doc))
+    return ret
+
+
+def write_output(output, data):
+    if hasattr(output, "write"):
+        output.write(data)
+    else:
+        with open(output, "wb") as fp:
+            fp.write(data.encode("utf-8"))
+
+
+def write_if_changed(filename, data):
+    if exists(filename):
+        with open(filename, "rb") as fp:
+            if fp.read() == data.encode("utf-8"):
+                return False
+    write_output(filename, data)
+    return True
+
+
+def without_version_label(data):
+    # The version label changes with every input change or random token,
+    # it doesn't make an object change
+    return VERSION_LABEL_RE.sub(r'\1""', data)
+
+
+def write_output_dir(objects, output_dir):
+    # Writes the objects that changed to output_dir and removes the files
+    # of the objects that are no longer generated. Returns the names of
+    # the changed files and the (name, object) of the removed ones.
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    changed = []
+    for name, data in objects:
+        filename = os.path.join(output_dir, name)
+        if exists(filename):
+            with open(filename, "rb") as fp:
+                old = fp.read().decode("utf-8")
+            if without_version_label(old) == without_version_label(data):
+                continue
+        write_output(filename, data)
+        changed.append(name)
+
+    removed = []
+    names = set(name for name, data in objects)
+    for name in sorted(os.listdir(output_dir)):
+        filename = os.path.join(output_dir, name)
+        if name in names or not name.endswith(".yaml"):
+            continue
+        # Only the files we wrote, other files are left alone
+        with open(filename, "r") as fp:
+            try:
+                obj = yaml.load(fp, Loader=YamlLoader)
+            except yaml.YAMLError:
+                continue
+        labels = ((obj or {}).get("metadata") or {}).get("labels") or {}
+        if "aci-containers-config-version" not in labels:
+            continue
+        os.remove(filename)
+        removed.append((name, obj))
+    return changed, removed
+
+
+def render_output(flavor_opts, config):
+    template = get_jinja_template(
+        flavor_opts.get("template", "aci-containers.yaml"))
+    return template.render(config=config)
+
+
+def generate_kube_yaml(config, output, output_dir=None, data=None):
+    if data is None:
+        data = render_output(DEFAULT_FLAVOR_OPTIONS, config)
 
     kube_objects = [
         "configmap", "secret", "serviceaccount",
@@ -670,8 +1271,15 @@ def generate_kube_yaml(config, output):
         info("Using configuration label aci-containers-config-version=" +
              str(config["registry"]["configuration_version"]))
         info("Writing kubernetes infrastructure YAML to %s" % outname)
-        template.stream(config=config).dump(output)
+        write_output(output, data)
         info("Apply infrastructure YAML using:")
+        if config.get("rollout", {}).get("prepull_images"):
+            # Pull the images on every node before updating the agents
+            info("  %s apply -f %s -l name=aci-containers-prepull" %
+                 (config["kube_config"]["kubectl"], applyname))
+            info("  %s -n kube-system rollout status "
+                 "daemonset/aci-containers-prepull" %
+                 config["kube_config"]["kubectl"])
         info("  %s apply -f %s" %
              (config["kube_config"]["kubectl"], applyname))
         info("  %s -n kube-system delete %s -l "
@@ -681,11 +1289,50 @@ def generate_kube_yaml(config, output):
               ",".join(kube_objects),
               str(config["registry"]["configuration_version"])))
 
+    if output_dir:
+        info("Using configuration label aci-containers-config-version=" +
+             str(config["registry"]["configuration_version"]))
+        info("Writing kubernetes infrastructure objects to %s" % output_dir)
+        objects = split_kube_objects(data)
+        changed, removed = write_output_dir(objects, output_dir)
+        if changed:
+            info("Changed objects:")
+            for name in changed:
+                info("  %s" % name)
+            info("Apply changed objects using:")
+            info("  %s apply %s" %
+                 (config["kube_config"]["kubectl"],
+                  " ".join("-f %s" % os.path.join(output_dir, name)
+                           for name in changed)))
+        if removed:
+            info("Removed objects:")
+            for name, obj in removed:
+                info("  %s" % name)
+            info("Delete removed objects using:")
+            for name, obj in removed:
+                namespace = obj["metadata"].get("namespace")
+                info("  %s %sdelete %s %s" %
+                     (config["kube_config"]["kubectl"],
+                      "-n %s " % namespace if namespace else "",
+                      obj["kind"].lower(), obj["metadata"]["name"]))
+        if not changed and not removed:
+            info("No kubernetes objects changed")
+
     return config
 
 
-def generate_cf_yaml(config, output):
-    template = get_jinja_template('aci-cf-containers.yaml')
+def generate_cf_yaml(config, output, output_dir=None, data=None):
+    if data is None:
+        data = render_output(CfFlavorOptions, config)
+
+    if output_dir:
+        # The deployment vars are a single document, keep them in one file
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        output = os.path.join(output_dir, "aci-cf-containers.yaml")
+        if not write_if_changed(output, data):
+            info("No deployment vars changed in %s" % output)
+            return config
 
     if output and output != "/dev/null":
         outname = output
@@ -698,7 +1345,7 @@ def generate_cf_yaml(config, output):
             applyname = os.path.basename(output)
 
         info("Writing deployment vars for ACI add-ons to %s" % outname)
-        template.stream(config=config).dump(output)
+        write_output(output, data)
         pg = ("%s/%s" %
               (config['aci_config']['vmm_domain']['nested_inside']['name'],
                config['cf_config']['node_network']))
@@ -737,43 +1384,129 @@ networks:
 CfFlavorOptions['template_generator'] = generate_cf_yaml
 
 
-def generate_apic_config(flavor_opts, config, prov_apic, apic_file):
-    configurator = ApicKubeConfig(config)
-    for k, v in flavor_opts.get("apic", {}).iteritems():
-        setattr(configurator, k, v)
-    apic_config = configurator.get_config()
+def generate_apic_config(flavor_opts, config, prov_apic, apic_file,
+                         apic_config=None):
+    if apic_config is None:
+        with tracing.phase("apic-gen"):
+            configurator = ApicKubeConfig(config)
+            for k, v in flavor_opts.get("apic", {}).iteritems():
+                setattr(configurator, k, v)
+            apic_config = configurator.get_config()
     if apic_file:
+        header = None
+        if apic_file.endswith(".jsonl"):
+            header = apic_file_header(config)
         if apic_file == "-":
             info("Writing apic configuration to \"STDOUT\"")
             ApicKubeConfig.save_config(apic_config, sys.stdout)
         else:
             info("Writing apic configuration to \"%s\"" % apic_file)
             with open(apic_file, 'w') as outfile:
-                ApicKubeConfig.save_config(apic_config, outfile)
+                ApicKubeConfig.save_config(apic_config, outfile, header)
 
-    sync_login = config["aci_config"]["sync_login"]["username"]
     if prov_apic is not None:
-        apic = get_apic(config)
+        push_apic_config(config, apic_config, prov_apic)
+    return apic_config
+
+
+def post_limits(config):
+    # (max_bytes, max_objects, jobs) of the APIC POSTs
+    apic_post = config["aci_config"].get("apic_post") or {}
+    return (apic_post.get("max_bytes") or apic_provision.POST_MAX_BYTES,
+            apic_post.get("max_objects") or apic_provision.POST_MAX_OBJECTS,
+            apic_post.get("jobs") or apic_provision.POST_JOBS)
+
+
+def push_apic_config(config, apic_config, prov_apic):
+    # Provisions apic_config in the APIC, or removes it if prov_apic is
+    # False
+    sync_login = config["aci_config"]["sync_login"]["username"]
+    apic = get_apic(config)
+    if config["provision"].get("run_dir"):
+        run_id = save_run(apic, config, apic_config)
+        info("Saved the APIC objects before the change, undo with "
+             "--rollback %s" % run_id)
+    with tracing.phase("apic-push"):
         if prov_apic is True:
             info("Provisioning configuration in APIC")
-            apic.provision(apic_config, sync_login)
+            shared = None
+            if apic_shared_objects is not None:
+                shared = apic_shared_objects.setdefault(apic.addr, set())
+            apic.provision(apic_config, sync_login, shared,
+                           post_limits(config))
         if prov_apic is False:
             info("Unprovisioning configuration in APIC")
             system_id = config["aci_config"]["system_id"]
             tenant = config["aci_config"]["vrf"]["tenant"]
             apic.unprovision(apic_config, system_id, tenant)
-    return apic_config
+
+
+def apic_file_header(config):
+    # What --replay needs besides the APIC credentials
+    aci_config = config["aci_config"]
+    return {
+        "aci_config": {
+            "apic_hosts": aci_config["apic_hosts"],
+            "system_id": aci_config["system_id"],
+            "vrf": {"tenant": aci_config["vrf"]["tenant"]},
+            "sync_login": {
+                "username": aci_config["sync_login"]["username"],
+            },
+        },
+    }
 
 
 def get_apic(config):
+    apic = getattr(apic_context, "apic", None)
+    if apic is not None:
+        return apic
+
     apic_host = config["aci_config"]["apic_hosts"][0]
     apic_username = config["aci_config"]["apic_login"]["username"]
     apic_password = config["aci_config"]["apic_login"]["password"]
     debug = config["provision"]["debug_apic"]
-    apic = Apic(apic_host, apic_username, apic_password, debug=debug)
+
+    snapshot_file = config["provision"].get("snapshot")
+    if snapshot_file:
+        # Answer the APIC queries from the snapshot, loaded again only
+        # when the file changes
+        st = os.stat(snapshot_file)
+        key = ("snapshot", snapshot_file, st.st_mtime, st.st_size, debug)
+        with apic_sessions_lock:
+            apic = apic_sessions.get(key)
+            if apic is None:
+                apic = snapshot.SnapshotApic(snapshot_file, debug=debug)
+                apic_sessions[key] = apic
+        return apic
+
+    # Reuse the logged in session for the fabric
+    key = (apic_host, apic_username, apic_password, debug)
+    with apic_sessions_lock:
+        apic = apic_sessions.get(key)
+        if apic is None:
+            apic = Apic(apic_host, apic_username, apic_password, debug=debug)
+            if apic.cookies is not None:
+                apic_sessions[key] = apic
     return apic
 
 
+def apic_lookup(apic, fn, *args):
+    # Returns fn(*args), reusing a recent result if the preflight cache
+    # is enabled
+    if apic_preflight is None:
+        return fn(*args)
+    key = (apic.addr, fn.__name__) + args
+    now = time.time()
+    with apic_sessions_lock:
+        entry = apic_preflight.get(key)
+    if entry is not None and now - entry[0] < PREFLIGHT_TTL:
+        return entry[1]
+    ret = fn(*args)
+    with apic_sessions_lock:
+        apic_preflight[key] = (now, ret)
+    return ret
+
+
 class CustomFormatter(argparse.HelpFormatter):
     def _format_action_invocation(self, action):
         ret = super(CustomFormatter, self)._format_action_invocation(action)
@@ -784,13 +1517,94 @@ class CustomFormatter(argparse.HelpFormatter):
         return ret
 
 
-def parse_args():
+def get_version():
     version = 'Unknown'
     try:
         version = pkg_resources.require("acc_provision")[0].version
     except pkg_resources.DistributionNotFound:
         # ignore, expected in case running from source
         pass
+    return version
+
+
+def cache_key(args, flavor, config, no_random):
+    # Hash of everything the generated artifacts depend on, but the version
+    # token which is set by cache_version; returns None if the certs still
+    # have to be generated, those runs are not cached
+    h = hashlib.sha1()
+    h.update(json.dumps([get_version(), flavor, config,
+                         args.hash_version_token, args.delete, no_random],
+                        sort_keys=True, default=str))
+    # Every module and template of the package
+    for name in sorted(pkg_resources.resource_listdir('acc_provision', '')):
+        if name.endswith(".py"):
+            h.update(pkgutil.get_data('acc_provision', name))
+    for name in sorted(pkg_resources.resource_listdir('acc_provision',
+                                                      'templates')):
+        h.update(pkgutil.get_data('acc_provision', 'templates/' + name))
+
+    if not args.delete:
+        for fname in sync_login_files(config):
+            if not exists(fname):
+                return None
+            with open(fname, "r") as fp:
+                h.update(fp.read())
+    return h.hexdigest()
+
+
+def cache_version(args, config, output):
+    # Sets the version token of this run in cached artifacts: the one
+    # given, the same hash, or a new one like an uncached run gets
+    cached = config["registry"]["configuration_version"]
+    if args.version_token:
+        token = args.version_token
+    elif args.hash_version_token:
+        token = cached
+    else:
+        token = str(uuid.uuid4())
+    config["registry"]["configuration_version"] = token
+    label = 'aci-containers-config-version: "%s"'
+    return output.replace(label % cached, label % token)
+
+
+def cache_load(cache_dir, key):
+    fname = os.path.join(os.path.expanduser(cache_dir), key + ".json")
+    if not exists(fname):
+        return None
+    try:
+        with open(fname, "r") as fp:
+            entry = json.load(fp)
+        entry["apic_config"] = [tuple(x) for x in entry["apic_config"]]
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        warn("Ignoring invalid cache entry %s: %s" % (fname, e))
+        return None
+    return entry
+
+
+def cache_store(cache_dir, key, config, apic_config, output):
+    # The APIC admin login is part of the key, don't persist it
+    config = copy.deepcopy(config)
+    config["aci_config"].pop("apic_login", None)
+    entry = {
+        "config": config,
+        "apic_config": apic_config,
+        "output": output,
+    }
+
+    # Entries include the private key, keep them private to the user
+    cache_dir = os.path.expanduser(cache_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, 0o700)
+    fname = os.path.join(cache_dir, key + ".json")
+    tmpname = "%s.%d.tmp" % (fname, os.getpid())
+    fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as fp:
+        json.dump(entry, fp)
+    os.rename(tmpname, fname)
+
+
+def parse_args(argv=None):
+    version = get_version()
 
     parser = argparse.ArgumentParser(
         description='Provision an ACI/Kubernetes installation',
@@ -810,6 +1624,26 @@ def parse_args():
     parser.add_argument(
         '-o', '--output', default="-", metavar='file',
         help='output file for your kubernetes deployment')
+    parser.add_argument(
+        '--output-dir', default=None, metavar='dir',
+        help='write one file per kubernetes object into dir, '
+        'rewriting only the objects that changed')
+    parser.add_argument(
+        '--apic-file', dest='apicfile', default=None, metavar='file',
+        help='write the generated APIC configuration to file, as JSON '
+        'lines with the APIC and system id if file ends with .jsonl')
+    parser.add_argument(
+        '--replay', default=None, metavar='file',
+        help='push the APIC configuration saved with --apic-file, or '
+        'remove it with --delete, without generating anything')
+    parser.add_argument(
+        '--run-dir', default=DEFAULT_RUN_DIR, metavar='dir',
+        help='directory where the APIC objects are saved before each '
+        'change, empty to disable.  Default is %s' % DEFAULT_RUN_DIR)
+    parser.add_argument(
+        '--rollback', default=None, metavar='run-id',
+        help='restore the APIC objects changed by a run, given its run id '
+        'or saved file')
     parser.add_argument(
         '-a', '--apic', action='store_true', default=False,
         help='create/validate the required APIC resources')
@@ -831,21 +1665,113 @@ def parse_args():
     parser.add_argument(
         '-t', '--version-token', default=None, metavar='token',
         help='set a configuration version token.  Default is UUID.')
-    return parser.parse_args()
+    parser.add_argument(
+        '--hash-version-token', action='store_true', default=False,
+        help='derive the configuration version token from a hash of the '
+        'configuration, templates and image versions')
+    parser.add_argument(
+        '--batch', default=None, metavar='path',
+        help='provision every cluster in a directory of input files or '
+        'in a YAML manifest')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1, metavar='n',
+        help='number of clusters provisioned in parallel in batch mode')
+    parser.add_argument(
+        '--batch-report', default=None, metavar='file',
+        help='write a JSON summary of the batch to file')
+    parser.add_argument(
+        '--rotate-cert', action='store_true', default=False,
+        help='replace the key and certificate of the controller APIC user, '
+        'updating only the APIC user certificate and the kubernetes secret')
+    parser.add_argument(
+        '--fleet', default=None, metavar='path',
+        help='check the clusters of a fabric, a directory of input files '
+        'or a YAML manifest, for overlapping multicast ranges, VLANs and '
+        'subnets and exit')
+    parser.add_argument(
+        '--allocate', default=None, metavar='file',
+        help='assign free multicast ranges, VLANs and subnets, not used by '
+        'the --fleet clusters, to the options missing in the input and '
+        'write the completed input to file')
+    parser.add_argument(
+        '--fleet-state', default=DEFAULT_FLEET_STATE, metavar='file',
+        help='file keeping the pools and the allocations of --allocate.  '
+        'Default is %s' % DEFAULT_FLEET_STATE)
+    parser.add_argument(
+        '--key-type', default=DEFAULT_KEY_TYPE, choices=KEY_TYPES,
+        help='type of the generated controller key.  '
+        'Default is %s' % DEFAULT_KEY_TYPE)
+    parser.add_argument(
+        '--key-pool', default=None, metavar='dir',
+        help='take the controller key from a pool of pre-generated keys')
+    parser.add_argument(
+        '--fill-key-pool', type=int, default=None, metavar='n',
+        help='add n pre-generated keys to the key pool and exit')
+    parser.add_argument(
+        '--trace', default=None, metavar='file',
+        help='write a JSON trace of phase and APIC request timings to '
+        'file and print a summary at the end of the run')
+    parser.add_argument(
+        '--profile', default=None, metavar='file',
+        help='profile the run, writing pstats to file and a report of CPU '
+        'and memory hotspots to file.txt')
+    parser.add_argument(
+        '--no-cache', action='store_true', default=False,
+        help='regenerate everything instead of using the build cache')
+    parser.add_argument(
+        '--cache-dir', default=None, metavar='dir',
+        help='build cache directory.  Default is %s' % DEFAULT_CACHE_DIR)
+    parser.add_argument(
+        '--check-drift', action='store_true', default=False,
+        help='compare the APIC objects with the generated configuration, '
+        'print a JSON report of the differences and exit with 1 if any')
+    parser.add_argument(
+        '--watch', action='store_true', default=False,
+        help='keep running and reprovision whenever the input file changes, '
+        'pushing only the changed APIC objects; use with --output-dir to '
+        'write only the changed kubernetes objects')
+    parser.add_argument(
+        '--watch-interval', type=float, default=DEFAULT_WATCH_INTERVAL,
+        metavar='sec',
+        help='polling interval when inotify is not available.  '
+        'Default is %s' % DEFAULT_WATCH_INTERVAL)
+    parser.add_argument(
+        '--serve', default=None, metavar='addr',
+        help='run as a daemon serving render, plan, apply and delete '
+        'requests over HTTP on [host:]port')
+    parser.add_argument(
+        '--export-snapshot', default=None, metavar='file',
+        help='write the APIC objects used by the input, or by every '
+        'cluster of --batch, to a JSON lines snapshot file and exit')
+    parser.add_argument(
+        '--snapshot', default=None, metavar='file',
+        help='check the configuration and drift against a snapshot file '
+        'instead of the APIC; nothing is changed in the APIC')
+    return parser.parse_args(argv)
 
 
-def provision(args, apic_file, no_random):
+def provision(args, apic_file, no_random, user_config=None, result=None,
+              push=True):
+    # user_config is used instead of reading args.config when given; the
+    # generated config, apic_config and output are stored in result when
+    # given; push=False checks the APIC without changing it
     config_file = args.config
     output_file = args.output
+    output_dir = args.output_dir
     prov_apic = None
     if args.apic:
         prov_apic = True
+    if args.snapshot:
+        # The snapshot is read-only
+        prov_apic = True
+        push = False
     if args.delete:
         prov_apic = False
 
     generate_cert_data = True
     if args.delete:
         output_file = "/dev/null"
+        output_dir = None
         generate_cert_data = False
 
     # Print sample, if needed
@@ -862,6 +1788,8 @@ def provision(args, apic_file, no_random):
         "provision": {
             "prov_apic": prov_apic,
             "debug_apic": args.debug,
+            "snapshot": args.snapshot,
+            "run_dir": args.run_dir,
         },
     }
     if args.username:
@@ -870,69 +1798,754 @@ def provision(args, apic_file, no_random):
         config["aci_config"]["apic_login"]["password"] = args.password
 
     # Create config
-    user_config = config_user(config_file)
+    if user_config is None:
+        with tracing.phase("load"):
+            user_config = config_user(config_file)
     deep_merge(config, user_config)
 
     flavor = DEFAULT_FLAVOR
     if args.flavor:
         flavor = args.flavor
-    if flavor in FLAVORS:
-        info("Using configuration flavor " + flavor)
-        if "config" in FLAVORS[flavor]:
-            deep_merge(config, FLAVORS[flavor]["config"])
-        if "default_version" in FLAVORS[flavor]:
-            deep_merge(config, {
-                "registry": {
-                    "version": FLAVORS[flavor]["default_version"]
-                }
-            })
-    else:
-        err("Unknown flavor %s" % flavor)
-        return False
-    flavor_opts = FLAVORS[flavor].get("options", DEFAULT_FLAVOR_OPTIONS)
+    with tracing.phase("merge"):
+        if flavor in FLAVORS:
+            info("Using configuration flavor " + flavor)
+            if "config" in FLAVORS[flavor]:
+                deep_merge(config, copy.deepcopy(FLAVORS[flavor]["config"]))
+            if "default_version" in FLAVORS[flavor]:
+                deep_merge(config, {
+                    "registry": {
+                        "version": FLAVORS[flavor]["default_version"]
+                    }
+                })
+        else:
+            err("Unknown flavor %s" % flavor)
+            return False
+        flavor_opts = FLAVORS[flavor].get("options", DEFAULT_FLAVOR_OPTIONS)
 
-    deep_merge(config, config_default())
+        deep_merge(config, config_default())
 
-    if config["registry"]["version"] in VERSIONS:
-        deep_merge(config,
-                   {"registry": VERSIONS[config["registry"]["version"]]})
+        if config["registry"]["version"] in VERSIONS:
+            deep_merge(config,
+                       {"registry": VERSIONS[config["registry"]["version"]]})
 
-    deep_merge(config, config_discover(config, prov_apic))
+    with tracing.phase("discover"):
+        deep_merge(config, config_discover(config, prov_apic))
 
     # Validate config
-    if not config_validate(flavor_opts, config):
-        err("Please fix configuration and retry.")
-        return False
+    with tracing.phase("validate"):
+        if not config_validate(flavor_opts, config):
+            err("Please fix configuration and retry.")
+            return False
+
+    # Advisory checks, including apic checks, ignore failures; they only
+    # read the APIC and overlap with the generation up to the push. They
+    # get a copy of the config, which the generation changes.
+    def advise(config, prov_apic):
+        with tracing.phase("advise"):
+            config_advise(config, prov_apic)
+    advise_task = BackgroundTask(advise, copy.deepcopy(config), prov_apic)
+
+    # Runs that only read the APIC don't save new certs
+    save_cert = push or prov_apic is None
+
+    # Generate the key in the background, overlapping with the rest of
+    # the config generation; an unused key goes back to the pool
+    key_task = None
+    if generate_cert_data and save_cert and \
+            not all(exists(f) for f in sync_login_files(config)):
+        key_task = BackgroundTask(generate_key, args.key_type, args.key_pool)
+
+    # Reuse the generated artifacts if none of the inputs changed
+    cache_dir = args.cache_dir or DEFAULT_CACHE_DIR
+    key, cached = None, None
+    if not args.no_cache:
+        with tracing.phase("cache"):
+            key = cache_key(args, flavor, config, no_random)
+            if key is not None:
+                cached = cache_load(cache_dir, key)
+
+    apic_config, output = None, None
+    if cached:
+        info("Using cached build artifacts %s" % key)
+        apic_login = config["aci_config"]["apic_login"]
+        config = cached["config"]
+        config["aci_config"]["apic_login"] = apic_login
+        apic_config = cached["apic_config"]
+        output = cache_version(args, config, cached["output"])
+    else:
+        # Adjust config based on convention/apic data
+        with tracing.phase("adjust"):
+            try:
+                adj_config = config_adjust(args, config, prov_apic,
+                                           no_random)
+            except Exception:
+                key_pool_release(args.key_pool, args.key_type, key_task)
+                raise
+            deep_merge(config, adj_config)
+
+        # generate key and cert if needed
+        username = config["aci_config"]["sync_login"]["username"]
+        certfile = config["aci_config"]["sync_login"]["certfile"]
+        keyfile = config["aci_config"]["sync_login"]["keyfile"]
+        key_data, cert_data = None, None
+        if generate_cert_data:
+            with tracing.phase("cert"):
+                pkey = None
+                if key_task is not None:
+                    pkey = key_task.result()
+                key_data, cert_data = generate_cert(username, certfile,
+                                                    keyfile, pkey, save_cert)
+        config["aci_config"]["sync_login"]["key_data"] = key_data
+        config["aci_config"]["sync_login"]["cert_data"] = cert_data
+
+        # identical inputs produce identical output if requested
+        if args.hash_version_token and not args.version_token:
+            config["registry"]["configuration_version"] = config_hash(config)
 
-    # Adjust config based on convention/apic data
-    adj_config = config_adjust(args, config, prov_apic, no_random)
-    deep_merge(config, adj_config)
+    # generate output files; and program apic if needed
+    apic_config = generate_apic_config(flavor_opts, config, None, apic_file,
+                                       apic_config)
+    advise_task.result()
+    if result is not None:
+        result["config"] = config
+        result["apic_config"] = apic_config
+
+    # The push runs while the output is rendered and written, its log
+    # lines follow those of the output
+    push_task = None
+    if push and prov_apic is not None:
+        push_task = BackgroundTask(push_apic_config, config, apic_config,
+                                   prov_apic)
+    try:
+        # Nothing is written when unprovisioning
+        if not args.delete:
+            with tracing.phase("render"):
+                if output is None:
+                    output = render_output(flavor_opts, config)
+                if key is not None and not cached:
+                    cache_store(cache_dir, key, config, apic_config, output)
+                if result is not None:
+                    result["output"] = output
+
+                gen = flavor_opts.get("template_generator",
+                                      generate_kube_yaml)
+                if output_dir:
+                    output_file = None
+                gen(config, output_file, output_dir, output)
+    except Exception:
+        # The render error is raised, an error of the push is only logged
+        if push_task is not None:
+            push_task.wait()
+        raise
+    if push_task is not None:
+        push_task.result()
+    return True
 
-    # Advisory checks, including apic checks, ignore failures
-    if not config_advise(config, prov_apic):
-        pass
 
-    # generate key and cert if needed
-    username = config["aci_config"]["sync_login"]["username"]
-    certfile = config["aci_config"]["sync_login"]["certfile"]
-    keyfile = config["aci_config"]["sync_login"]["keyfile"]
-    key_data, cert_data = None, None
-    if generate_cert_data:
-        key_data, cert_data = generate_cert(username, certfile, keyfile)
-    config["aci_config"]["sync_login"]["key_data"] = key_data
-    config["aci_config"]["sync_login"]["cert_data"] = cert_data
+def batch_clusters(args):
+    if os.path.isdir(args.batch) and not args.output_dir:
+        raise Exception("--output-dir is required for a batch directory")
+    return manifest_clusters(args.batch)
+
+
+def manifest_clusters(path):
+    # Returns a list of dicts describing each cluster of a directory of
+    # input files or of a manifest. A manifest is a YAML list of entries
+    # with the keys: config, name, flavor, output, output_dir and
+    # apic_file. Paths are relative to the manifest.
+    if os.path.isdir(path):
+        clusters = []
+        files = sorted(glob.glob(os.path.join(path, "*.yaml")) +
+                       glob.glob(os.path.join(path, "*.yml")))
+        for config_file in files:
+            clusters.append({
+                "config": config_file,
+                "name": os.path.splitext(os.path.basename(config_file))[0],
+            })
+        return clusters
+
+    basedir = os.path.dirname(path)
+    with open(path, "r") as fp:
+        clusters = yaml.load(fp, Loader=YamlLoader) or []
+    for cluster in clusters:
+        for k in ["config", "output", "output_dir", "apic_file"]:
+            if cluster.get(k) and cluster[k] != "-":
+                cluster[k] = os.path.join(basedir, cluster[k])
+        if not cluster.get("name"):
+            cluster["name"] = os.path.splitext(
+                os.path.basename(cluster["config"]))[0]
+    return clusters
+
+
+def provision_cluster(args, cluster, no_random, log_state=None):
+    # The log lines of the cluster are held back and logged together,
+    # prefixed with its name, once it is provisioned
+    if log_state is not None:
+        logs.set_context(log_state)
+    lines = log_context.buffer = []
+    try:
+        return provision_cluster_logged(args, cluster, no_random)
+    finally:
+        log_context.buffer = None
+        for msg in lines:
+            # After the level, "INFO: " or "ERR:  "
+            log("%s%s: %s" % (msg[:6], cluster["name"], msg[6:]))
+
+
+def provision_cluster_logged(args, cluster, no_random):
+    cargs = argparse.Namespace(**vars(args))
+    cargs.batch = None
+    cargs.config = cluster["config"]
+    cargs.flavor = cluster.get("flavor", args.flavor)
+    cargs.output = cluster.get("output")
+    cargs.output_dir = cluster.get("output_dir")
+    if not cargs.output and not cargs.output_dir and args.output_dir:
+        cargs.output_dir = os.path.join(args.output_dir, cluster["name"])
+
+    result = {
+        "name": cluster["name"],
+        "config": cluster["config"],
+        "status": "failed",
+    }
+    start = time.time()
+    tracing.set_label(cluster["name"])
+    if not cargs.output and not cargs.output_dir and not cargs.delete:
+        # Nothing would be written
+        result["error"] = "No output or output_dir"
+        err(result["error"])
+        result["elapsed"] = 0.0
+        return result
+    try:
+        if provision(cargs, cluster.get("apic_file"), no_random):
+            result["status"] = "ok"
+    except Exception as e:
+        err("%s: %s" % (e.__class__.__name__, e))
+        result["error"] = "%s: %s" % (e.__class__.__name__, e)
+    result["elapsed"] = round(time.time() - start, 3)
+    return result
 
-    # generate output files; and program apic if needed
-    generate_apic_config(flavor_opts, config, prov_apic, apic_file)
-    gen = flavor_opts.get("template_generator", generate_kube_yaml)
-    gen(config, output_file)
-    return True
+
+def provision_batch(args, no_random):
+    global apic_shared_objects
+    clusters = batch_clusters(args)
+    info("Provisioning %d clusters using %d jobs" %
+         (len(clusters), args.jobs))
+
+    apic_shared_objects = {}
+    log_state = logs.get_context()
+    pool = ThreadPool(max(args.jobs, 1))
+    try:
+        results = pool.map(
+            lambda c: provision_cluster(args, c, no_random, log_state),
+            clusters)
+    finally:
+        pool.close()
+        apic_shared_objects = None
+
+    failed = [r for r in results if r["status"] != "ok"]
+    info("Batch summary:")
+    for r in results:
+        info("  %-30s %-6s %.3fs" % (r["name"], r["status"], r["elapsed"]))
+    info("%d clusters provisioned, %d failed" %
+         (len(results) - len(failed), len(failed)))
+
+    if args.batch_report:
+        report = {
+            "clusters": results,
+            "ok": len(results) - len(failed),
+            "failed": len(failed),
+        }
+        with open(args.batch_report, "w") as fp:
+            json.dump(report, fp, indent=4, sort_keys=True)
+    return not failed
+
+
+def kubectl(config, *args, **kwargs):
+    # Runs the kubectl of the configuration, returns its output
+    cmd = shlex.split(config["kube_config"]["kubectl"]) + list(args)
+    if kwargs.get("log", True):
+        info("Running %s" % " ".join(cmd))
+    return subprocess.check_output(cmd)
+
+
+def rolled_out(deployment):
+    # Whether all the pods of a deployment are of its latest template and
+    # available, as kubectl rollout status checks
+    spec, status = deployment["spec"], deployment.get("status", {})
+    replicas = spec.get("replicas", 1)
+    updated = status.get("updatedReplicas", 0)
+    return (status.get("observedGeneration", 0) >=
+            deployment["metadata"].get("generation", 0) and
+            updated >= replicas and
+            status.get("replicas", 0) <= updated and
+            status.get("availableReplicas", 0) >= updated)
+
+
+def restart_controller(config):
+    # Restarts the controller by changing an annotation of its pod
+    # template, as rollout restart needs kubectl 1.15 and isn't in oc 3.x,
+    # then waits for the new pods
+    name = "aci-containers-controller"
+    kubectl(config, "-n", "kube-system", "patch", "deployment", name, "-p",
+            json.dumps({"spec": {"template": {"metadata": {"annotations": {
+                ROTATE_ANNOTATION: time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                                 time.gmtime())}}}}}))
+    info("Waiting for deployment %s" % name)
+    deadline = time.time() + ROTATE_TIMEOUT
+    while not rolled_out(json.loads(kubectl(
+            config, "-n", "kube-system", "get", "deployment", name,
+            "-o", "json", log=False))):
+        if time.time() > deadline:
+            raise Exception("Deployment %s not restarted after %ds" %
+                            (name, ROTATE_TIMEOUT))
+        time.sleep(ROTATE_POLL)
+
+
+def rotate_cert(args, no_random):
+    # Replaces the key and certificate of the controller user: the new
+    # certificate is added next to the one in use and checked, then the
+    # secret is applied, the certificate the controller signs with is
+    # replaced and the controller restarted, and the extra one removed.
+    # The old certificate and secret are put back if the restart fails.
+    flavor = args.flavor or DEFAULT_FLAVOR
+    flavor_opts = FLAVORS[flavor].get("options", DEFAULT_FLAVOR_OPTIONS)
+    if flavor_opts.get("template_generator",
+                       generate_kube_yaml) != generate_kube_yaml:
+        err("--rotate-cert is not supported for the %s flavor" % flavor)
+        return 1
+
+    cargs = argparse.Namespace(**vars(args))
+    cargs.apic = False
+    cargs.output = None
+    cargs.output_dir = None
+    cargs.no_cache = True
+    result = {}
+    config = config_user(args.config)
+    if not config.get("aci_config", {}).get("system_id"):
+        err("Missing system_id in %s" % args.config)
+        return 1
+    # Checked first, provision() would generate them otherwise
+    certfile, keyfile = sync_login_files(config)
+    if not exists(certfile) or not exists(keyfile):
+        err("No certificate to rotate in %s and %s" % (certfile, keyfile))
+        return 1
+    if not provision(cargs, None, no_random, config, result, push=False):
+        return 1
+    config = result["config"]
+    if not args.version_token:
+        # The secret keeps the version of the deployed objects
+        config["registry"]["configuration_version"] = kubectl(
+            config, "-n", "kube-system", "get", "secret", "aci-user-cert",
+            "-o", "jsonpath={.metadata.labels.aci-containers-config-version}"
+        ).strip()
+
+    sync_login = config["aci_config"]["sync_login"]
+    username = sync_login["username"]
+    cert_name, next_name = "%s.crt" % username, "%s-next.crt" % username
+    user_path = "/api/node/mo/uni/userext/user-%s.json" % username
+    next_path = "/api/node/mo/uni/userext/user-%s/usercert-%s.json" % (
+        username, next_name)
+    newcert, newkey = certfile + ".new", keyfile + ".new"
+    for fname in [newcert, newkey]:
+        if exists(fname):
+            os.remove(fname)
+    key_data, cert_data = generate_cert(
+        username, newcert, newkey, generate_key(args.key_type, args.key_pool))
+
+    old_data = (sync_login["key_data"], sync_login["cert_data"])
+
+    def post_cert(name, data):
+        apic.check_resp(apic.post(user_path, json.dumps({
+            "aaaUser": {
+                "attributes": {"name": username},
+                "children": [aci_obj_cert(name, data)],
+            }
+        })))
+
+    def apply_secret(data):
+        sync_login["key_data"], sync_login["cert_data"] = data
+        secret = [doc for name, doc in
+                  split_kube_objects(render_output(flavor_opts, config))
+                  if name == "secret-aci-user-cert.yaml"][0]
+        # The secret holds the private key
+        output = args.output
+        if output and output != "-":
+            fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+        else:
+            fd, output = tempfile.mkstemp(suffix=".yaml")
+        try:
+            with os.fdopen(fd, "w") as fp:
+                fp.write(secret)
+            kubectl(config, "apply", "-f", output)
+        finally:
+            if output != args.output:
+                os.remove(output)
+
+    def undo():
+        apic.delete(next_path)
+        os.remove(newcert)
+        os.remove(newkey)
+
+    def restore():
+        # Puts the old certificate and secret back, as far as possible
+        for step in [lambda: post_cert(cert_name, old_data[1]),
+                     lambda: apply_secret(old_data), undo]:
+            try:
+                step()
+            except Exception as e:
+                err("Error in restoring certificate %s: %s" % (cert_name, e))
+
+    apic = get_apic(config)
+    try:
+        post_cert(next_name, cert_data)
+        if not apic.check_cert(username, next_name, key_data):
+            raise Exception("The APIC rejects the new certificate")
+        info("Added certificate %s to user %s" % (next_name, username))
+        apply_secret((key_data, cert_data))
+    except Exception:
+        undo()
+        raise
+
+    # The controller signs with the key it read at startup: from here
+    # until it is restarted its requests are rejected
+    try:
+        post_cert(cert_name, cert_data)
+        restart_controller(config)
+    except Exception as e:
+        err("Replacing certificate %s failed, restoring it: %s" %
+            (cert_name, e))
+        restore()
+        raise
+    os.rename(newcert, certfile)
+    os.rename(newkey, keyfile)
+    info("Replaced certificate %s of user %s, new key in %s" %
+         (cert_name, username, keyfile))
+    if not apic.check_cert(username, cert_name, key_data):
+        err("The APIC rejects the new certificate %s" % cert_name)
+        return 1
+    apic.check_resp(apic.delete(next_path))
+    info("Removed certificate %s of user %s" % (next_name, username))
+    return 0
+
+
+def aci_obj_cert(name, data):
+    return {"aaaUserCert": {"attributes": {"name": name, "data": data}}}
+
+
+def fleet_clusters(args, exclude=None):
+    # Returns the allocation state and the (system id, resources) of the
+    # clusters of --fleet, then of those only in the state, but for the
+    # system id exclude
+    state = fleet.load_state(os.path.expanduser(args.fleet_state))
+    clusters, seen = [], set()
+    for cluster in (manifest_clusters(args.fleet) if args.fleet else []):
+        config = deep_merge(config_user(cluster["config"]), config_default())
+        system_id = config["aci_config"]["system_id"] or cluster["name"]
+        if system_id == exclude:
+            continue
+        if system_id in seen:
+            warn("Duplicate system_id %s in %s" %
+                 (system_id, cluster["config"]))
+            system_id = cluster["name"]
+        seen.add(system_id)
+        clusters.append((system_id, fleet.cluster_resources(config)))
+    for system_id, entry in sorted(state["clusters"].items()):
+        if system_id not in seen and system_id != exclude:
+            clusters.append(
+                (system_id, [tuple(r) for r in entry["resources"]]))
+    return state, clusters
+
+
+def fleet_check(args):
+    state, clusters = fleet_clusters(args)
+    conflicts = fleet.Fleet(clusters).conflicts()
+    print(json.dumps({"clusters": len(clusters), "conflicts": conflicts},
+                     indent=4, sort_keys=True, separators=(",", ": ")))
+    if conflicts:
+        warn("%d overlapping resources in %d clusters" %
+             (len(conflicts), len(clusters)))
+        return 1
+    info("No overlapping resources in %d clusters" % len(clusters))
+    return 0
+
+
+def fleet_allocate(args):
+    config = config_user(args.config)
+    system_id = (config.get("aci_config") or {}).get("system_id")
+    if not system_id:
+        err("Invalid configuration for aci_config/system_id: Missing option")
+        return 1
+    state, clusters = fleet_clusters(args, exclude=system_id)
+    fl = fleet.Fleet(clusters)
+    fl.add_resources(system_id, fleet.cluster_resources(config))
+    conflicts = fl.conflicts(system_id)
+    for c in conflicts:
+        err("%s %s of %s overlaps %s %s of %s" % (
+            c["a"]["field"], c["a"]["value"], c["a"]["cluster"],
+            c["b"]["field"], c["b"]["value"], c["b"]["cluster"]))
+    if conflicts:
+        return 1
+
+    allocated = fl.allocate(system_id, config, state["pools"])
+    for field in sorted(allocated):
+        value = allocated[field]
+        if isinstance(value, dict):
+            value = "%s-%s" % (value["start"], value["end"])
+        info("Assigned %s: %s" % (field, value))
+    output = args.allocate
+    if output == "-":
+        output = sys.stdout
+    write_output(output, yaml.safe_dump(config, default_flow_style=False))
+
+    state["clusters"][system_id] = {
+        "config": args.config,
+        "resources": fleet.cluster_resources(config),
+        "time": int(time.time()),
+    }
+    fleet.save_state(os.path.expanduser(args.fleet_state), state)
+    info("Saved the allocation of %s in %s" % (system_id, args.fleet_state))
+    return 0
+
+
+def check_drift(args, apic_file, no_random):
+    args = argparse.Namespace(**vars(args))
+    args.apic = True
+    args.output = None
+    args.output_dir = None
+    result = {}
+    if not provision(args, apic_file, no_random, result=result, push=False):
+        return 1
+
+    config = result["config"]
+    with tracing.phase("drift"):
+        apic = get_apic(config)
+        report = apic.check_drift(result["apic_config"])
+    report["system_id"] = config["aci_config"]["system_id"]
+    print(json.dumps(report, indent=4, sort_keys=True,
+                     separators=(",", ": ")))
+    if report["drift"]:
+        warn("%d objects differ from the configuration in APIC" %
+             len(report["drift"]))
+        return 1
+    info("No drift in %d objects in APIC" % report["objects"])
+    return 0
+
+
+def export_snapshot(args, no_random):
+    if args.batch:
+        clusters = batch_clusters(args)
+    else:
+        clusters = [{"config": args.config}]
+
+    # Generate the configuration of every cluster, checking the APIC, to
+    # know which objects to export
+    configs = []
+    for cluster in clusters:
+        cargs = argparse.Namespace(**vars(args))
+        cargs.batch = None
+        cargs.config = cluster["config"]
+        cargs.flavor = cluster.get("flavor", args.flavor)
+        cargs.apic = True
+        cargs.output = None
+        cargs.output_dir = None
+        result = {}
+        if not provision(cargs, cluster.get("apic_file"), no_random,
+                         result=result, push=False):
+            return 1
+        configs.append((result["config"], result["apic_config"]))
+
+    apics = set(get_apic(config).addr for config, apic_config in configs)
+    if len(apics) != 1:
+        err("--export-snapshot requires clusters of a single APIC, got: %s"
+            % ", ".join(sorted(apics)))
+        return 1
+
+    with tracing.phase("snapshot"):
+        apic = get_apic(configs[0][0])
+        count = snapshot.export(apic, configs, args.export_snapshot)
+    info("Exported %d objects of %s to %s" %
+         (count, apic.addr, args.export_snapshot))
+    return 0
+
+
+def saved_config(args, header, option, read_input):
+    # The configuration to push a saved file; the APIC, system id and sync
+    # user come from the command line, the input file if read_input and
+    # the header of the file, in that order. Returns None if incomplete.
+    config = {
+        "aci_config": {
+            "apic_login": {},
+        },
+        "provision": {
+            "prov_apic": not args.delete,
+            "debug_apic": args.debug,
+        },
+    }
+    if args.username:
+        config["aci_config"]["apic_login"]["username"] = args.username
+    if args.password:
+        config["aci_config"]["apic_login"]["password"] = args.password
+    if read_input:
+        deep_merge(config, config_user(args.config))
+    deep_merge(config, header)
+
+    # The sync user is named after the system id by default
+    aci_config = config["aci_config"]
+    sync_login = aci_config.setdefault("sync_login", {})
+    if not sync_login.get("username"):
+        sync_login["username"] = aci_config.get("system_id")
+    missing = [k for k, v in [
+        ("apic_hosts", aci_config.get("apic_hosts")),
+        ("apic_login/username", aci_config["apic_login"].get("username")),
+        ("apic_login/password", aci_config["apic_login"].get("password")),
+        ("system_id", aci_config.get("system_id")),
+        ("vrf/tenant", aci_config.get("vrf", {}).get("tenant")),
+    ] if not v]
+    if missing:
+        err("Missing configuration for %s: %s" %
+            (option, ", ".join(missing)))
+        return None
+    return config
+
+
+def replay(args):
+    # Pushes a saved APIC configuration as it is read
+    fp = sys.stdin if args.replay == "-" else open(args.replay, "r")
+    try:
+        header, apic_config = ApicKubeConfig.load_config(fp)
+        read_input = args.config != "-" or (not header and
+                                            args.replay != "-")
+        if not header and not read_input:
+            err("--replay of %s requires an input file" % args.replay)
+            return 1
+        config = saved_config(args, header, "--replay", read_input)
+        if config is None:
+            return 1
+
+        aci_config = config["aci_config"]
+        with tracing.phase("apic-push"):
+            apic = get_apic(config)
+            if args.delete:
+                info("Unprovisioning configuration from \"%s\" in APIC" %
+                     args.replay)
+                apic.unprovision(apic_config, aci_config["system_id"],
+                                 aci_config["vrf"]["tenant"])
+            else:
+                info("Provisioning configuration from \"%s\" in APIC" %
+                     args.replay)
+                apic.provision(apic_config,
+                               aci_config["sync_login"]["username"])
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
+    return 0
+
+
+def save_run(apic, config, apic_config):
+    # Records the state of the objects apic_config is about to change in
+    # the run directory; returns the run id
+    run_dir = os.path.expanduser(config["provision"]["run_dir"])
+    if not os.path.isdir(run_dir):
+        os.makedirs(run_dir, 0o700)
+    system_id = config["aci_config"]["system_id"]
+    run_id = "%s-%s-%s" % (time.strftime("%Y%m%d-%H%M%S"), system_id,
+                           uuid.uuid4().hex[:6])
+    fname = os.path.join(run_dir, run_id + ".jsonl")
+    with tracing.phase("apic-capture"):
+        snapshot.capture(apic, apic_config, fname, apic_file_header(config))
+    return run_id
+
+
+def rollback(args):
+    # Restores the objects changed by a run, given its run id or file
+    fname = args.rollback
+    if not exists(fname):
+        fname = os.path.join(os.path.expanduser(args.run_dir),
+                             args.rollback + ".jsonl")
+    header, apic_config, before = snapshot.load(fname, "rollback")
+    config = saved_config(args, header, "--rollback", args.config != "-")
+    if config is None:
+        return 1
+
+    info("Restoring the APIC objects changed by %s" % args.rollback)
+    with tracing.phase("apic-push"):
+        apic = get_apic(config)
+        snapshot.restore(apic, apic_config, before)
+    return 0
+
+
+def apic_config_delta(old, new):
+    # Returns the (path, config) pairs of new that are not in old, and the
+    # pairs of old whose path is gone from new. A path can be posted more
+    # than once.
+    old_pairs = set(old)
+    new_paths = set(path for path, config in new)
+    changed = [(path, config) for path, config in new
+               if config is not None and (path, config) not in old_pairs]
+    removed = [(path, config) for path, config in old
+               if config is not None and path not in new_paths]
+    return changed, removed
+
+
+def reconcile(args, apic_file, no_random, previous):
+    # Provisions the current input; the first time everything is pushed,
+    # afterwards only the difference with the previous apic config.
+    # Returns the new apic config, or previous if the input is invalid.
+    result = {}
+    if not provision(args, apic_file, no_random, result=result,
+                     push=previous is None):
+        return previous
+    apic_config = result["apic_config"]
+    if previous is not None and args.apic:
+        changed, removed = apic_config_delta(previous, apic_config)
+        if changed or removed:
+            info("Updating %d and removing %d objects in APIC" %
+                 (len(changed), len(removed)))
+            get_apic(result["config"]).update(changed, removed,
+                                              post_limits(result["config"]))
+        else:
+            info("No changes to the APIC configuration")
+    return apic_config
+
+
+def watch(args, apic_file, no_random):
+    if args.config == "-":
+        err("--watch requires an input file")
+        return False
+    if args.delete:
+        err("--watch can't be used with --delete")
+        return False
+
+    args = argparse.Namespace(**vars(args))
+    if not args.version_token:
+        # Keep the version token while the input doesn't change
+        args.hash_version_token = True
+
+    files = watcher.Watcher([args.config])
+    info("Watching %s for changes (%s)" % (args.config, files.backend))
+    previous, changed = None, True
+    try:
+        while True:
+            if changed:
+                try:
+                    previous = reconcile(args, apic_file, no_random,
+                                         previous)
+                except Exception as e:
+                    err("%s: %s" % (e.__class__.__name__, e))
+            changed = files.wait(args.watch_interval)
+            if changed:
+                info("Input changed: %s" % ", ".join(changed))
+    finally:
+        files.close()
 
 
 def main(args=None, apic_file=None, no_random=False):
     # apic_file and no_random are used by the test functions
     if args is None:
         args = parse_args()
+    if apic_file is None:
+        apic_file = args.apicfile
 
     if args.list_flavors:
         info("Available configuration flavors:")
@@ -943,6 +2556,108 @@ def main(args=None, apic_file=None, no_random=False):
         err("Invalid configuration flavor: " + args.flavor)
         return
 
+    if args.fill_key_pool:
+        if not args.key_pool:
+            err("--fill-key-pool requires --key-pool")
+            return 1
+        key_pool_fill(args.key_pool, args.key_type, args.fill_key_pool,
+                      args.jobs)
+        return
+
+    if args.serve:
+        return server.serve(args)
+
+    if args.trace:
+        tracing.enable()
+    try:
+        if args.profile:
+            ret, report = profiling.run(
+                lambda: run(args, apic_file, no_random), args.profile)
+            info("Profile written to %s, report in %s.txt:" %
+                 (args.profile, args.profile))
+            for line in report:
+                info("  " + line)
+            return ret
+        return run(args, apic_file, no_random)
+    finally:
+        tracer = tracing.disable()
+        if args.trace:
+            tracer.save(args.trace)
+            info("Timing summary (trace written to %s):" % args.trace)
+            for line in tracer.summary():
+                info("  " + line)
+
+
+def run(args, apic_file, no_random):
+    if args.snapshot and (args.apic or args.delete or args.watch or
+                          args.export_snapshot or args.replay or
+                          args.rollback):
+        err("--snapshot can't be used with --apic, --delete, --watch, "
+            "--export-snapshot, --replay or --rollback")
+        return 1
+
+    if args.rollback:
+        try:
+            return rollback(args)
+        except Exception as e:
+            err("%s: %s" % (e.__class__.__name__, e))
+            return 1
+
+    if args.replay:
+        try:
+            return replay(args)
+        except Exception as e:
+            err("%s: %s" % (e.__class__.__name__, e))
+            return 1
+
+    if args.rotate_cert:
+        try:
+            return rotate_cert(args, no_random)
+        except Exception as e:
+            err("%s: %s" % (e.__class__.__name__, e))
+            return 1
+
+    if args.fleet or args.allocate:
+        try:
+            if args.allocate:
+                return fleet_allocate(args)
+            return fleet_check(args)
+        except Exception as e:
+            err("%s: %s" % (e.__class__.__name__, e))
+            return 1
+
+    if args.export_snapshot:
+        try:
+            return export_snapshot(args, no_random)
+        except Exception as e:
+            err("%s: %s" % (e.__class__.__name__, e))
+            return 1
+
+    if args.batch:
+        try:
+            if not provision_batch(args, no_random):
+                return 1
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            err("%s: %s" % (e.__class__.__name__, e))
+            return 1
+        return
+
+    if args.check_drift:
+        try:
+            return check_drift(args, apic_file, no_random)
+        except Exception as e:
+            err("%s: %s" % (e.__class__.__name__, e))
+            return 1
+
+    if args.watch:
+        try:
+            watch(args, apic_file, no_random)
+        except KeyboardInterrupt:
+            pass
+        return
+
     if args.debug:
         provision(args, apic_file, no_random)
     else:
@@ -955,4 +2670,4 @@ def main(args=None, apic_file=None, no_random=False):
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,144 @@
+"""Library interface of acc-provision.
+
+Provisions a cluster from a configuration dict in the calling process and
+returns the generated objects instead of writing files:
+
+    from acc_provision import api
+
+    result = api.render(config, flavor="kubernetes-1.8")
+    for name, data in result.objects:
+        ...
+
+Nothing is printed, the log lines are returned in the result. Errors are
+raised as ConfigError, ApicError or another ProvisionError. An APIC session
+logged in by the caller, or a snapshot, can be passed as apic; otherwise
+the sessions are shared by every call of the process. As on the command
+line, the key and certificate files of sync_login are created if missing.
+Unlike the command line, nothing is cached and no run records are saved
+unless cache_dir or run_dir is given.
+"""
+
+from __future__ import print_function
+
+import copy
+import json
+
+import acc_provision
+import tracing
+from errors import ApicError, ConfigError, ProvisionError  # noqa: F401
+from server import ACTIONS
+
+# Command line defaults, parsed once
+default_args = None
+
+
+class Result(object):
+    """The outcome of a provisioning call.
+
+    config is the generated configuration, apic_config the (path, data)
+    pairs of the APIC objects, data being a dict or None, and output the
+    rendered manifests. messages are the log lines, requests the APIC
+    requests made (method, path, status, elapsed, ...) and phases the time
+    spent in each phase, all in seconds.
+    """
+
+    def __init__(self, result, messages, tracer):
+        trace = tracer.to_dict()
+        self.config = result.get("config")
+        self.apic_config = [
+            (path, json.loads(data) if data else None)
+            for path, data in result.get("apic_config") or []]
+        self.output = result.get("output")
+        self.messages = messages
+        self.requests = trace["requests"]
+        self.phases = trace["phases"]
+        self.elapsed = trace["elapsed"]
+
+    @property
+    def errors(self):
+        # Errors that did not stop the call, such as rejected APIC objects
+        return [m for m in self.messages if m.startswith("ERR:")]
+
+    @property
+    def objects(self):
+        # (filename, text) of each object of the kubernetes manifests
+        return acc_provision.split_kube_objects(self.output or "")
+
+
+def make_args(flavor, options):
+    global default_args
+    if default_args is None:
+        default_args = acc_provision.parse_args([])
+        # The cache entries hold private keys and the run records the
+        # sync user's password, they are only written in the given dirs
+        default_args.no_cache = True
+        default_args.run_dir = ""
+    args = copy.copy(default_args)
+    args.flavor = flavor
+    if options.get("cache_dir"):
+        args.no_cache = False
+    for k, v in options.items():
+        if not hasattr(args, k):
+            raise TypeError("Unknown option %s" % k)
+        setattr(args, k, v)
+    return args
+
+
+def provision(config, action="render", flavor=None, apic=None,
+              no_random=False, **options):
+    """Runs action, one of render, plan, apply or delete, for config, a
+    user configuration dict. options are the command line options, by
+    their argparse name, such as version_token or key_type.
+    """
+    if action not in ACTIONS:
+        raise ValueError("Unknown action %s" % action)
+    if flavor is not None and flavor not in acc_provision.FLAVORS:
+        raise ConfigError("Invalid configuration flavor: %s" % flavor)
+    check_apic, delete, push = ACTIONS[action]
+    args = make_args(flavor, options)
+    args.config = None
+    args.output = None
+    args.output_dir = None
+    args.apic = check_apic
+    args.delete = delete
+
+    result = {}
+    messages = acc_provision.log_context.messages = []
+    acc_provision.log_context.quiet = True
+    acc_provision.apic_context.apic = apic
+    try:
+        with tracing.collect() as tracer:
+            ok = acc_provision.provision(args, None, no_random,
+                                         copy.deepcopy(config), result, push)
+    except ProvisionError as e:
+        e.messages = messages
+        raise
+    except Exception as e:
+        raise ProvisionError("%s: %s" % (e.__class__.__name__, e), messages)
+    finally:
+        acc_provision.log_context.messages = None
+        acc_provision.log_context.quiet = False
+        acc_provision.apic_context.apic = None
+    if not ok:
+        errors = [m for m in messages if m.startswith("ERR:")]
+        msg = "Invalid configuration"
+        if errors:
+            msg = errors[0].split(":", 1)[1].strip()
+        raise ConfigError(msg, messages)
+    return Result(result, messages, tracer)
+
+
+def render(config, **kwargs):
+    return provision(config, "render", **kwargs)
+
+
+def plan(config, **kwargs):
+    return provision(config, "plan", **kwargs)
+
+
+def apply(config, **kwargs):
+    return provision(config, "apply", **kwargs)
+
+
+def delete(config, **kwargs):
+    return provision(config, "delete", **kwargs)
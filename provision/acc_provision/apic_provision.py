@@ -1,26 +1,34 @@
 from __future__ import print_function
 
+import base64
+import hashlib
 import json
-import sys
+import time
+from multiprocessing.pool import ThreadPool
 
+import logs
 import requests
+import tracing
 import urllib3
+from errors import ApicError
+from logs import log
+from OpenSSL import crypto
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 apic_debug = False
 
 
 def err(msg):
-    print("ERR:  " + msg, file=sys.stderr)
+    log("ERR:  " + msg)
 
 
 def warn(msg):
-    print("WARN: " + msg, file=sys.stderr)
+    log("WARN: " + msg)
 
 
 def dbg(msg):
     if apic_debug:
-        print("DBG:  " + msg, file=sys.stderr)
+        log("DBG:  " + msg)
 
 
 def yesno(flag):
@@ -29,6 +37,303 @@ def yesno(flag):
     return "no"
 
 
+# Relative names of the managed objects used by the provisioning
+RN_FORMATS = {
+    "polUni": "uni",
+    "infraInfra": "infra",
+    "aaaUserEp": "userext",
+    "fvTenant": "tn-{name}",
+    "fvAp": "ap-{name}",
+    "fvAEPg": "epg-{name}",
+    "fvBD": "BD-{name}",
+    "fvCtx": "ctx-{name}",
+    "fvSubnet": "subnet-[{ip}]",
+    "fvRsBd": "rsbd",
+    "fvRsCtx": "rsctx",
+    "fvRsCons": "rscons-{tnVzBrCPName}",
+    "fvRsProv": "rsprov-{tnVzBrCPName}",
+    "fvRsDomAtt": "rsdomAtt-[{tDn}]",
+    "fvRsBDToOut": "rsBDToOut-{tnL3extOutName}",
+    "vzFilter": "flt-{name}",
+    "vzEntry": "e-{name}",
+    "vzBrCP": "brc-{name}",
+    "vzSubj": "subj-{name}",
+    "vzRsSubjFiltAtt": "rssubjFiltAtt-{tnVzFilterName}",
+    "vzInTerm": "intmnl",
+    "vzOutTerm": "outtmnl",
+    "vzRsFiltAtt": "rsfiltAtt-{tnVzFilterName}",
+    "fvnsVlanInstP": "vlanns-[{name}]-{allocMode}",
+    "fvnsEncapBlk": "from-[{from}]-to-[{to}]",
+    "fvnsMcastAddrInstP": "maddrns-{name}",
+    "fvnsMcastAddrBlk": "fromaddr-[{from}]-toaddr-[{to}]",
+    "physDomP": "phys-{name}",
+    "infraRsVlanNs": "rsvlanNs",
+    "vmmProvP": "vmmp-{vendor}",
+    "vmmDomP": "dom-{name}",
+    "vmmCtrlrP": "ctrlr-{name}",
+    "vmmRsDomMcastAddrNs": "rsdomMcastAddrNs",
+    "vmmUsrCustomAggr": "usrcustomaggr-{name}",
+    "infraAttEntityP": "attentp-{name}",
+    "infraRsDomP": "rsdomP-[{tDn}]",
+    "infraProvAcc": "provacc",
+    "infraRsFuncToEpg": "rsfuncToEpg-[{tDn}]",
+    "infraGeneric": "gen-{name}",
+    "infraSetPol": "setpol",
+    "dhcpInfraProvP": "infraprovp",
+    "l3extOut": "out-{name}",
+    "l3extInstP": "instP-{name}",
+    "aaaUser": "user-{name}",
+    "aaaUserDomain": "userdomain-{name}",
+    "aaaUserRole": "role-{name}",
+    "aaaUserCert": "usercert-{name}",
+    "tagInst": "tag-{name}",
+}
+
+
+def dn_split(dn):
+    # Split a DN into its RNs; "/" inside of [] is part of the RN
+    rns, depth, start = [], 0, 0
+    for i, c in enumerate(dn):
+        if c == "[":
+            depth += 1
+        elif c == "]":
+            depth -= 1
+        elif c == "/" and depth == 0:
+            rns.append(dn[start:i])
+            start = i + 1
+    rns.append(dn[start:])
+    return rns
+
+
+def mo_rn(klass, attributes):
+    if "dn" in attributes:
+        return dn_split(attributes["dn"])[-1]
+    if klass not in RN_FORMATS:
+        raise Exception("Unknown class %s" % klass)
+    return RN_FORMATS[klass].format(**attributes)
+
+
+def path_dn(path):
+    # "/api/node/mo/uni/tn-x.json?query" -> "uni/tn-x"
+    path = path.split("?")[0]
+    for prefix in ["/api/node/mo/", "/api/mo/"]:
+        if path.startswith(prefix):
+            path = path[len(prefix):]
+    if path.endswith(".json"):
+        path = path[:-len(".json")]
+    return path
+
+
+LOGIN_PATH = '/api/aaaLogin.json'
+APIC_CONFIG_VERSION = 1
+# Objects read at a time by the paged queries
+PAGE_SIZE = 1000
+INFRAVLAN_PATH = '/api/node/mo/uni/infra/attentp-default/provacc' + \
+    '/rsfuncToEpg-[uni/tn-infra/ap-access/epg-default].json'
+
+# Largest POST sent at once, in bytes and objects; larger trees are split
+# and the chunks of the same depth are posted by POST_JOBS threads
+POST_MAX_BYTES = 512 * 1024
+POST_MAX_OBJECTS = 2000
+POST_JOBS = 4
+
+# Objects shared with other clusters, never deleted
+SHARED_PATHS = [
+    "/api/mo/uni/infra.json",
+    "/api/mo/uni/tn-common.json",
+]
+
+
+# Containers shared with other clusters, drift is checked on the children
+# we post into them
+SHARED_DNS = ["uni", "uni/infra", "uni/tn-common"]
+# Attributes that are not returned as posted
+DRIFT_IGNORED = ["dn", "rn", "status", "pwd"]
+
+
+def mo_tree(mos, dn, klass, body):
+    # Adds the object posted at dn and its children to mos, a dict of
+    # dn: (class, attributes, [child dn, ...])
+    attributes = dict((k, v) for k, v in body.get("attributes", {}).items()
+                      if k not in DRIFT_IGNORED)
+    if dn in mos:
+        mos[dn][1].update(attributes)
+    else:
+        mos[dn] = (klass, attributes, [])
+    for child in body.get("children", []):
+        cklass, cbody = list(child.items())[0]
+        cdn = cbody.get("attributes", {}).get("dn") or \
+            dn + "/" + (cbody.get("attributes", {}).get("rn") or
+                        mo_rn(cklass, cbody.get("attributes", {})))
+        if cdn not in mos[dn][2]:
+            mos[dn][2].append(cdn)
+        mo_tree(mos, cdn, cklass, cbody)
+
+
+def post_dn(path, klass, attributes):
+    # DN of the object posted to path, the path's object or a child of it
+    dn = path_dn(path)
+    if "dn" in attributes:
+        return attributes["dn"]
+    if dn_split(dn)[-1] != mo_rn(klass, attributes):
+        return dn + "/" + mo_rn(klass, attributes)
+    return dn
+
+
+def mo_count(data):
+    body = list(data.values())[0]
+    return 1 + sum(mo_count(c) for c in body.get("children", []))
+
+
+def has_rn(data):
+    # Whether the RN of the object is known, to post it to its parent
+    klass, body = list(data.items())[0]
+    try:
+        mo_rn(klass, body["attributes"])
+    except Exception:
+        return False
+    return True
+
+
+def split_post(path, config, max_bytes=POST_MAX_BYTES,
+               max_objects=POST_MAX_OBJECTS):
+    # Splits the POST of config to path into (depth, path, config) chunks
+    # of at most max_bytes and max_objects, except for single objects.
+    # The parent of the objects of a chunk is in a chunk of lower depth.
+    if (len(config) <= max_bytes and
+            config.count('"attributes"') <= max_objects):
+        return [(0, path, config)]
+    ret = []
+
+    def split(path, data, depth):
+        size = len(json.dumps(data))
+        if size <= max_bytes and mo_count(data) <= max_objects:
+            ret.append((depth, path, json.dumps(data)))
+            return
+        klass, body = list(data.items())[0]
+        parent = {"attributes": body["attributes"]}
+        size = len(json.dumps({klass: parent})) + len(', "children": []')
+        count = 1
+        kept, rest = [], []
+        for child in body.get("children", []):
+            child_size = len(json.dumps(child)) + len(", ")
+            child_count = mo_count(child)
+            if (size + child_size <= max_bytes and
+                    count + child_count <= max_objects or
+                    not has_rn(child)):
+                kept.append(child)
+                size += child_size
+                count += child_count
+            else:
+                rest.append(child)
+        if kept:
+            parent["children"] = kept
+        ret.append((depth, path, json.dumps({klass: parent})))
+        child_path = "/api/mo/%s.json" % post_dn(path, klass,
+                                                 body["attributes"])
+        for child in rest:
+            split(child_path, child, depth + 1)
+
+    split(path, json.loads(config), 0)
+    # In the order they are posted
+    ret.sort(key=lambda c: c[0])
+    return ret
+
+
+def merge_ranges(ranges):
+    # The fewest sorted (first, last) ranges covering ranges, merging the
+    # overlapping and adjacent ones
+    ret = []
+    for lo, hi in sorted(ranges):
+        if ret and lo <= ret[-1][1] + 1:
+            ret[-1] = (ret[-1][0], max(ret[-1][1], hi))
+        else:
+            ret.append((lo, hi))
+    return ret
+
+
+def subtract_ranges(ranges, used):
+    # The merged parts of ranges not in used
+    ret = []
+    used = merge_ranges(used)
+    for lo, hi in merge_ranges(ranges):
+        for ulo, uhi in used:
+            if uhi < lo or ulo > hi:
+                continue
+            if ulo > lo:
+                ret.append((lo, ulo - 1))
+            lo = uhi + 1
+        if lo <= hi:
+            ret.append((lo, hi))
+    return ret
+
+
+def encap_range(attributes):
+    # (first, last) VLAN of an fvnsEncapBlk
+    return (int(attributes["from"].split("-")[-1]),
+            int(attributes["to"].split("-")[-1]))
+
+
+def encap_blocks(ranges, **attributes):
+    # One fvnsEncapBlk per merged VLAN range
+    return [aci_obj("fvnsEncapBlk", **dict(
+        attributes, **{"from": "vlan-%d" % lo, "to": "vlan-%d" % hi}))
+        for lo, hi in merge_ranges(ranges)]
+
+
+def desired_mos(apic_config):
+    # Returns the objects posted by apic_config, the DNs of the subtrees
+    # to check and the (dn, path) of each post
+    mos, roots, posts = {}, [], []
+    for path, config in apic_config:
+        if config is None:
+            continue
+        klass, body = list(json.loads(config).items())[0]
+        dn = post_dn(path, klass, body.get("attributes", {}))
+        mo_tree(mos, dn, klass, body)
+        posts.append((dn, path))
+        if dn not in roots:
+            roots.append(dn)
+
+    # Check the children of shared containers, and only the topmost of
+    # nested roots
+    while any(dn in SHARED_DNS for dn in roots):
+        expanded = []
+        for dn in roots:
+            expanded.extend(mos[dn][2] if dn in SHARED_DNS else [dn])
+        roots = expanded
+    roots = [dn for dn in roots
+             if not any(dn.startswith(r + "/") for r in roots)]
+    return mos, sorted(set(roots), key=roots.index), posts
+
+
+def tree_digest(desired, mos, dn, cache):
+    # Hash of the subtree at dn of mos, restricted to the classes,
+    # attributes and children of the desired subtree
+    if dn in cache:
+        return cache[dn]
+    klass, attributes, children = desired[dn]
+    h = hashlib.sha1()
+    mo = mos.get(dn)
+    if mo is None:
+        h.update(b"missing")
+    else:
+        h.update(mo[0].encode("utf-8"))
+        for k in sorted(attributes):
+            h.update(("\0%s=%s" % (k, drift_value(mo[1].get(k)))).encode(
+                "utf-8"))
+    for child in children:
+        h.update(tree_digest(desired, mos, child, cache).encode("utf-8"))
+    cache[dn] = h.hexdigest()
+    return cache[dn]
+
+
+def drift_value(v):
+    if v is None:
+        return None
+    return str(v).strip()
+
+
 def aci_obj(klass, **kwargs):
     children = kwargs.pop('_children', None)
     data = {klass: {'attributes': kwargs}}
@@ -56,23 +361,40 @@ class Apic(object):
             return 'https://%s%s' % (self.addr, path)
         return 'http://%s%s' % (self.addr, path)
 
+    def request(self, method, path, data=None, **kwargs):
+        start = time.time()
+        retries = 0
+        while True:
+            resp = requests.request(method, self.url(path), data=data,
+                                    **kwargs)
+            if (resp.status_code != 403 or retries or
+                    path == LOGIN_PATH or self.cookies is None):
+                break
+            # The session expired, log in again and retry once
+            dbg("%s: session expired, logging in again" % path)
+            self.login()
+            kwargs["cookies"] = self.cookies
+            retries += 1
+        tracing.request(method, path, resp.status_code, time.time() - start,
+                        len(data or ""), len(resp.content), retries)
+        return resp
+
     def get(self, path, data=None):
         args = dict(data=data, cookies=self.cookies, verify=self.verify)
-        return requests.get(self.url(path), **args)
+        return self.request("GET", path, **args)
 
     def post(self, path, data):
         args = dict(data=data, cookies=self.cookies, verify=self.verify)
-        return requests.post(self.url(path), **args)
+        return self.request("POST", path, **args)
 
     def delete(self, path, data=None):
         args = dict(data=data, cookies=self.cookies, verify=self.verify)
-        return requests.delete(self.url(path), **args)
+        return self.request("DELETE", path, **args)
 
     def login(self):
         data = '{"aaaUser":{"attributes":{"name": "%s", "pwd": "%s"}}}' % \
             (self.username, self.password)
-        path = '/api/aaaLogin.json'
-        req = requests.post(self.url(path), data=data, verify=False)
+        req = self.request("POST", LOGIN_PATH, data=data, verify=False)
         if req.status_code == 200:
             resp = json.loads(req.text)
             token = resp["imdata"][0]["aaaLogin"]["attributes"]["token"]
@@ -84,7 +406,7 @@ class Apic(object):
         if len(respj["imdata"]) > 0:
             ret = respj["imdata"][0]
             if "error" in ret:
-                raise Exception("APIC REST Error: %s" % ret["error"])
+                raise ApicError("APIC REST Error: %s" % ret["error"])
         return resp
 
     def get_path(self, path, multi=False):
@@ -102,11 +424,27 @@ class Apic(object):
             err("Error in getting %s: %s: " % (path, str(e)))
         return ret
 
+    def check_cert(self, username, cert_name, key_data):
+        # Whether the APIC accepts a GET signed with key_data for the
+        # certificate cert_name of username, as the controller signs them
+        path = "/api/node/mo/uni/userext/user-%s.json" % username
+        key = crypto.load_privatekey(crypto.FILETYPE_PEM, key_data)
+        cookies = {
+            "APIC-Request-Signature": base64.b64encode(
+                crypto.sign(key, ("GET" + path).encode("utf-8"), "sha256")),
+            "APIC-Certificate-Algorithm": "v1.0",
+            "APIC-Certificate-DN": "uni/userext/user-%s/usercert-%s" %
+            (username, cert_name),
+            "APIC-Certificate-Fingerprint": "fingerprint",
+        }
+        # Not retried with the session of the APIC login on a 403
+        resp = requests.request("GET", self.url(path), cookies=cookies,
+                                verify=self.verify)
+        return resp.status_code == 200
+
     def get_infravlan(self):
         infra_vlan = None
-        path = '/api/node/mo/uni/infra/attentp-default/provacc' + \
-               '/rsfuncToEpg-[uni/tn-infra/ap-access/epg-default].json'
-        data = self.get_path(path)
+        data = self.get_path(INFRAVLAN_PATH)
         if data:
             encap = data["infraRsFuncToEpg"]["attributes"]["encap"]
             infra_vlan = int(encap.split("-")[1])
@@ -128,7 +466,62 @@ class Apic(object):
         path = "/api/node/mo/uni/userext/user-%s.json" % name
         return self.get_path(path)
 
-    def provision(self, data, sync_login):
+    def post_chunks(self, path, config, limits=None):
+        # Posts config to path in the chunks of split_post, limits being
+        # (max_bytes, max_objects, jobs); the chunks of a depth are posted
+        # concurrently once their parents are. Returns the (path, error)
+        # of each chunk, error being None if it was provisioned.
+        max_bytes, max_objects, jobs = limits or (
+            POST_MAX_BYTES, POST_MAX_OBJECTS, POST_JOBS)
+        chunks = split_post(path, config, max_bytes, max_objects)
+        if len(chunks) == 1:
+            resp = self.post(path, config)
+            self.check_resp(resp)
+            dbg("%s: %s" % (path, resp.text))
+            return [(path, None)]
+
+        dbg("%s: posting %d chunks" % (path, len(chunks)))
+        failed = []
+        label = getattr(tracing.context, "label", None)
+        tracer = getattr(tracing.context, "tracer", None)
+        log_state = logs.get_context()
+
+        def post(chunk):
+            depth, path, config = chunk
+            tracing.context.label, tracing.context.tracer = label, tracer
+            logs.set_context(log_state)
+            dn = path_dn(path)
+            if any(dn == f or dn.startswith(f + "/") for f in failed):
+                return "Parent not provisioned"
+            try:
+                resp = self.post(path, config)
+                self.check_resp(resp)
+                dbg("%s: %s" % (path, resp.text))
+            except Exception as e:
+                return str(e)
+            return None
+
+        ret = []
+        pool = ThreadPool(max(jobs, 1))
+        try:
+            for depth in sorted(set(c[0] for c in chunks)):
+                level = [c for c in chunks if c[0] == depth]
+                for (_, path, config), error in zip(level,
+                                                    pool.map(post, level)):
+                    ret.append((path, error))
+                    if error is None:
+                        continue
+                    klass, body = list(json.loads(config).items())[0]
+                    failed.append(post_dn(path, klass, body["attributes"]))
+                    err("Error in provisioning %s (chunk %d of %d): %s" %
+                        (failed[-1], len(ret), len(chunks), error))
+        finally:
+            pool.close()
+        return ret
+
+    def provision(self, data, sync_login, shared=None, limits=None):
+        # shared: set of (path, config) already posted to this APIC by
+        # other clusters of the same run, identical posts are skipped
         ignore_list = []
         if self.get_user(sync_login):
             warn("User already exists (%s), recreating user" % sync_login)
@@ -136,27 +529,197 @@ class Apic(object):
             resp = self.delete(user_path)
             dbg("%s: %s" % (user_path, resp.text))
 
+        data = self.new_encap_blocks(data)
         for path, config in data:
             try:
                 if path in ignore_list:
                     continue
+                if shared is not None and (path, config) in shared:
+                    dbg("%s: already provisioned" % path)
+                    continue
                 if config is not None:
-                    resp = self.post(path, config)
-                    self.check_resp(resp)
-                    dbg("%s: %s" % (path, resp.text))
+                    outcomes = self.post_chunks(path, config, limits)
+                    if shared is not None and all(
+                            e is None for p, e in outcomes):
+                        shared.add((path, config))
             except Exception as e:
                 # log it, otherwise ignore it
                 err("Error in provisioning %s: %s" % (path, str(e)))
 
+    def update(self, data, removed, limits=None):
+        # Posts the (path, config) pairs of data and deletes the objects
+        # posted by the removed ones
+        data = self.new_encap_blocks(data)
+        for path, config in data:
+            try:
+                self.post_chunks(path, config, limits)
+            except Exception as e:
+                # log it, otherwise ignore it
+                err("Error in provisioning %s: %s" % (path, str(e)))
+
+        for path, config in removed:
+            try:
+                if path in SHARED_PATHS or config is None:
+                    continue
+                # The posted object can be a child of the path's object
+                klass, body = list(json.loads(config).items())[0]
+                dn = post_dn(path, klass, body["attributes"])
+                mo_path = "/api/node/mo/%s.json" % dn
+                resp = self.delete(mo_path)
+                self.check_resp(resp)
+                dbg("%s: %s" % (mo_path, resp.text))
+            except Exception as e:
+                # log it, otherwise ignore it
+                err("Error in un-provisioning %s: %s" % (path, str(e)))
+
+    def new_encap_blocks(self, data):
+        # Yields the (path, config) of data without the VLANs of its
+        # fvnsEncapBlk objects already in their pool, which the APIC
+        # rejects as overlapping blocks. The blocks of the fabric are read
+        # with a single query, when the first one is needed.
+        existing = None
+        for path, config in data:
+            if config and '"fvnsEncapBlk"' in config:
+                if existing is None:
+                    existing = self.encap_pools()
+                config = self.prune_encap_blocks(path, config, existing)
+            yield path, config
+
+    def encap_pools(self):
+        # The (first, last) VLAN ranges of the fvnsEncapBlk objects of the
+        # fabric by parent DN
+        existing = {}
+        try:
+            for mo in self.get_all("/api/node/class/fvnsEncapBlk.json",
+                                   PAGE_SIZE):
+                attributes = mo["fvnsEncapBlk"]["attributes"]
+                pool = "/".join(dn_split(attributes["dn"])[:-1])
+                existing.setdefault(pool, []).append(encap_range(attributes))
+        except Exception as e:
+            warn("Error in getting the VLAN blocks: %s" % str(e))
+        return existing
+
+    def prune_encap_blocks(self, path, config, existing):
+        klass, body = list(json.loads(config).items())[0]
+        pool = post_dn(path, klass, body.get("attributes", {}))
+        used = existing.get(pool, [])
+        children, changed = [], False
+        for child in body.get("children", []):
+            if "fvnsEncapBlk" not in child:
+                children.append(child)
+                continue
+            attributes = dict(child["fvnsEncapBlk"]["attributes"])
+            vlans = encap_range(attributes)
+            for other, ranges in sorted(existing.items()):
+                if (other != pool and other.startswith("uni/infra/vlanns-") and
+                        subtract_ranges([vlans], ranges) != [vlans]):
+                    warn("VLANs %d-%d of %s are also in %s" %
+                         (vlans + (pool, other)))
+            new = subtract_ranges([vlans], used)
+            if new == [vlans]:
+                children.append(child)
+                continue
+            dbg("%s: VLANs %d-%d already in the pool" % ((pool,) + vlans))
+            del attributes["from"], attributes["to"]
+            children.extend(encap_blocks(new, **attributes))
+            changed = True
+        if not changed:
+            return config
+        body["children"] = children
+        return json.dumps({klass: body}, sort_keys=True, indent=4)
+
+    def get_all(self, path, page_size):
+        # Returns the objects of a query, reading page_size at a time
+        ret, page = [], 0
+        sep = "&" if "?" in path else "?"
+        while True:
+            resp = self.check_resp(self.get(
+                "%s%spage=%d&page-size=%d" % (path, sep, page, page_size)))
+            respj = json.loads(resp.text)
+            ret.extend(respj["imdata"])
+            page += 1
+            if (not respj["imdata"] or
+                    len(ret) >= int(respj.get("totalCount", 0))):
+                return ret
+
+    def get_subtree(self, dn, mos):
+        # Adds the objects of the subtree at dn to mos, a dict of
+        # dn: (class, attributes, [child dn, ...])
+        path = "/api/node/mo/%s.json?rsp-subtree=full" % dn
+        resp = self.check_resp(self.get(path))
+
+        def add(parent, data):
+            klass, body = list(data.items())[0]
+            attributes = body.get("attributes", {})
+            mo_dn = attributes.get("dn") or \
+                parent + "/" + (attributes.get("rn") or
+                                mo_rn(klass, attributes))
+            mos[mo_dn] = (klass, attributes, [])
+            for child in body.get("children", []):
+                mos[mo_dn][2].append(add(mo_dn, child))
+            return mo_dn
+
+        for data in json.loads(resp.text)["imdata"]:
+            add("", data)
+
+    def check_drift(self, apic_config):
+        # Compares the objects of apic_config with the APIC, fetching one
+        # subtree per root and comparing digests before the attributes
+        desired, roots, posts = desired_mos(apic_config)
+        actual = {}
+        for dn in roots:
+            self.get_subtree(dn, actual)
+
+        drift = []
+        desired_cache, actual_cache = {}, {}
+
+        def compare(dn):
+            if (tree_digest(desired, desired, dn, desired_cache) ==
+                    tree_digest(desired, actual, dn, actual_cache)):
+                return
+            klass, attributes, children = desired[dn]
+            mo = actual.get(dn)
+            if mo is None:
+                drift.append({"dn": dn, "class": klass, "change": "missing"})
+                return
+            if mo[0] != klass:
+                drift.append({"dn": dn, "class": klass, "change": "class",
+                              "actual": mo[0]})
+                return
+            changed = dict(
+                (k, {"desired": v, "actual": mo[1].get(k)})
+                for k, v in attributes.items()
+                if drift_value(v) != drift_value(mo[1].get(k)))
+            if changed:
+                drift.append({"dn": dn, "class": klass, "change": "modified",
+                              "attributes": changed})
+            for child in children:
+                compare(child)
+
+        for dn in roots:
+            compare(dn)
+
+        # The posts that would restore the drifted objects
+        plan = []
+        for dn, path in posts:
+            if path not in plan and any(
+                    d["dn"] == dn or d["dn"].startswith(dn + "/")
+                    for d in drift):
+                plan.append(path)
+        return {
+            "apic": self.addr,
+            "objects": len(desired),
+            "subtrees": len(roots),
+            "drift": drift,
+            "plan": plan,
+        }
+
     def unprovision(self, data, system_id, tenant):
         for path, config in data:
             try:
                 if path.split("/")[-1].startswith("instP-"):
                     continue
-                if path not in [
-                        "/api/mo/uni/infra.json",
-                        "/api/mo/uni/tn-common.json",
-                ]:
+                if path not in SHARED_PATHS:
                     resp = self.delete(path)
                     self.check_resp(resp)
                     dbg("%s: %s" % (path, resp.text))
@@ -229,11 +792,63 @@ class ApicKubeConfig(object):
         return t
 
     @staticmethod
-    def save_config(config, outfilep):
+    def save_config(config, outfilep, header=None):
+        # Alternating path and JSON lines, or JSON lines after a header
+        # line if a header is given
+        if header is not None:
+            header = dict(header, apic_config=APIC_CONFIG_VERSION)
+            print(json.dumps(header, sort_keys=True), file=outfilep)
+            for path, data in config:
+                if data is not None:
+                    data = json.loads(data)
+                print(json.dumps({"path": path, "data": data},
+                                 sort_keys=True, separators=(",", ":")),
+                      file=outfilep)
+            return
         for path, data in config:
             print(path, file=outfilep)
             print(data, file=outfilep)
 
+    @staticmethod
+    def load_config(infilep):
+        # Returns the header, empty for the alternating format, and an
+        # iterator of the (path, data) of a file written by save_config.
+        # The file is read as the iterator is consumed.
+        first = infilep.readline()
+        if first.startswith("{"):
+            header = json.loads(first)
+            if header.get("apic_config") != APIC_CONFIG_VERSION:
+                raise Exception("Unsupported APIC configuration file")
+            return header, ApicKubeConfig.read_lines(infilep)
+        return {}, ApicKubeConfig.read_pairs(first, infilep)
+
+    @staticmethod
+    def read_lines(infilep):
+        for line in infilep:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            data = entry["data"]
+            if data is not None:
+                data = json.dumps(data, sort_keys=True, indent=4)
+            yield entry["path"], data
+
+    @staticmethod
+    def read_pairs(first, infilep):
+        def pair(path, lines):
+            data = "".join(lines).rstrip("\n")
+            return path, None if data == "None" else data
+
+        path, lines = first.rstrip("\n"), []
+        for line in infilep:
+            if line.startswith("/api/"):
+                yield pair(path, lines)
+                path, lines = line.rstrip("\n"), []
+            else:
+                lines.append(line)
+        if path:
+            yield pair(path, lines)
+
     def get_config(self):
         def update(data, x):
             if x:
@@ -265,6 +880,11 @@ class ApicKubeConfig(object):
         pool_name = self.config["aci_config"]["physical_domain"]["vlan_pool"]
         service_vlan = self.config["net_config"]["service_vlan"]
 
+        vlans = [(int(service_vlan), int(service_vlan))]
+        if self.use_kubeapi_vlan:
+            kubeapi_vlan = self.config["net_config"]["kubeapi_vlan"]
+            vlans.append((int(kubeapi_vlan), int(kubeapi_vlan)))
+
         path = "/api/mo/uni/infra/vlanns-[%s]-static.json" % pool_name
         data = {
             "fvnsVlanInstP": {
@@ -272,32 +892,9 @@ class ApicKubeConfig(object):
                     "name": pool_name,
                     "allocMode": "static"
                 },
-                "children": [
-                    {
-                        "fvnsEncapBlk": {
-                            "attributes": {
-                                "allocMode": "static",
-                                "from": "vlan-%s" % service_vlan,
-                                "to": "vlan-%s" % service_vlan
-                            }
-                        },
-                    },
-                ]
+                "children": encap_blocks(vlans, allocMode="static"),
             }
         }
-        if self.use_kubeapi_vlan:
-            kubeapi_vlan = self.config["net_config"]["kubeapi_vlan"]
-            data["fvnsVlanInstP"]["children"].insert(
-                0,
-                {
-                    "fvnsEncapBlk": {
-                        "attributes": {
-                            "allocMode": "static",
-                            "from": "vlan-%s" % kubeapi_vlan,
-                            "to": "vlan-%s" % kubeapi_vlan
-                        }
-                    }
-                })
         return path, data
 
     def vdom_pool(self):
@@ -315,17 +912,9 @@ class ApicKubeConfig(object):
                     "name": vpool_name,
                     "allocMode": "dynamic"
                 },
-                "children": [
-                    {
-                        "fvnsEncapBlk": {
-                            "attributes": {
-                                "allocMode": "dynamic",
-                                "from": "vlan-%s" % vlan_range["start"],
-                                "to": "vlan-%s" % vlan_range["end"],
-                            }
-                        }
-                    },
-                ]
+                "children": encap_blocks(
+                    [(int(vlan_range["start"]), int(vlan_range["end"]))],
+                    allocMode="dynamic"),
             }
         }
         return path, data
@@ -453,6 +1042,14 @@ class ApicKubeConfig(object):
         infra_vlan = self.config["net_config"]["infra_vlan"]
         service_vlan = self.config["net_config"]["service_vlan"]
 
+        vlans = [(infra_vlan, infra_vlan), (service_vlan, service_vlan)]
+        if self.use_kubeapi_vlan:
+            kubeapi_vlan = self.config["net_config"]["kubeapi_vlan"]
+            vlans.append((kubeapi_vlan, kubeapi_vlan))
+        if encap_type == "vlan":
+            vlan_range = self.config["aci_config"]["vmm_domain"]["vlan_range"]
+            vlans.append((vlan_range["start"], vlan_range["end"]))
+
         path = ("/api/mo/uni/vmmp-%s/dom-%s/usrcustomaggr-%s.json" %
                 (nvmm_type, nvmm_name, system_id))
         data = {
@@ -461,47 +1058,9 @@ class ApicKubeConfig(object):
                     "name": system_id,
                     "promMode": "Enabled",
                 },
-                "children": [
-                    {
-                        "fvnsEncapBlk": {
-                            "attributes": {
-                                "from": "vlan-%d" % infra_vlan,
-                                "to": "vlan-%d" % infra_vlan,
-                            }
-                        }
-                    },
-                    {
-                        "fvnsEncapBlk": {
-                            "attributes": {
-                                "from": "vlan-%d" % service_vlan,
-                                "to": "vlan-%d" % service_vlan,
-                            }
-                        }
-                    },
-                ]
+                "children": encap_blocks(vlans),
             }
         }
-        if self.use_kubeapi_vlan:
-            kubeapi_vlan = self.config["net_config"]["kubeapi_vlan"]
-            data["vmmUsrCustomAggr"]["children"].append(
-                {
-                    "fvnsEncapBlk": {
-                        "attributes": {
-                            "from": "vlan-%d" % kubeapi_vlan,
-                            "to": "vlan-%d" % kubeapi_vlan,
-                        }
-                    }
-                })
-        if encap_type == "vlan":
-            vlan_range = self.config["aci_config"]["vmm_domain"]["vlan_range"]
-            data["vmmUsrCustomAggr"]["children"].append({
-                "fvnsEncapBlk": {
-                    "attributes": {
-                        "from": "vlan-%d" % vlan_range["start"],
-                        "to": "vlan-%d" % vlan_range["end"],
-                    }
-                },
-            })
         return path, data
 
     def associate_aep(self):
@@ -740,15 +1299,18 @@ class ApicKubeConfig(object):
         return path, data
 
     def kube_cert(self):
-        name = self.config["aci_config"]["sync_login"]["username"]
-        certfile = self.config["aci_config"]["sync_login"]["certfile"]
+        sync_login = self.config["aci_config"]["sync_login"]
+        name = sync_login["username"]
+        certfile = sync_login["certfile"]
 
         if certfile is None:
             return None
 
-        cert = None
-        with open(certfile, "r") as cfile:
-            cert = cfile.read()
+        # The certificate of a run that only reads the APIC isn't saved
+        cert = sync_login.get("cert_data")
+        if cert is None:
+            with open(certfile, "r") as cfile:
+                cert = cfile.read()
         path = "/api/node/mo/uni/userext/user-%s.json" % name
         data = {
             "aaaUser": {
@@ -778,7 +1340,9 @@ class ApicKubeConfig(object):
         kube_vrf = self.config["aci_config"]["vrf"]["name"]
         kube_l3out = self.config["aci_config"]["l3out"]["name"]
         node_subnet = self.config["net_config"]["node_subnet"]
-        pod_subnet = self.config["net_config"]["pod_subnet"]
+        pod_subnets = self.config["net_config"]["pod_subnet"]
+        if not isinstance(pod_subnets, list):
+            pod_subnets = [pod_subnets]
         kade = self.config["kube_config"].get("allow_kube_api_default_epg")
         vmm_type = self.config["aci_config"]["vmm_domain"]["type"]
 
@@ -1029,7 +1593,9 @@ class ApicKubeConfig(object):
                                             "ip": pod_subnet
                                         }
                                     }
-                                },
+                                }
+                                for pod_subnet in pod_subnets
+                            ] + [
                                 {
                                     "fvRsCtx": {
                                         "attributes": {
@@ -1358,7 +1924,9 @@ class ApicKubeConfig(object):
         cf_vrf = self.config["aci_config"]["vrf"]["name"]
         cf_l3out = self.config["aci_config"]["l3out"]["name"]
         node_subnet = self.config["net_config"]["node_subnet"]
-        pod_subnet = self.config["net_config"]["pod_subnet"]
+        pod_subnets = self.config["net_config"]["pod_subnet"]
+        if not isinstance(pod_subnets, list):
+            pod_subnets = [pod_subnets]
         vmm_type = self.config["aci_config"]["vmm_domain"]["type"]
         nvmm_name = (
             self.config["aci_config"]["vmm_domain"]["nested_inside"]["name"])
@@ -1385,7 +1953,7 @@ class ApicKubeConfig(object):
                      _children=[node_epg, app_default_epg])
 
         app_bd = self.bd('cf-app-bd', cf_vrf,
-                         subnets=[pod_subnet],
+                         subnets=pod_subnets,
                          l3outs=[cf_l3out])
 
         node_bd = self.bd('cf-node-bd', cf_vrf,
@@ -0,0 +1,23 @@
+class ProvisionError(Exception):
+    """Base class of the errors raised by the library interface, with the
+    messages logged until the error.
+    """
+
+    def __init__(self, msg, messages=None):
+        super(ProvisionError, self).__init__(msg)
+        self.messages = messages or []
+
+
+class ConfigError(ProvisionError):
+    """The configuration or the flavor is invalid."""
+
+
+class ApicError(ProvisionError):
+    """The APIC rejected a request, with the HTTP status and the APIC error
+    code when known.
+    """
+
+    def __init__(self, msg, messages=None, status=None, code=None):
+        super(ApicError, self).__init__(msg, messages)
+        self.status = status
+        self.code = code
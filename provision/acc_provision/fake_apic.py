@@ -0,0 +1,229 @@
+from __future__ import print_function
+
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import shutil
+import ssl
+import tempfile
+import threading
+import time
+import uuid
+
+from errors import ApicError
+from mit import Mit
+from OpenSSL import crypto
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, unquote, urlparse
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, imdata, total=None):
+        if total is None:
+            total = len(imdata)
+        body = json.dumps({"totalCount": str(total), "imdata": imdata})
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, status, code, text):
+        self.reply(status, [{"error": {"attributes": {
+            "code": code, "text": text}}}])
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        data = self.rfile.read(length) if length else b""
+        return json.loads(data.decode("utf-8")) if data else None
+
+    def authorized(self, method):
+        cookie = self.headers.get("Cookie") or ""
+        tokens = re.findall(r"APIC-Cookie=([^;\s]+)", cookie)
+        if any(t in self.server.apic.tokens for t in tokens):
+            return True
+        # GETs can be signed with the key of a user certificate
+        sig = re.findall(r"APIC-Request-Signature=\"?([^;\s\"]+)", cookie)
+        dn = re.findall(r"APIC-Certificate-DN=\"?([^;\s\"]+)", cookie)
+        mo = self.server.apic.get(dn[0]) if sig and dn else None
+        if method != "GET" or mo is None or mo["class"] != "aaaUserCert":
+            return False
+        cert = crypto.load_certificate(crypto.FILETYPE_PEM,
+                                       mo["attributes"]["data"])
+        try:
+            crypto.verify(cert, base64.b64decode(sig[0]),
+                          (method + self.path).encode("utf-8"), "sha256")
+        except crypto.Error:
+            return False
+        return True
+
+    def handle_request(self, method):
+        apic = self.server.apic
+        url = urlparse(self.path)
+        query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        path = unquote(url.path)
+        apic.record(method, self.path)
+        if apic.latency:
+            time.sleep(apic.latency)
+        if apic.error_rate and apic.random.random() < apic.error_rate:
+            return self.error(500, "500", "Injected error")
+
+        try:
+            if method == "POST" and path == "/api/aaaLogin.json":
+                return self.login()
+            if not self.authorized(method):
+                return self.error(403, "403", "Token was invalid")
+
+            if method == "GET":
+                imdata, total = apic.mit.get(path, query)
+                return self.reply(200, imdata, total)
+            m = re.match(r"^/api/(node/)?mo/(.*)\.json$", path)
+            if not m:
+                return self.error(400, "400", "Invalid request %s" % path)
+            if method == "POST":
+                apic.mit.post(m.group(2), self.read_body())
+            elif method == "DELETE":
+                apic.mit.remove(m.group(2))
+            return self.reply(200, [])
+        except ApicError as e:
+            return self.error(e.status, e.code, str(e))
+        except Exception as e:
+            return self.error(400, "400", "%s: %s" %
+                              (e.__class__.__name__, e))
+
+    def login(self):
+        apic = self.server.apic
+        data = self.read_body()
+        user = data["aaaUser"]["attributes"]
+        if (user.get("name") != apic.username or
+                user.get("pwd") != apic.password):
+            return self.error(401, "401", "Username or password is incorrect")
+        token = uuid.uuid4().hex
+        apic.tokens.add(token)
+        return self.reply(200, [{"aaaLogin": {"attributes": {
+            "token": token, "userName": user["name"]}}}])
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeApic(object):
+    """A local stand-in for the APIC REST API.
+
+    Keeps the objects in an in-memory tree and serves login, mo/class/tag
+    queries, posts and deletes. latency (seconds) is added to every
+    request and error_rate is the fraction of requests failing with an
+    injected HTTP 500.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, username="admin",
+                 password="noir0123", use_ssl=False, latency=0,
+                 error_rate=0, seed=None):
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.mit = Mit()
+        self.tokens = set()
+        self.requests = []
+        self.requests_lock = threading.Lock()
+        self.server = Server((host, port), Handler)
+        self.server.apic = self
+        self.certdir = None
+        if use_ssl:
+            self.wrap_ssl()
+        self.thread = None
+
+    def wrap_ssl(self):
+        from acc_provision import generate_cert
+
+        self.certdir = tempfile.mkdtemp()
+        certfile = os.path.join(self.certdir, "apic.crt")
+        keyfile = os.path.join(self.certdir, "apic.key")
+        generate_cert("fake-apic", certfile, keyfile)
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.load_cert_chain(certfile, keyfile)
+        self.server.socket = context.wrap_socket(
+            self.server.socket, server_side=True)
+
+    @property
+    def addr(self):
+        return "%s:%d" % self.server.server_address[:2]
+
+    def record(self, method, path):
+        with self.requests_lock:
+            self.requests.append((method, path))
+
+    def add(self, dn, klass, **attributes):
+        return self.mit.add(dn, klass, **attributes)
+
+    def get(self, dn):
+        return self.mit.mos.get(dn)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.certdir:
+            shutil.rmtree(self.certdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run a local fake APIC for tests and benchmarks')
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--username', default="admin")
+    parser.add_argument('--password', default="noir0123")
+    parser.add_argument('--no-ssl', action='store_true', default=False)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every request')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of requests failing with HTTP 500')
+    args = parser.parse_args()
+
+    apic = FakeApic(args.host, args.port, args.username, args.password,
+                    use_ssl=not args.no_ssl, latency=args.latency,
+                    error_rate=args.error_rate)
+    print("Fake APIC listening on %s" % apic.addr)
+    try:
+        apic.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        apic.stop()
+
+
+if __name__ == "__main__":
+    main()
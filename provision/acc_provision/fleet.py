@@ -0,0 +1,308 @@
+from __future__ import print_function
+
+import binascii
+import json
+import os
+import socket
+
+FLEET_VERSION = 1
+
+# Pools the resources of new clusters are taken from; 225.0.0.0/15 is
+# the default GIPo pool of the fabric
+DEFAULT_POOLS = {
+    "mcast": {"start": "225.2.0.0", "end": "225.255.255.255",
+              "size": 65536},
+    "vlan": {"start": 2, "end": 4094, "size": 100},
+    "ipv4": {"start": "10.0.0.0", "end": "10.255.255.255"},
+}
+
+# Prefix length of the allocated subnets
+SUBNET_PREFIXES = [
+    ("node_subnet", 16),
+    ("pod_subnet", 16),
+    ("extern_dynamic", 24),
+    ("extern_static", 24),
+    ("node_svc_subnet", 24),
+]
+
+VLAN_FIELDS = ["kubeapi_vlan", "service_vlan"]
+
+# Owner of the resources shared by every cluster of the fabric
+FABRIC = "fabric"
+
+
+def ip_int(addr):
+    # (family, bits, integer) of an IPv4 or IPv6 address
+    family, bits = socket.AF_INET, 32
+    if ":" in addr:
+        family, bits = socket.AF_INET6, 128
+    return family, bits, int(binascii.hexlify(socket.inet_pton(family, addr)),
+                             16)
+
+
+def int_ip(family, i):
+    bits = 128 if family == socket.AF_INET6 else 32
+    return socket.inet_ntop(family, binascii.unhexlify("%0*x" % (bits // 4, i)))
+
+
+def cidr_range(cidr):
+    # (kind, first, last) of the addresses of a subnet
+    addr, mask = cidr.split("/")
+    family, bits, i = ip_int(addr)
+    hostmask = (1 << (bits - int(mask))) - 1
+    kind = "ipv6" if family == socket.AF_INET6 else "ipv4"
+    return kind, i & ~hostmask, i | hostmask
+
+
+class Node(object):
+    def __init__(self, interval):
+        self.interval = interval
+        self.left = None
+        self.right = None
+        self.max = interval[1]
+
+
+class IntervalTree(object):
+    """Closed integer intervals (lo, hi, owner) in a binary search tree on
+    lo, each node keeping the largest hi of its subtree.
+
+    The tree built from the initial intervals is balanced; intervals are
+    then added as leaves, new clusters being few next to the inventory.
+    """
+
+    def __init__(self, intervals=()):
+        self.root = self.build(sorted(intervals))
+
+    def build(self, intervals):
+        if not intervals:
+            return None
+        mid = len(intervals) // 2
+        node = Node(intervals[mid])
+        node.left = self.build(intervals[:mid])
+        node.right = self.build(intervals[mid + 1:])
+        for child in [node.left, node.right]:
+            if child is not None:
+                node.max = max(node.max, child.max)
+        return node
+
+    def add(self, lo, hi, owner):
+        interval = (lo, hi, owner)
+        if self.root is None:
+            self.root = Node(interval)
+            return
+        node = self.root
+        while True:
+            node.max = max(node.max, hi)
+            side = "left" if interval < node.interval else "right"
+            child = getattr(node, side)
+            if child is None:
+                setattr(node, side, Node(interval))
+                return
+            node = child
+
+    def overlap(self, lo, hi):
+        # The intervals overlapping [lo, hi], sorted
+        ret = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None or node.max < lo:
+                continue
+            stack.append(node.left)
+            if node.interval[0] <= hi:
+                if node.interval[1] >= lo:
+                    ret.append(node.interval)
+                stack.append(node.right)
+        return sorted(ret)
+
+    def __iter__(self):
+        stack, node = [], self.root
+        while stack or node is not None:
+            if node is not None:
+                stack.append(node)
+                node = node.left
+                continue
+            node = stack.pop()
+            yield node.interval
+            node = node.right
+
+    def conflicts(self):
+        # Pairs of overlapping intervals with different owners
+        ret = []
+        for a in self:
+            for b in self.overlap(a[0], a[1]):
+                if a < b and a[2] != b[2]:
+                    ret.append((a, b))
+        return ret
+
+    def free(self, lo, hi, size, align=1):
+        # The first block of size addresses in [lo, hi], starting at a
+        # multiple of align, overlapping no interval; None if full
+        start = -(-lo // align) * align
+        while start + size - 1 <= hi:
+            used = self.overlap(start, start + size - 1)
+            if not used:
+                return start
+            end = max(i[1] for i in used) + 1
+            start = -(-end // align) * align
+        return None
+
+
+def cluster_resources(config):
+    # (kind, first, last, field, value) of the fabric resources used by a
+    # cluster configuration
+    net_config = config.get("net_config") or {}
+    vmm_domain = (config.get("aci_config") or {}).get("vmm_domain") or {}
+    encap_type = vmm_domain.get("encap_type", "vxlan")
+    ret = []
+    mcast = vmm_domain.get("mcast_range")
+    if encap_type == "vxlan" and mcast:
+        ret.append(("mcast", ip_int(mcast["start"])[2],
+                    ip_int(mcast["end"])[2], "mcast_range",
+                    "%s-%s" % (mcast["start"], mcast["end"])))
+    vlans = vmm_domain.get("vlan_range")
+    if encap_type == "vlan" and vlans:
+        ret.append(("vlan", vlans["start"], vlans["end"], "vlan_range",
+                    "%s-%s" % (vlans["start"], vlans["end"])))
+    for field in VLAN_FIELDS + ["infra_vlan"]:
+        if net_config.get(field):
+            ret.append(("vlan", net_config[field], net_config[field], field,
+                        net_config[field]))
+    for field, prefix in SUBNET_PREFIXES:
+        value = net_config.get(field)
+        for cidr in (value if isinstance(value, list) else [value]):
+            if cidr:
+                ret.append(cidr_range(cidr) + (field, cidr))
+    return ret
+
+
+class Fleet(object):
+    """The fabric resources used by a fleet of clusters, one interval tree
+    per kind of resource: mcast, vlan, ipv4 and ipv6.
+    """
+
+    def __init__(self, clusters=()):
+        # clusters is a list of (name, resources)
+        self.trees = {}
+        self.values = {}
+        intervals = {}
+        for name, resources in clusters:
+            for kind, lo, hi, key in self.intervals(name, resources):
+                intervals.setdefault(kind, []).append((lo, hi, key))
+        for kind, l in intervals.items():
+            self.trees[kind] = IntervalTree(l)
+
+    def intervals(self, name, resources):
+        for kind, lo, hi, field, value in resources:
+            # infra_vlan is the same for every cluster of the fabric
+            owner = FABRIC if field == "infra_vlan" else name
+            key = (owner, field)
+            self.values.setdefault(key, [])
+            if value not in self.values[key]:
+                self.values[key].append(value)
+            yield kind, lo, hi, key
+
+    def add_resources(self, name, resources):
+        for kind, lo, hi, key in self.intervals(name, resources):
+            self.trees.setdefault(kind, IntervalTree()).add(lo, hi, key)
+
+    def describe(self, interval):
+        owner, field = interval[2]
+        values = self.values[interval[2]]
+        return {"cluster": owner, "field": field,
+                "value": values[0] if len(values) == 1 else values}
+
+    def conflicts(self, name=None):
+        # The overlapping resources of different clusters or fields, of
+        # cluster name if given, as a list of {"kind", "a", "b"}
+        ret = []
+        for kind in sorted(self.trees):
+            for a, b in self.trees[kind].conflicts():
+                if name is not None and name not in (a[2][0], b[2][0]):
+                    continue
+                ret.append({
+                    "kind": kind,
+                    "a": self.describe(a),
+                    "b": self.describe(b),
+                })
+        return ret
+
+    def allocate(self, name, config, pools):
+        # Assigns free resources to the fields missing in config, a user
+        # configuration, adding them to the fleet; returns the assigned
+        # {field: value}
+        aci_config = config.setdefault("aci_config", {})
+        vmm_domain = aci_config.setdefault("vmm_domain", {})
+        net_config = config.setdefault("net_config", {})
+        encap_type = vmm_domain.get("encap_type", "vxlan")
+        ret = {}
+
+        ipv4 = lambda i: int_ip(socket.AF_INET, i)
+
+        def take(kind, pool, size, align, field, value):
+            # The first free block of pool, added to the fleet with the
+            # value(first, last) of field
+            lo, hi = pool["start"], pool["end"]
+            if kind != "vlan":
+                lo, hi = ip_int(lo)[2], ip_int(hi)[2]
+            tree = self.trees.setdefault(kind, IntervalTree())
+            start = tree.free(lo, hi, size, align)
+            if start is None:
+                raise Exception("No free %s left in %s-%s for %s" %
+                                (kind, pool["start"], pool["end"], field))
+            end = start + size - 1
+            self.add_resources(name, [(kind, start, end, field,
+                                       value(start, end))])
+            return start, end
+
+        if encap_type == "vxlan" and not vmm_domain.get("mcast_range"):
+            size = pools["mcast"]["size"]
+            lo, hi = take("mcast", pools["mcast"], size, size, "mcast_range",
+                          lambda lo, hi: "%s-%s" % (ipv4(lo), ipv4(hi)))
+            vmm_domain["mcast_range"] = ret["mcast_range"] = {
+                "start": ipv4(lo),
+                "end": ipv4(hi),
+            }
+        if encap_type == "vlan" and not vmm_domain.get("vlan_range"):
+            lo, hi = take("vlan", pools["vlan"], pools["vlan"]["size"], 1,
+                          "vlan_range", lambda lo, hi: "%s-%s" % (lo, hi))
+            vmm_domain["vlan_range"] = ret["vlan_range"] = {
+                "start": lo,
+                "end": hi,
+            }
+        for field in VLAN_FIELDS:
+            if not net_config.get(field):
+                lo, hi = take("vlan", pools["vlan"], 1, 1, field,
+                              lambda lo, hi: lo)
+                net_config[field] = ret[field] = lo
+        for field, prefix in SUBNET_PREFIXES:
+            if not net_config.get(field):
+                size = 1 << (32 - prefix)
+                cidr = lambda lo, hi: "%s/%d" % (ipv4(lo + 1), prefix)
+                lo, hi = take("ipv4", pools["ipv4"], size, size, field, cidr)
+                net_config[field] = ret[field] = cidr(lo, hi)
+        return ret
+
+
+def load_state(fname):
+    # The allocation state: the pools and the resources assigned to each
+    # cluster by system id
+    state = {"fleet": FLEET_VERSION, "pools": {}, "clusters": {}}
+    if os.path.exists(fname):
+        with open(fname, "r") as fp:
+            state.update(json.load(fp))
+        if state["fleet"] != FLEET_VERSION:
+            raise Exception("Unsupported fleet state %s" % fname)
+    state["pools"] = dict(DEFAULT_POOLS, **state["pools"])
+    return state
+
+
+def save_state(fname, state):
+    dirname = os.path.dirname(fname)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmpname = fname + ".tmp"
+    with open(tmpname, "w") as fp:
+        json.dump(state, fp, indent=4, sort_keys=True,
+                  separators=(",", ": "))
+    os.rename(tmpname, fname)
@@ -0,0 +1,33 @@
+from __future__ import print_function
+
+import sys
+import threading
+
+# Messages logged by a thread are also collected in log_context.messages
+# when it is set, the server returns them with each response; they are
+# not printed when log_context.quiet is set, and are held back in
+# log_context.buffer when a background task sets it
+log_context = threading.local()
+
+
+def log(msg):
+    buf = getattr(log_context, "buffer", None)
+    if buf is not None:
+        buf.append(msg)
+        return
+    if not getattr(log_context, "quiet", False):
+        print(msg, file=sys.stderr)
+    messages = getattr(log_context, "messages", None)
+    if messages is not None:
+        messages.append(msg)
+
+
+def get_context():
+    # The log context of this thread, for the threads working for it
+    return dict((k, getattr(log_context, k, None))
+                for k in ["messages", "quiet", "buffer"])
+
+
+def set_context(context):
+    for k, v in context.items():
+        setattr(log_context, k, v)
@@ -0,0 +1,165 @@
+import re
+import threading
+
+from apic_provision import dn_split, mo_rn
+from errors import ApicError
+
+# Objects that exist on every APIC
+ROOT_MOS = [
+    ("uni", "polUni"),
+    ("uni/infra", "infraInfra"),
+    ("uni/userext", "aaaUserEp"),
+    ("uni/tn-common", "fvTenant"),
+    ("uni/tn-infra", "fvTenant"),
+    ("uni/vmmp-Kubernetes", "vmmProvP"),
+    ("uni/vmmp-OpenShift", "vmmProvP"),
+    ("uni/vmmp-CloudFoundry", "vmmProvP"),
+    ("uni/vmmp-VMware", "vmmProvP"),
+]
+
+
+class Mit(object):
+    """In-memory management information tree, indexed by DN.
+
+    A tree that is not seeded with the objects of every APIC holds a part
+    of the APIC's tree, the parents of its objects need not exist.
+    """
+
+    def __init__(self, seed=True):
+        self.lock = threading.RLock()
+        self.strict = seed
+        self.mos = {}
+        self.children = {}
+        if seed:
+            for dn, klass in ROOT_MOS:
+                self.add(dn, klass)
+
+    def add(self, dn, klass, **attributes):
+        with self.lock:
+            parent = "/".join(dn_split(dn)[:-1])
+            if dn not in self.mos:
+                if self.strict and parent and parent not in self.mos:
+                    raise ApicError("Parent of %s does not exist" % dn,
+                                    status=400, code="103")
+                self.mos[dn] = {"class": klass, "attributes": {}}
+                self.children.setdefault(dn, [])
+                if parent:
+                    self.children.setdefault(parent, []).append(dn)
+            elif self.mos[dn]["class"] != klass:
+                raise ApicError("Class mismatch for %s" % dn,
+                                status=400, code="107")
+            mo = self.mos[dn]
+            mo["attributes"].update(attributes)
+            mo["attributes"]["dn"] = dn
+            return mo
+
+    def remove(self, dn):
+        with self.lock:
+            if dn not in self.mos:
+                return
+            for child in list(self.children[dn]):
+                self.remove(child)
+            del self.mos[dn]
+            del self.children[dn]
+            parent = "/".join(dn_split(dn)[:-1])
+            if parent in self.children:
+                self.children[parent].remove(dn)
+
+    def post(self, dn, data):
+        # A posted object is either the object at dn itself or a child
+        # of it, like the APIC does
+        with self.lock:
+            klass, body = list(data.items())[0]
+            attributes = dict(body.get("attributes", {}))
+            rn = mo_rn(klass, attributes)
+            if "dn" in attributes:
+                dn = attributes["dn"]
+            elif dn_split(dn)[-1] != rn:
+                dn = dn + "/" + rn
+            self.post_mo(dn, klass, body)
+
+    def post_mo(self, dn, klass, body):
+        attributes = dict(body.get("attributes", {}))
+        attributes.pop("dn", None)
+        status = attributes.pop("status", "")
+        if "deleted" in status:
+            self.remove(dn)
+            return
+        self.add(dn, klass, **attributes)
+        for child in body.get("children", []):
+            cklass, cbody = list(child.items())[0]
+            cdn = dn + "/" + mo_rn(cklass, cbody.get("attributes", {}))
+            self.post_mo(cdn, cklass, cbody)
+
+    def subtree(self, dn):
+        with self.lock:
+            ret = [dn]
+            for child in self.children[dn]:
+                ret.extend(self.subtree(child))
+            return ret
+
+    def render(self, dn, rsp_subtree="no"):
+        with self.lock:
+            mo = self.mos[dn]
+            data = {"attributes": dict(mo["attributes"])}
+            if rsp_subtree in ["children", "full"] and self.children[dn]:
+                sub = "full" if rsp_subtree == "full" else "no"
+                data["children"] = [
+                    self.render(c, sub) for c in self.children[dn]]
+            return {mo["class"]: data}
+
+    def query(self, dns, query):
+        # Returns the objects selected by the query and the total count
+        # before paging
+        classes = query.get("target-subtree-class")
+        if classes:
+            classes = classes.split(",")
+            dns = [dn for dn in dns if self.mos[dn]["class"] in classes]
+        rsp_subtree = query.get("rsp-subtree", "no")
+        imdata = [self.render(dn, rsp_subtree) for dn in dns]
+        total = len(imdata)
+        if "page-size" in query:
+            size = int(query["page-size"])
+            page = int(query.get("page", 0))
+            imdata = imdata[page * size:(page + 1) * size]
+        return imdata, total
+
+    def get_mo(self, dn, query):
+        with self.lock:
+            if dn not in self.mos:
+                return [], 0
+            target = query.get("query-target", "self")
+            if target == "subtree":
+                dns = self.subtree(dn)
+            elif target == "children":
+                dns = list(self.children[dn])
+            else:
+                dns = [dn]
+            return self.query(dns, query)
+
+    def get_class(self, klass, query):
+        with self.lock:
+            dns = sorted(dn for dn, mo in self.mos.items()
+                         if mo["class"] == klass)
+            return self.query(dns, query)
+
+    def get(self, path, query):
+        # Returns (imdata, total) for a GET of path, raises ApicError
+        m = re.match(r"^/api/(node/)?(mo|class|tag)/(.*)\.json$", path)
+        if not m:
+            raise ApicError("Invalid request %s" % path, status=400,
+                            code="400")
+        kind, target = m.group(2), m.group(3)
+        if kind == "mo":
+            return self.get_mo(target, query)
+        elif kind == "class":
+            return self.get_class(target, query)
+        return self.get_tag(target, query)
+
+    def get_tag(self, tag, query):
+        with self.lock:
+            dns = sorted(
+                "/".join(dn_split(dn)[:-1]) for dn, mo in self.mos.items()
+                if mo["class"] == "tagInst" and
+                mo["attributes"].get("name") == tag)
+            return self.query(dns, query)
@@ -0,0 +1,190 @@
+from __future__ import print_function
+
+import cProfile
+import inspect
+import os
+import pstats
+import resource
+import sys
+import threading
+
+import tracing
+from apic_provision import ApicKubeConfig
+
+try:
+    import tracemalloc
+except ImportError:
+    # Not available before python 3.4
+    tracemalloc = None
+
+TOP = 25
+
+
+def apic_generator_lines():
+    lines, start = inspect.getsourcelines(ApicKubeConfig)
+    return inspect.getsourcefile(ApicKubeConfig), start, start + len(lines)
+
+
+def subsystem_matchers():
+    gen_file, gen_start, gen_end = apic_generator_lines()
+    gen_file = os.path.realpath(gen_file)
+
+    def in_generators(filename, lineno, funcname):
+        return (os.path.realpath(filename) == gen_file and
+                gen_start <= lineno < gen_end)
+
+    def in_path(*parts):
+        return lambda filename, lineno, funcname: any(
+            p in filename for p in parts)
+
+    sep = os.sep
+    return [
+        ("yaml", in_path(sep + "yaml" + sep)),
+        ("deep_merge", lambda f, l, n: n == "deep_merge"),
+        ("apic-generators", in_generators),
+        ("jinja", in_path(sep + "jinja2" + sep, sep + "templates" + sep)),
+        ("http", in_path(sep + "requests" + sep, sep + "urllib3" + sep,
+                         "httplib", sep + "http" + sep, "ssl.py",
+                         "socket.py")),
+    ]
+
+
+def subsystem_times(stats):
+    # Cumulative time per subsystem, counting only the calls made into a
+    # subsystem from outside of it so that nested calls aren't counted
+    # twice
+    matchers = subsystem_matchers()
+    ret = []
+    for name, match in matchers:
+        inside = lambda func: match(*func)
+        total, calls = 0.0, 0
+        for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+            if not inside(func):
+                continue
+            for caller, data in callers.items():
+                if not inside(caller):
+                    calls += data[1]
+                    total += data[3]
+        ret.append((name, calls, total))
+    return ret
+
+
+def subsystem_memory(snapshot):
+    matchers = subsystem_matchers()
+    totals = dict((name, 0) for name, match in matchers)
+    for stat in snapshot.statistics("filename"):
+        filename = stat.traceback[0].filename
+        for name, match in matchers:
+            if match(filename, 0, None):
+                totals[name] += stat.size
+                break
+    return [(name, totals[name]) for name, match in matchers]
+
+
+def current_rss():
+    # Resident memory in KiB, None where /proc isn't available
+    try:
+        with open("/proc/self/statm", "r") as fp:
+            pages = int(fp.read().split()[1])
+    except (IOError, OSError):
+        return None
+    return pages * resource.getpagesize() / 1024.0
+
+
+def phase_memory(phases):
+    # Growth of the resident memory per phase name, in order of first
+    # appearance; phases of concurrent threads overlap
+    ret = []
+    for p in phases:
+        if "rss_kib" not in p:
+            continue
+        for i, (name, count, total) in enumerate(ret):
+            if name == p["name"]:
+                ret[i] = (name, count + 1, total + p["rss_kib"])
+                break
+        else:
+            ret.append((p["name"], 1, p["rss_kib"]))
+    return ret
+
+
+def report(stats, snapshot, phases=()):
+    lines = ["Time by subsystem:"]
+    for name, calls, total in subsystem_times(stats):
+        lines.append("  %-20s %8d calls %10.1f ms" %
+                     (name, calls, total * 1000))
+
+    lines.append("Memory:")
+    lines.append("  peak RSS %d KiB" %
+                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    if snapshot is None:
+        lines.append("  allocation tracking requires python 3.4+")
+    else:
+        for name, size in subsystem_memory(snapshot):
+            lines.append("  %-20s %10.1f KiB" % (name, size / 1024.0))
+        lines.append("Top %d allocators:" % TOP)
+        for stat in snapshot.statistics("lineno")[:TOP]:
+            lines.append("  %s" % stat)
+
+    memory = phase_memory(phases)
+    if memory:
+        lines.append("RSS growth by phase:")
+        for name, count, total in memory:
+            lines.append("  %-20s %8d times %10.1f KiB" %
+                         (name, count, total))
+    return lines
+
+
+def profile_threads():
+    # Profiles every thread started from now on, such as the APIC push and
+    # the chunk posts, as cProfile only sees the thread it runs in.
+    # Returns the list their profilers are added to.
+    profilers = []
+    lock = threading.Lock()
+
+    def start(frame, event, arg):
+        # Called on the first event of a new thread
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        with lock:
+            profilers.append(profiler)
+        profiler.enable()
+
+    threading.setprofile(start)
+    return profilers
+
+
+def run(fn, fname):
+    # Run fn under cProfile, saving the stats of all its threads in fname
+    # and a report in fname.txt; returns the value of fn and the report
+    # lines
+    if tracemalloc is not None:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    threads = profile_threads()
+    # The phases sample the resident memory at their start and end
+    if current_rss() is not None:
+        tracing.memory = current_rss
+    try:
+        with tracing.collect() as tracer:
+            ret = profiler.runcall(fn)
+    finally:
+        threading.setprofile(None)
+        tracing.memory = None
+        snapshot = None
+        if tracemalloc is not None:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        stats = pstats.Stats(profiler)
+        for thread_profiler in list(threads):
+            stats.add(thread_profiler)
+        stats.dump_stats(fname)
+
+    with open(fname + ".txt", "w") as fp:
+        stats.stream = fp
+        lines = report(stats, snapshot, tracer.to_dict()["phases"])
+        for line in lines:
+            print(line, file=fp)
+        print("", file=fp)
+        stats.sort_stats("cumulative").print_stats(TOP)
+        stats.sort_stats("tottime").print_stats(TOP)
+    return ret, lines
@@ -0,0 +1,196 @@
+from __future__ import print_function
+
+import argparse
+import contextlib
+import json
+import os
+import re
+import threading
+import yaml
+
+import acc_provision
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+DEFAULT_HOST = "127.0.0.1"
+# Keys and certificates of the clusters, in a directory per system_id
+DEFAULT_KEY_DIR = "~/.local/share/acc-provision/keys"
+
+# Action: (check the APIC, delete, change the APIC)
+ACTIONS = {
+    "render": (False, False, False),
+    "plan": (True, False, False),
+    "apply": (True, False, True),
+    "delete": (False, True, True),
+}
+
+
+class Provisioner(object):
+    """Runs the provisioning actions of the server.
+
+    Each request is provisioned with a copy of the server's command line
+    arguments. Requests for the same system_id are serialized, others run
+    concurrently and share the templates, the APIC sessions and the
+    preflight results of the process. The key and certificate of each
+    system_id are kept in key_dir, requests can't name files.
+    """
+
+    def __init__(self, args, key_dir=None):
+        self.args = args
+        self.key_dir = os.path.expanduser(key_dir or DEFAULT_KEY_DIR)
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def sync_login_files(self, user_config):
+        # Points sync_login at the files of the system_id in key_dir,
+        # returns an error message if the request can't be served
+        aci_config = user_config.get("aci_config") or {}
+        sync_login = aci_config.get("sync_login") or {}
+        if not isinstance(sync_login, dict):
+            return "Invalid aci_config/sync_login"
+        if "certfile" in sync_login or "keyfile" in sync_login:
+            return ("aci_config/sync_login certfile and keyfile can't be "
+                    "set in a request")
+        system_id = aci_config.get("system_id")
+        if system_id is None:
+            # Refused by the validation
+            return None
+        if not re.match(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]*$", str(system_id)):
+            return "Invalid aci_config/system_id: %s" % system_id
+        dirname = os.path.join(self.key_dir, str(system_id))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, 0o700)
+        sync_login = dict(sync_login,
+                          certfile=os.path.join(dirname, "user.crt"),
+                          keyfile=os.path.join(dirname, "user.key"))
+        user_config["aci_config"] = dict(aci_config, sync_login=sync_login)
+        return None
+
+    @contextlib.contextmanager
+    def system_lock(self, system_id):
+        with self.lock:
+            lock = self.locks.setdefault(system_id, threading.Lock())
+        with lock:
+            yield
+
+    def run(self, action, user_config, flavor=None, version_token=None):
+        check_apic, delete, push = ACTIONS[action]
+        if flavor is not None and flavor not in acc_provision.FLAVORS:
+            return {"ok": False,
+                    "messages": ["Invalid configuration flavor: " + flavor]}
+
+        args = argparse.Namespace(**vars(self.args))
+        args.config = None
+        args.output = None
+        args.output_dir = None
+        args.apic = check_apic
+        args.delete = delete
+        if flavor is not None:
+            args.flavor = flavor
+        if version_token is not None:
+            args.version_token = version_token
+
+        user_config = dict(user_config)
+        error = self.sync_login_files(user_config)
+        if error is not None:
+            return {"ok": False, "messages": [error]}
+
+        system_id = (user_config.get("aci_config") or {}).get("system_id")
+        result = {}
+        messages = acc_provision.log_context.messages = []
+        try:
+            with self.system_lock(system_id):
+                ok = acc_provision.provision(args, None, False, user_config,
+                                             result, push)
+        except Exception as e:
+            acc_provision.err("%s: %s" % (e.__class__.__name__, e))
+            ok = False
+        finally:
+            acc_provision.log_context.messages = None
+
+        ret = {"ok": bool(ok), "messages": messages}
+        if "apic_config" in result:
+            ret["apic_config"] = [
+                {"path": path, "data": json.loads(data) if data else None}
+                for path, data in result["apic_config"]]
+        if "output" in result:
+            ret["output"] = result["output"]
+        return ret
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        acc_provision.info("%s %s" % (self.address_string(), format % args))
+
+    def reply(self, status, data):
+        body = json.dumps(data, indent=4, sort_keys=True,
+                          separators=(",", ": ")).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/health":
+            return self.reply(200, {"ok": True})
+        self.reply(404, {"ok": False, "messages": ["Not found"]})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        action = url.path.strip("/")
+        if action not in ACTIONS:
+            return self.reply(404, {"ok": False, "messages": ["Not found"]})
+        query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            user_config = yaml.load(self.rfile.read(length),
+                                    Loader=acc_provision.YamlLoader)
+        except yaml.YAMLError as e:
+            return self.reply(400, {"ok": False, "messages": [str(e)]})
+        if not isinstance(user_config, dict):
+            return self.reply(400, {
+                "ok": False, "messages": ["Expected a configuration"]})
+
+        ret = self.server.provisioner.run(
+            action, user_config, query.get("flavor"),
+            query.get("version_token"))
+        self.reply(200 if ret["ok"] else 400, ret)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def parse_addr(addr):
+    # "[host:]port" -> (host, port)
+    host, _, port = addr.rpartition(":")
+    return host or DEFAULT_HOST, int(port)
+
+
+def make_server(args, key_dir=None):
+    server = Server(parse_addr(args.serve), Handler)
+    server.provisioner = Provisioner(args, key_dir)
+    return server
+
+
+def serve(args):
+    # Keep the APIC lookups made before provisioning for the lifetime of
+    # the server, the templates and sessions are always shared
+    acc_provision.apic_preflight = {}
+    server = make_server(args)
+    acc_provision.info("Serving on %s:%d" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
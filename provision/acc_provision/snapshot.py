@@ -0,0 +1,200 @@
+from __future__ import print_function
+
+import json
+import os
+import time
+
+import requests
+import tracing
+from apic_provision import (INFRAVLAN_PATH, Apic, desired_mos,
+                            err, path_dn)
+from errors import ApicError
+from mit import Mit
+
+try:
+    from urllib import unquote
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from urllib.parse import parse_qs, unquote, urlparse
+
+SNAPSHOT_VERSION = 1
+
+
+def preflight_mos(config):
+    # (dn, class) of the objects looked up before provisioning
+    aci_config = config["aci_config"]
+    tenant = aci_config["vrf"]["tenant"]
+    return [
+        (path_dn(INFRAVLAN_PATH), "infraRsFuncToEpg"),
+        ("uni/infra/attentp-%s" % aci_config["aep"], "infraAttEntityP"),
+        ("uni/tn-%s/ctx-%s" % (tenant, aci_config["vrf"]["name"]), "fvCtx"),
+        ("uni/tn-%s/out-%s" % (tenant, aci_config["l3out"]["name"]),
+         "l3extOut"),
+        ("uni/userext/user-%s" % aci_config["sync_login"]["username"],
+         "aaaUser"),
+    ]
+
+
+def read_objects(apic, dns):
+    # Returns the objects of the subtrees at dns, read with one query per
+    # subtree as check_drift does
+    mos = {}
+    for dn in sorted(dns):
+        if not any(dn.startswith(d + "/") for d in dns):
+            apic.get_subtree(dn, mos)
+    return [{klass: {"attributes": dict(attributes, dn=dn)}}
+            for dn, (klass, attributes, children) in sorted(mos.items())]
+
+
+def write_line(fp, data):
+    print(json.dumps(data, sort_keys=True, separators=(",", ":")), file=fp)
+
+
+def write_objects(fp, objects):
+    for data in objects:
+        klass, body = list(data.items())[0]
+        write_line(fp, {"class": klass, "attributes": body["attributes"]})
+
+
+def load(fname, version_key):
+    # Returns the header, the (path, data) posts and a Mit with the
+    # objects of a snapshot or rollback file
+    mit = Mit(seed=False)
+    posts = []
+    with open(fname, "r") as fp:
+        header = json.loads(fp.readline())
+        if header.get(version_key) != SNAPSHOT_VERSION:
+            raise Exception("Unsupported file %s" % fname)
+        for line in fp:
+            entry = json.loads(line)
+            if "path" in entry:
+                data = entry["data"]
+                if data is not None:
+                    data = json.dumps(data, sort_keys=True, indent=4)
+                posts.append((entry["path"], data))
+                continue
+            attributes = entry["attributes"]
+            mit.add(attributes["dn"], entry["class"])[
+                "attributes"].update(attributes)
+    return header, posts, mit
+
+
+def export(apic, clusters, fname):
+    # Writes the APIC objects used by clusters, a list of (config,
+    # apic_config), to fname as JSON lines after a header line. Only the
+    # subtrees we use are read, not every object of their classes.
+    dns, system_ids = set(), []
+    for config, apic_config in clusters:
+        mos, roots, posts = desired_mos(apic_config)
+        dns.update(roots)
+        dns.update(dn for dn, klass in preflight_mos(config))
+        system_ids.append(config["aci_config"]["system_id"])
+
+    objects = read_objects(apic, dns)
+    with open(fname, "w") as fp:
+        write_line(fp, {
+            "snapshot": SNAPSHOT_VERSION,
+            "apic": apic.addr,
+            "system_ids": system_ids,
+            "time": int(time.time()),
+        })
+        write_objects(fp, objects)
+    return len(objects)
+
+
+def capture(apic, apic_config, fname, header):
+    # Writes the posts of apic_config and the current state of the
+    # objects they change to fname, for restore
+    mos, roots, posts = desired_mos(apic_config)
+    objects = read_objects(apic, roots)
+    # The posts hold the password of the sync user
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as fp:
+        write_line(fp, dict(header, rollback=SNAPSHOT_VERSION,
+                            apic=apic.addr, time=int(time.time())))
+        for path, data in apic_config:
+            if data is not None:
+                data = json.loads(data)
+            write_line(fp, {"path": path, "data": data})
+        write_objects(fp, objects)
+    return len(objects)
+
+
+def restore_mo(desired, before, dn):
+    # The post restoring the desired attributes of the object at dn and
+    # its children, deleting those that didn't exist
+    klass, attributes, children = desired[dn]
+    mo = before.mos.get(dn)
+    if mo is None:
+        return {klass: {"attributes": dict(attributes, status="deleted")}}
+    actual = mo["attributes"]
+    body = {"attributes": dict((k, actual[k]) for k in attributes
+                               if k in actual)}
+    restored = [restore_mo(desired, before, c) for c in children]
+    if restored:
+        body["children"] = restored
+    return {klass: body}
+
+
+def restore(apic, apic_config, before):
+    # Puts the objects changed by apic_config back the way they were in
+    # before, a Mit, with one request per changed subtree
+    desired, roots, posts = desired_mos(apic_config)
+    for dn in roots:
+        path = "/api/node/mo/%s.json" % dn
+        try:
+            if dn in before.mos:
+                resp = apic.post(path, json.dumps(
+                    restore_mo(desired, before, dn), sort_keys=True))
+            else:
+                resp = apic.delete(path)
+            apic.check_resp(resp)
+        except Exception as e:
+            # log it, otherwise ignore it
+            err("Error in restoring %s: %s" % (dn, str(e)))
+    return len(roots)
+
+
+class SnapshotApic(Apic):
+    """Answers the queries of Apic from a snapshot file.
+
+    Nothing is sent to the APIC; posts and deletes raise an exception.
+    """
+
+    def __init__(self, fname, debug=False):
+        self.fname = fname
+        header, posts, self.mit = load(fname, "snapshot")
+        self.addr = header["apic"]
+        self.system_ids = header["system_ids"]
+        self.ssl = True
+        self.username = None
+        self.password = None
+        self.cookies = {}
+        self.verify = False
+        self.debug = debug
+
+    def login(self):
+        return None
+
+    def request(self, method, path, data=None, **kwargs):
+        if method != "GET":
+            raise Exception("The APIC snapshot %s is read-only" % self.fname)
+        start = time.time()
+        url = urlparse(path)
+        query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        try:
+            imdata, total = self.mit.get(unquote(url.path), query)
+            status = 200
+        except ApicError as e:
+            imdata = [{"error": {"attributes": {
+                "code": e.code, "text": str(e)}}}]
+            total, status = 1, e.status
+
+        resp = requests.models.Response()
+        resp.status_code = status
+        resp.encoding = "utf-8"
+        resp._content = json.dumps(
+            {"totalCount": str(total), "imdata": imdata}).encode("utf-8")
+        tracing.request(method, path, status, time.time() - start, 0,
+                        len(resp.content))
+        return resp
@@ -1,10 +1,18 @@
+import base64
 import collections
+import copy
 import filecmp
 import functools
+import json
 import os
+import shutil
 import sys
+import tempfile
+import urllib
+import yaml
 
 import acc_provision
+import fleet
 
 
 def in_testdir(f):
@@ -75,6 +83,240 @@ def test_with_overrides():
     )
 
 
+@in_testdir
+def test_with_performance():
+    run_provision(
+        "with_performance.inp.yaml",
+        "with_performance.kube.yaml",
+        "base_case.apic.txt"
+    )
+
+
+@in_testdir
+def test_performance_errors():
+    with open("with_performance.inp.yaml", "r") as fp:
+        config = yaml.safe_load(fp)
+    config["performance"]["mtu"] = 100000
+    config["performance"]["resources"]["kube_proxy"] = {}
+    config["performance"]["resources"]["host_agent"]["requests"]["gpu"] = 1
+    tmperr = os.tempnam(".", "tmp-stderr-")
+    with open(tmperr, "w") as sys.stderr:
+        try:
+            args = get_args(config="-")
+            assert not acc_provision.provision(args, None, True, config)
+        finally:
+            sys.stderr = sys.__stderr__
+    with open(tmperr, "r") as fp:
+        errors = [l for l in fp if l.startswith("ERR:")]
+    os.remove(tmperr)
+    assert [e.split(" for ")[1].split(":")[0] for e in errors[:-1]] == [
+        "performance/mtu",
+        "performance/resources",
+        "performance/resources/host_agent/requests",
+    ]
+
+
+@in_testdir
+def test_multi_subnet():
+    run_provision(
+        "multi_subnet.inp.yaml",
+        "multi_subnet.kube.yaml",
+        "multi_subnet.apic.txt"
+    )
+
+
+@in_testdir
+def test_multi_subnet_errors():
+    with open("multi_subnet.inp.yaml", "r") as fp:
+        config = yaml.safe_load(fp)
+    config["net_config"]["pod_subnet"].append("10.2.128.1/17")
+    tmperr = os.tempnam(".", "tmp-stderr-")
+    with open(tmperr, "w") as sys.stderr:
+        try:
+            args = get_args(config="-")
+            assert not acc_provision.provision(args, None, True, config)
+            config["net_config"]["pod_subnet"][-1] = "10.7.0.1/33"
+            assert not acc_provision.provision(args, None, True, config)
+        finally:
+            sys.stderr = sys.__stderr__
+    with open(tmperr, "r") as fp:
+        errors = [l for l in fp if l.startswith("ERR:  Invalid")]
+    os.remove(tmperr)
+    assert "Subnets 10.2.0.1/16 and 10.2.128.1/17 overlap" in errors[0]
+    assert "Invalid value: 10.7.0.1/33" in errors[1]
+
+
+@in_testdir
+def test_config_schema():
+    with open("with_rollout.inp.yaml", "r") as fp:
+        config = yaml.safe_load(fp)
+    config["rollout"]["max_unavailble"] = 1
+    config["rollout"]["controller"]["strategy"] = "Blue"
+    config["performance"] = {"mtu": 100, "opflex": {"prr": 1}}
+    config["network"] = {}
+    tmperr = os.tempnam(".", "tmp-stderr-")
+    with open(tmperr, "w") as sys.stderr:
+        try:
+            args = get_args(config="-")
+            assert not acc_provision.provision(args, None, True, config)
+        finally:
+            sys.stderr = sys.__stderr__
+    with open(tmperr, "r") as fp:
+        errors = [l.strip() for l in fp if l.startswith("ERR:  Invalid")]
+    os.remove(tmperr)
+    prefix = "ERR:  Invalid configuration for "
+    assert errors == [prefix + e for e in [
+        "network: Unknown option",
+        "performance/mtu: Invalid value: 100; "
+        "Expected an integer in [1280, 9216]",
+        "performance/opflex/prr: Unknown option",
+        "rollout/controller/strategy: Invalid value: Blue; "
+        "Expected one of: {Recreate,RollingUpdate}",
+        "rollout/max_unavailble: Unknown option",
+    ]]
+    assert acc_provision.config_schema() is acc_provision.config_schema()
+
+    # Only plain YAML is loaded
+    inpfile = os.tempnam(".", "tmp-inp-")
+    with open(inpfile, "w") as fp:
+        fp.write("aci_config: !!python/object/apply:os.getpid []\n")
+    try:
+        acc_provision.config_user(inpfile)
+        assert False
+    except yaml.YAMLError:
+        pass
+    finally:
+        os.remove(inpfile)
+
+
+def test_propose_chunk_size():
+    propose = acc_provision.propose_chunk_size
+    # 110 pods fit in one chunk of 256 with room for half a chunk
+    assert propose(2 * 65533, 500, 110) == (256, 128000)
+    # A /16 has no room for 500 nodes with 256 or 192 addresses each
+    assert propose(65533, 500, 110) == (32, 64000)
+    assert propose(1000, 500, 110) == (None, None)
+    assert acc_provision.pool_size(
+        ["10.2.0.1/16", "10.6.0.1/24", "fd00:2::1/64"]) == 65533 + 253
+
+
+def test_interval_tree():
+    tree = fleet.IntervalTree([(10, 19, "a"), (30, 39, "b"), (15, 15, "c")])
+    tree.add(40, 49, "d")
+    assert tree.overlap(12, 30) == [(10, 19, "a"), (15, 15, "c"),
+                                    (30, 39, "b")]
+    assert tree.overlap(20, 29) == []
+    assert tree.conflicts() == [((10, 19, "a"), (15, 15, "c"))]
+    assert tree.free(0, 100, 10, 10) == 0
+    assert tree.free(10, 100, 10, 10) == 20
+    assert tree.free(10, 100, 11, 1) == 50
+    assert tree.free(10, 55, 11, 1) is None
+
+
+@in_testdir
+def test_fleet_check():
+    state = os.tempnam(".", "tmp-fleet-")
+    tmpout = os.tempnam(".", "tmp-stdout-")
+    with open(tmpout, "w") as sys.stdout:
+        try:
+            args = get_args(fleet="fleet.yaml", fleet_state=state)
+            assert acc_provision.main(args, no_random=True) == 1
+        finally:
+            sys.stdout = sys.__stdout__
+    with open(tmpout, "r") as fp:
+        report = json.load(fp)
+    os.remove(tmpout)
+    assert report["clusters"] == 2
+    assert [(c["kind"], c["a"]["field"], c["b"]["cluster"])
+            for c in report["conflicts"]] == [
+        ("ipv4", "node_subnet", "kube-vlan"),
+        ("ipv4", "pod_subnet", "kube-vlan"),
+        ("ipv4", "extern_dynamic", "kube-vlan"),
+        ("ipv4", "extern_static", "kube-vlan"),
+        ("ipv4", "node_svc_subnet", "kube-vlan"),
+        ("vlan", "kubeapi_vlan", "kube-vlan"),
+        ("vlan", "service_vlan", "kube-vlan"),
+    ]
+    assert not os.path.exists(state)
+
+
+@in_testdir
+def test_fleet_allocate():
+    state = os.tempnam(".", "tmp-fleet-")
+    output = os.tempnam(".", "tmp-fleet-out-")
+    args = get_args(config="fleet_new.inp.yaml", fleet="fleet.yaml",
+                    fleet_state=state, allocate=output)
+    assert acc_provision.main(args, no_random=True) == 0
+    assert filecmp.cmp(output, "fleet_new.out.yaml")
+
+    # The allocation is kept, another cluster gets other resources
+    with open(state, "r") as fp:
+        assert list(json.load(fp)["clusters"]) == ["kube2"]
+    with open("fleet_new.inp.yaml", "r") as fp:
+        config = yaml.safe_load(fp)
+    config["aci_config"]["system_id"] = "kube3"
+    with open(output, "w") as fp:
+        yaml.safe_dump(config, fp)
+    args = args._replace(config=output)
+    assert acc_provision.main(args, no_random=True) == 1
+    with open(output, "w") as fp:
+        config["net_config"]["pod_subnet"] = "10.7.0.1/16"
+        yaml.safe_dump(config, fp)
+    assert acc_provision.main(args, no_random=True) == 0
+    with open(output, "r") as fp:
+        config = yaml.safe_load(fp)
+    assert config["net_config"]["node_subnet"] == "10.8.0.1/16"
+    assert config["aci_config"]["vmm_domain"]["mcast_range"] == {
+        "start": "225.4.0.0", "end": "225.4.255.255"}
+    fl = fleet.Fleet(acc_provision.fleet_clusters(args)[1])
+    assert fl.conflicts("kube2") == fl.conflicts("kube3") == []
+    os.remove(output)
+    os.remove(state)
+
+
+@in_testdir
+def test_with_rollout():
+    run_provision(
+        "with_rollout.inp.yaml",
+        "with_rollout.kube.yaml",
+        "base_case.apic.txt"
+    )
+    run_provision(
+        "with_rollout.inp.yaml",
+        "with_rollout_16.kube.yaml",
+        None,
+        overrides={"flavor": "kubernetes-1.6"}
+    )
+
+    # DaemonSets only take maxSurge with apps/v1
+    with open("with_rollout.inp.yaml", "r") as fp:
+        config = yaml.safe_load(fp)
+    config["kube_config"]["use_apps_api"] = "apps/v1"
+    result = {}
+    tmpout = os.tempnam(".", "tmp-kube-")
+    args = get_args(config="-", output=tmpout)
+    messages = acc_provision.log_context.messages = []
+    try:
+        assert acc_provision.provision(args, None, True, config, result)
+    finally:
+        acc_provision.log_context.messages = None
+        os.remove(tmpout)
+    objects = dict((o["metadata"]["name"], o)
+                   for o in yaml.safe_load_all(result["output"]) if o)
+
+    # The printed selector picks the prepull DaemonSet alone
+    selector, = [m.split(" -l ")[1] for m in messages
+                 if "apply -f" in m and " -l " in m]
+    key, value = selector.split("=")
+    assert [name for name, o in objects.items()
+            if o["metadata"].get("labels", {}).get(key) == value] == [
+        "aci-containers-prepull"]
+    assert objects["aci-containers-host"]["spec"]["updateStrategy"] == {
+        "type": "RollingUpdate",
+        "rollingUpdate": {"maxUnavailable": "10%", "maxSurge": 0},
+    }
+
+
 @in_testdir
 def test_flavor_openshift_36():
     run_provision(
@@ -143,10 +385,1177 @@ def test_helpmsg():
     os.remove(tmpout)
 
 
+@in_testdir
+def test_output_dir():
+    outdir = os.tempnam(".", "tmp-kube-dir-")
+    args = get_args(config="base_case.inp.yaml", output_dir=outdir)
+    acc_provision.main(args, no_random=True)
+
+    # One file per object, together matching the single file output
+    files = sorted(os.listdir(outdir))
+    assert "configmap-aci-containers-config.yaml" in files
+    assert "clusterrole-aci-containers-controller.yaml" in files
+    with open("base_case.kube.yaml", "r") as fp:
+        expected = fp.read()
+    for name in files:
+        with open(os.path.join(outdir, name), "r") as fp:
+            assert fp.read() in expected
+
+    # Nothing is rewritten when the inputs are unchanged
+    mtimes = dict((name, os.stat(os.path.join(outdir, name)).st_mtime)
+                  for name in files)
+    objects = acc_provision.split_kube_objects(expected)
+    assert acc_provision.write_output_dir(objects, outdir) == ([], [])
+    for name in files:
+        assert os.stat(os.path.join(outdir, name)).st_mtime == mtimes[name]
+
+    def write(config, **overrides):
+        args = get_args(config="-", output_dir=outdir, **overrides)
+        messages = acc_provision.log_context.messages = []
+        try:
+            assert acc_provision.provision(args, None, True, config)
+        finally:
+            acc_provision.log_context.messages = None
+        return messages
+
+    # Only the objects touched by an input change are rewritten, a new
+    # version token alone changes nothing
+    with open("base_case.inp.yaml", "r") as fp:
+        config = yaml.safe_load(fp)
+    config["logging"]["controller_log_level"] = "debug"
+    messages = write(copy.deepcopy(config), version_token="other")
+    changed = messages[messages.index("INFO: Changed objects:") + 1:]
+    assert changed[0] == "INFO:   configmap-aci-containers-config.yaml"
+    assert changed[1] == "INFO: Apply changed objects using:"
+
+    # Objects no longer generated are removed, other files are kept
+    with open(os.path.join(outdir, "notes.yaml"), "w") as fp:
+        fp.write("a: b\n")
+    config["rollout"] = {"prepull_images": True}
+    write(copy.deepcopy(config))
+    prepull = "daemonset-aci-containers-prepull.yaml"
+    assert prepull in os.listdir(outdir)
+    del config["rollout"]
+    messages = write(copy.deepcopy(config))
+    assert prepull not in os.listdir(outdir)
+    assert "notes.yaml" in os.listdir(outdir)
+    assert "INFO:   %s" % prepull in messages
+    assert "INFO:   kubectl -n kube-system delete daemonset " \
+        "aci-containers-prepull" in messages
+
+    shutil.rmtree(outdir)
+
+
+@in_testdir
+def test_hash_version_token():
+    def version_label(output):
+        with open(output, "r") as fp:
+            config = yaml.safe_load(fp.read().split("---")[0])
+        os.remove(output)
+        return config["metadata"]["labels"]["aci-containers-config-version"]
+
+    def run(inpfile, **overrides):
+        args = get_args(config=inpfile, output=os.tempnam(".", "tmp-kube-"),
+                        version_token=None, hash_version_token=True,
+                        **overrides)
+        acc_provision.main(args, no_random=False)
+        return version_label(args.output)
+
+    token = run("base_case.inp.yaml")
+    assert len(token) == 40
+    assert run("base_case.inp.yaml") == token
+    assert run("base_case.inp.yaml", username="other") == token
+    assert run("vlan_case.inp.yaml") != token
+
+
+@in_testdir
+def test_build_cache():
+    cachedir = os.tempnam(".", "tmp-cache-")
+    try:
+        # The second run is served from the cache with identical output
+        for i in range(2):
+            run_provision(
+                "base_case.inp.yaml",
+                "base_case.kube.yaml",
+                "base_case.apic.txt",
+                overrides={"no_cache": False, "cache_dir": cachedir}
+            )
+            assert len(os.listdir(cachedir)) == 1
+
+        # Any change in the inputs results in a new entry
+        run_provision(
+            "base_case.inp.yaml",
+            "flavor_openshift_36.kube.yaml",
+            "flavor_openshift_36.apic.txt",
+            overrides={"no_cache": False, "cache_dir": cachedir,
+                       "flavor": "openshift-3.6"}
+        )
+        assert len(os.listdir(cachedir)) == 2
+
+        # The version token isn't cached, runs without -t get a new one
+        tokens = []
+        for token in ["given", None, None]:
+            output = os.tempnam(".", "tmp-kube-")
+            args = get_args(config="base_case.inp.yaml", output=output,
+                            no_cache=False, cache_dir=cachedir,
+                            version_token=token)
+            acc_provision.main(args, no_random=True)
+            with open(output, "r") as fp:
+                objects = list(yaml.safe_load_all(fp))
+            os.remove(output)
+            labels = set(o["metadata"]["labels"][
+                "aci-containers-config-version"] for o in objects if o)
+            assert len(labels) == 1
+            tokens.extend(labels)
+        assert tokens[0] == "given" and len(set(tokens)) == 3
+        assert len(os.listdir(cachedir)) == 2
+    finally:
+        for name in os.listdir(cachedir):
+            os.remove(os.path.join(cachedir, name))
+        os.rmdir(cachedir)
+
+
+@in_testdir
+def test_batch():
+    manifest = os.tempnam(".", "tmp-batch-")
+    report = os.tempnam(".", "tmp-report-")
+    clusters = [
+        {"config": "base_case.inp.yaml",
+         "output": os.tempnam(".", "tmp-kube-")},
+        {"config": "vlan_case.inp.yaml",
+         "output": os.tempnam(".", "tmp-kube-")},
+        {"name": "missing", "config": "missing.inp.yaml",
+         "output": os.tempnam(".", "tmp-kube-")},
+        # Nothing would be written
+        {"name": "nowhere", "config": "base_case.inp.yaml"},
+    ]
+    with open(manifest, "w") as fp:
+        yaml.safe_dump(clusters, fp)
+
+    args = get_args(batch=manifest, jobs=2, batch_report=report)
+    messages = acc_provision.log_context.messages = []
+    try:
+        assert acc_provision.main(args, no_random=True) == 1
+    finally:
+        acc_provision.log_context.messages = None
+    assert filecmp.cmp(clusters[0]["output"], "base_case.kube.yaml")
+    assert filecmp.cmp(clusters[1]["output"], "vlan_case.kube.yaml")
+    with open(report, "r") as fp:
+        summary = json.load(fp)
+    assert summary["ok"] == 2
+    assert summary["failed"] == 2
+    assert [c["status"] for c in summary["clusters"]] == [
+        "ok", "ok", "failed", "failed"]
+    assert summary["clusters"][0]["name"] == "base_case.inp"
+    assert summary["clusters"][3]["error"] == "No output or output_dir"
+
+    # The lines of each cluster are prefixed with its name
+    assert "ERR:  nowhere: No output or output_dir" in messages
+    assert any(m.startswith("ERR:  missing: ") for m in messages)
+    assert any(m.startswith("INFO: vlan_case.inp: ") for m in messages)
+
+    for f in [manifest, report, clusters[0]["output"], clusters[1]["output"]]:
+        os.remove(f)
+
+
+def test_generate_cert():
+    from OpenSSL import crypto
+
+    tmpdir = os.tempnam(".", "tmp-certs-")
+    os.mkdir(tmpdir)
+    certfile = os.path.join(tmpdir, "user.crt")
+    keyfile = os.path.join(tmpdir, "user.key")
+    try:
+        key = acc_provision.generate_key("ecdsa-p256")
+        key_data, cert_data = acc_provision.generate_cert(
+            "test", certfile, keyfile, key)
+        cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert_data)
+        assert cert.get_signature_algorithm() == "ecdsa-with-SHA256"
+        assert cert.get_pubkey().bits() == 256
+
+        # Existing files are reused
+        assert acc_provision.generate_cert(
+            "test", certfile, keyfile) == (key_data, cert_data)
+    finally:
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+
+def test_background_task():
+    import threading
+
+    started = threading.Event()
+
+    def task(x):
+        acc_provision.info("task %d" % x)
+        started.set()
+        if x < 0:
+            raise ValueError("negative")
+        return x * 2
+
+    messages = acc_provision.log_context.messages = []
+    try:
+        t = acc_provision.BackgroundTask(task, 1)
+        started.wait()
+        acc_provision.info("caller")
+        assert t.result() == 2
+        assert messages == ["INFO: caller", "INFO: task 1"]
+
+        t = acc_provision.BackgroundTask(task, -1)
+        try:
+            t.result()
+            assert False
+        except ValueError:
+            pass
+        assert messages[-1] == "INFO: task -1"
+
+        # wait() logs the error so that the caller's error is the one raised
+        t = acc_provision.BackgroundTask(task, -2)
+        try:
+            try:
+                raise KeyError("caller")
+            except KeyError:
+                t.wait()
+                raise
+        except KeyError as e:
+            assert e.args == ("caller",)
+        assert messages[-2:] == ["INFO: task -2", "ERR:  ValueError: negative"]
+    finally:
+        acc_provision.log_context.messages = None
+
+
+@in_testdir
+def test_key_pool():
+    from fake_apic import FakeApic
+
+    pooldir = os.tempnam(".", "tmp-pool-")
+    apic = FakeApic(use_ssl=True).start()
+    inpfile = fake_apic_input(apic, "base_case.inp.yaml")
+    certfile, keyfile = os.tempnam(".", "tmp-crt-"), os.tempnam(".", "tmp-key-")
+    try:
+        acc_provision.key_pool_fill(pooldir, "rsa-2048", 2, jobs=2)
+        assert len(os.listdir(pooldir)) == 2
+        key = acc_provision.generate_key("rsa-2048", pooldir)
+        assert key.bits() == 2048
+        assert len(os.listdir(pooldir)) == 1
+        assert acc_provision.key_pool_take(pooldir, "rsa-4096") is None
+
+        with open(inpfile, "r") as fp:
+            config = yaml.safe_load(fp)
+        config["aci_config"]["sync_login"] = {
+            "certfile": certfile,
+            "keyfile": keyfile,
+        }
+
+        # An invalid configuration takes no key
+        bad = copy.deepcopy(config)
+        del bad["net_config"]["node_subnet"]
+        args = get_args(config="-", output="/dev/null", key_pool=pooldir)
+        tmperr = os.tempnam(".", "tmp-stderr-")
+        with open(tmperr, "w") as sys.stderr:
+            try:
+                assert not acc_provision.provision(args, None, True, bad)
+            finally:
+                sys.stderr = sys.__stderr__
+        os.remove(tmperr)
+        assert len(os.listdir(pooldir)) == 1
+
+        # Runs only reading the APIC take no key and save no certs
+        args = get_args(config="-", output="/dev/null", key_pool=pooldir,
+                        apic=True)
+        assert acc_provision.provision(args, None, True,
+                                       copy.deepcopy(config), push=False)
+        assert len(os.listdir(pooldir)) == 1
+        assert not os.path.exists(certfile)
+        assert not os.path.exists(keyfile)
+
+        args = get_args(config="-", output="/dev/null", key_pool=pooldir)
+        assert acc_provision.provision(args, None, True, config)
+        assert os.listdir(pooldir) == []
+        assert os.path.exists(keyfile)
+    finally:
+        apic.stop()
+        shutil.rmtree(pooldir)
+        for fname in [inpfile, certfile, keyfile]:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+
+@in_testdir
+def test_trace():
+    tracefile = os.tempnam(".", "tmp-trace-")
+    run_provision(
+        "base_case.inp.yaml",
+        "base_case.kube.yaml",
+        "base_case.apic.txt",
+        overrides={"trace": tracefile}
+    )
+    with open(tracefile, "r") as fp:
+        trace = json.load(fp)
+    os.remove(tracefile)
+    phases = [p["name"] for p in trace["phases"]]
+    # advise runs alongside adjust, cert and apic-gen
+    assert "advise" in phases
+    assert [p for p in phases if p != "advise"] == [
+        "load", "merge", "discover", "validate", "adjust", "cert",
+        "apic-gen", "render"]
+    assert trace["requests"] == []
+
+
+@in_testdir
+def test_profile():
+    import pstats
+
+    proffile = os.tempnam(".", "tmp-prof-")
+    run_provision(
+        "base_case.inp.yaml",
+        "base_case.kube.yaml",
+        "base_case.apic.txt",
+        overrides={"profile": proffile}
+    )
+    stats = pstats.Stats(proffile)
+    times = dict((name, calls) for name, calls, total in
+                 acc_provision.profiling.subsystem_times(stats))
+    assert times["deep_merge"] > 0
+    assert times["apic-generators"] > 0
+    assert times["jinja"] > 0
+    with open(proffile + ".txt", "r") as fp:
+        text = fp.read()
+    assert text.startswith("Time by subsystem:")
+    # The memory of each phase, without tracemalloc too
+    memory = text[text.index("RSS growth by phase:"):].split("\n")
+    assert [l.split()[0] for l in memory[1:4]] == ["load", "merge",
+                                                   "discover"]
+    os.remove(proffile)
+    os.remove(proffile + ".txt")
+
+    # The push runs in other threads, their calls are in the stats too
+    from fake_apic import FakeApic
+    apic = FakeApic(use_ssl=True).start()
+    inpfile = fake_apic_input(apic, "base_case.inp.yaml")
+    try:
+        args = get_args(config=inpfile, output="/dev/null", apic=True,
+                        profile=proffile)
+        acc_provision.main(args, no_random=True)
+        stats = pstats.Stats(proffile)
+        assert [f for f in stats.stats if f[2] == "post_chunks"]
+        times = dict((name, calls) for name, calls, total in
+                     acc_provision.profiling.subsystem_times(stats))
+        assert times["http"] > 0
+    finally:
+        apic.stop()
+        os.remove(inpfile)
+        os.remove(proffile)
+        os.remove(proffile + ".txt")
+
+
+@in_testdir
+def test_namespace_endpoint_groups():
+    with open("base_case.inp.yaml", "r") as fp:
+        config = yaml.safe_load(fp)
+    config["kube_config"]["namespace_default_endpoint_group"] = dict(
+        ("ns-%d" % i, {"tenant": "kube", "app_profile": "kubernetes",
+                       "group": "epg-%d" % i}) for i in range(3))
+    inpfile = os.tempnam(".", "tmp-inp-")
+    with open(inpfile, "w") as fp:
+        yaml.safe_dump(config, fp)
+
+    args = get_args(config=inpfile, output=os.tempnam(".", "tmp-kube-"))
+    acc_provision.main(args, no_random=True)
+    with open(args.output, "r") as fp:
+        configmap = list(yaml.safe_load_all(fp))[0]
+    controller = json.loads(configmap["data"]["controller-config"])
+    assert sorted(controller["namespace-default-endpoint-group"]) == [
+        "kube-system", "ns-0", "ns-1", "ns-2"]
+    os.remove(inpfile)
+    os.remove(args.output)
+
+
+def fake_apic_input(apic, inpfile):
+    # Copy of inpfile pointing at the fake APIC, with the objects it
+    # expects to find in the fabric
+    apic.add("uni/infra/attentp-default", "infraAttEntityP", name="default")
+    apic.add("uni/infra/attentp-default/provacc", "infraProvAcc")
+    apic.add("uni/infra/attentp-default/provacc/"
+             "rsfuncToEpg-[uni/tn-infra/ap-access/epg-default]",
+             "infraRsFuncToEpg", tDn="uni/tn-infra/ap-access/epg-default",
+             encap="vlan-4093")
+    apic.add("uni/infra/attentp-kube-aep", "infraAttEntityP", name="kube-aep")
+    apic.add("uni/tn-common/ctx-kube", "fvCtx", name="kube")
+    apic.add("uni/tn-common/out-l3out", "l3extOut", name="l3out")
+    apic.add("uni/tn-common/out-l3out/instP-default", "l3extInstP",
+             name="default")
+
+    with open(inpfile, "r") as fp:
+        config = yaml.safe_load(fp)
+    config["aci_config"]["apic_hosts"] = [apic.addr]
+    fname = os.tempnam(".", "tmp-inp-")
+    with open(fname, "w") as fp:
+        yaml.safe_dump(config, fp)
+    return fname
+
+
+@in_testdir
+def test_fake_apic_provision():
+    from apic_provision import Apic
+    from fake_apic import FakeApic
+
+    apic = FakeApic(use_ssl=True).start()
+    inpfile = fake_apic_input(apic, "base_case.inp.yaml")
+    try:
+        client = Apic(apic.addr, "admin", "noir0123")
+        assert client.get_infravlan() == 4093
+
+        # The kube yaml has the APIC address, the APIC config is unchanged
+        run_provision(inpfile, None, "base_case.apic.txt",
+                      overrides={"apic": True})
+        assert apic.get("uni/tn-kube/ap-kubernetes/epg-kube-nodes")
+        assert apic.get("uni/vmmp-Kubernetes/dom-kube")
+        assert apic.get("uni/userext/user-kube/usercert-kube.crt")
+        assert apic.get("uni/tn-common/out-l3out/instP-default/"
+                        "rsprov-kube-l3out-allow-all")
+
+        acc_provision.main(get_args(config=inpfile, delete=True),
+                           no_random=True)
+        assert apic.get("uni/tn-kube") is None
+        assert apic.get("uni/vmmp-Kubernetes/dom-kube") is None
+        assert apic.get("uni/userext/user-kube") is None
+        assert apic.get("uni/tn-common/out-l3out/instP-default")
+        assert apic.get("uni/tn-common/brc-kube-l3out-allow-all") is None
+    finally:
+        apic.stop()
+        os.remove(inpfile)
+
+
+@in_testdir
+def test_encap_blocks():
+    from apic_provision import merge_ranges, subtract_ranges
+    from fake_apic import FakeApic
+
+    assert merge_ranges([(4003, 4003), (4001, 4001), (4002, 4002),
+                         (200, 299), (250, 300)]) == [(200, 300),
+                                                      (4001, 4003)]
+    assert subtract_ranges([(1, 10)], [(3, 4), (8, 20)]) == [(1, 2), (5, 7)]
+    assert subtract_ranges([(1, 10)], [(0, 11)]) == []
+
+    # Only the VLANs missing in a shared pool are posted
+    apic = FakeApic(use_ssl=True).start()
+    inpfile = fake_apic_input(apic, "base_case.inp.yaml")
+    pool = "uni/infra/vlanns-[shared-pool]-static"
+    apic.add(pool, "fvnsVlanInstP", name="shared-pool", allocMode="static")
+    apic.add(pool + "/from-[vlan-3990]-to-[vlan-4001]", "fvnsEncapBlk",
+             **{"from": "vlan-3990", "to": "vlan-4001"})
+    with open(inpfile, "r") as fp:
+        config = yaml.safe_load(fp)
+    config["aci_config"]["physical_domain"] = {"vlan_pool": "shared-pool"}
+    with open(inpfile, "w") as fp:
+        yaml.safe_dump(config, fp)
+    try:
+        run_provision(inpfile, None, None, overrides={"apic": True})
+        blocks = sorted(dn for dn, mo in apic.mit.mos.items()
+                        if mo["class"] == "fvnsEncapBlk" and
+                        dn.startswith(pool + "/"))
+        assert blocks == [pool + "/from-[vlan-3990]-to-[vlan-4001]",
+                          pool + "/from-[vlan-4003]-to-[vlan-4003]"]
+        gets = [p for m, p in apic.requests if "fvnsEncapBlk" in p]
+        assert len(gets) == 1
+    finally:
+        apic.stop()
+        os.remove(inpfile)
+
+
+@in_testdir
+def test_split_post():
+    import api
+    import apic_provision
+    from apic_provision import Apic, mo_count, mo_rn, path_dn, split_post
+    from fake_apic import FakeApic
+
+    path = "/api/mo/uni/tn-kube.json"
+    with open("base_case.inp.yaml", "r") as fp:
+        result = api.render(yaml.safe_load(fp), no_random=True)
+    config = json.dumps(dict(result.apic_config)[path])
+    assert split_post(path, config) == [(0, path, config)]
+
+    chunks = split_post(path, config, 1024, 20)
+    assert len(chunks) > 1
+    dns = set()
+    for depth, p, c in chunks:
+        data = json.loads(c)
+        assert len(c) <= 1024 and mo_count(data) <= 20
+        # Parents first
+        assert depth == 0 or path_dn(p) in dns
+        klass, body = list(data.items())[0]
+        dns.add(path_dn(p) if depth == 0 else
+                "%s/%s" % (path_dn(p), mo_rn(klass, body["attributes"])))
+    assert sum(mo_count(json.loads(c)) for d, p, c in chunks) == \
+        mo_count(json.loads(config))
+
+    def provision(apic, apic_post=None):
+        inpfile = fake_apic_input(apic, "base_case.inp.yaml")
+        with open(inpfile, "r") as fp:
+            config = yaml.safe_load(fp)
+        if apic_post:
+            config["aci_config"]["apic_post"] = apic_post
+        with open(inpfile, "w") as fp:
+            yaml.safe_dump(config, fp)
+        try:
+            run_provision(inpfile, overrides={"apic": True})
+        finally:
+            os.remove(inpfile)
+        return dict((dn, mo) for dn, mo in apic.mit.mos.items()
+                    if dn.startswith("uni/tn-kube"))
+
+    # The same objects are posted in chunks
+    apic = FakeApic(use_ssl=True).start()
+    try:
+        expected = provision(apic)
+    finally:
+        apic.stop()
+    apic = FakeApic(use_ssl=True).start()
+    try:
+        assert provision(apic, {"max_bytes": 1024,
+                                "max_objects": 20}) == expected
+        posts = [p for m, p in apic.requests if m == "POST" and
+                 p.startswith("/api/mo/uni/tn-kube")]
+        assert len(posts) == len(chunks)
+    finally:
+        apic.stop()
+
+    # A rejected chunk fails its subtree only
+    ap = "uni/tn-kube/ap-kubernetes"
+    apic = FakeApic(use_ssl=True).start()
+    try:
+        apic.add("uni/tn-kube", "fvTenant", name="kube")
+        apic.add(ap, "fvBD", name="kubernetes")
+        client = Apic(apic.addr, "admin", "noir0123")
+        # The lines logged by the posting threads are held back with
+        # those of the task
+        apic_provision.apic_debug = True
+        messages = acc_provision.log_context.messages = []
+        acc_provision.log_context.quiet = True
+        try:
+            task = acc_provision.BackgroundTask(
+                client.post_chunks, path, config, (1024, 20, 2))
+            task.thread.join()
+            assert messages == []
+            outcomes = task.result()
+        finally:
+            apic_provision.apic_debug = False
+            acc_provision.log_context.messages = None
+            acc_provision.log_context.quiet = False
+        assert len([m for m in messages if m.startswith("DBG:")]) > \
+            len(chunks) // 2
+        assert [p for d, p, c in chunks] == [p for p, e in outcomes]
+        errors = [e for p, e in outcomes if e is not None]
+        assert "Parent not provisioned" in errors
+        assert len(errors) < len(outcomes)
+        assert apic.get(ap)["class"] == "fvBD"
+        assert apic.get("uni/tn-kube/BD-kube-pod-bd")
+        assert not [dn for dn in apic.mit.mos if dn.startswith(ap + "/")]
+    finally:
+        apic.stop()
+
+
+@in_testdir
+def test_rotate_cert():
+    from apic_provision import Apic
+    from fake_apic import FakeApic
+
+    apic = FakeApic(use_ssl=True).start()
+    inpfile = fake_apic_input(apic, "base_case.inp.yaml")
+    certfile, keyfile = os.tempnam(".", "tmp-crt-"), os.tempnam(".", "tmp-key-")
+    with open(inpfile, "r") as fp:
+        config = yaml.safe_load(fp)
+    config["aci_config"]["sync_login"] = {
+        "certfile": certfile,
+        "keyfile": keyfile,
+    }
+    # A kubectl whose patches fail with "fail" as first argument
+    kubectl = os.tempnam(".", "tmp-kubectl-")
+    with open(kubectl, "w") as fp:
+        fp.write("""#!/bin/sh
+if [ "$1" = fail ]; then shift; fail=1; fi
+echo "$@" >> %s.log
+case "$*" in
+*" patch "*) [ -z "$fail" ] ;;
+*" get deployment "*) echo '{"metadata": {"generation": 2},
+  "spec": {"replicas": 1}, "status": {"observedGeneration": 2,
+  "replicas": 1, "updatedReplicas": 1, "availableReplicas": 1}}' ;;
+esac
+""" % kubectl)
+    os.chmod(kubectl, 0o755)
+    config["kube_config"] = {"kubectl": kubectl}
+    with open(inpfile, "w") as fp:
+        yaml.safe_dump(config, fp)
+    output = os.tempnam(".", "tmp-kube-")
+    try:
+        # Nothing to rotate before the first run
+        args = get_args(config=inpfile, rotate_cert=True)
+        assert acc_provision.main(args, no_random=True) == 1
+
+        run_provision(inpfile, overrides={"apic": True})
+        with open(keyfile, "r") as fp:
+            old_key = fp.read()
+        client = Apic(apic.addr, "admin", "noir0123")
+        assert client.check_cert("kube", "kube.crt", old_key)
+
+        args = get_args(config=inpfile, output=output, rotate_cert=True)
+        assert acc_provision.main(args, no_random=True) == 0
+        with open(keyfile, "r") as fp:
+            new_key = fp.read()
+        with open(certfile, "r") as fp:
+            new_cert = fp.read()
+        assert new_key != old_key
+        assert not os.path.exists(certfile + ".new")
+        cert = apic.get("uni/userext/user-kube/usercert-kube.crt")
+        assert cert["attributes"]["data"] == new_cert
+        assert apic.get("uni/userext/user-kube/usercert-kube-next.crt") is None
+        assert client.check_cert("kube", "kube.crt", new_key)
+        assert not client.check_cert("kube", "kube.crt", old_key)
+
+        # Only the secret is applied
+        with open(output, "r") as fp:
+            secret = yaml.safe_load(fp)
+        assert secret["metadata"]["name"] == "aci-user-cert"
+        assert secret["metadata"]["labels"] == {
+            "aci-containers-config-version": "dummy"}
+        assert base64.b64decode(secret["data"]["user.key"]) == new_key
+        assert os.stat(output).st_mode & 0o777 == 0o600
+
+        # The controller is restarted with a patch, not rollout restart
+        with open(kubectl + ".log", "r") as fp:
+            calls = fp.read()
+        assert "patch deployment aci-containers-controller" in calls
+        assert "rollout" not in calls
+
+        # The old certificate and secret are put back if it can't be
+        config["kube_config"] = {"kubectl": kubectl + " fail"}
+        with open(inpfile, "w") as fp:
+            yaml.safe_dump(config, fp)
+        assert acc_provision.main(args, no_random=True) == 1
+        cert = apic.get("uni/userext/user-kube/usercert-kube.crt")
+        assert cert["attributes"]["data"] == new_cert
+        assert apic.get("uni/userext/user-kube/usercert-kube-next.crt") is None
+        assert client.check_cert("kube", "kube.crt", new_key)
+        with open(keyfile, "r") as fp:
+            assert fp.read() == new_key
+        assert not os.path.exists(certfile + ".new")
+        with open(output, "r") as fp:
+            secret = yaml.safe_load(fp)
+        assert base64.b64decode(secret["data"]["user.key"]) == new_key
+
+        # Without -o the secret is only kept while it is applied
+        config["kube_config"] = {"kubectl": kubectl}
+        with open(inpfile, "w") as fp:
+            yaml.safe_dump(config, fp)
+        files = set(os.listdir("."))
+        args = get_args(config=inpfile, output="-", rotate_cert=True)
+        assert acc_provision.main(args, no_random=True) == 0
+        assert set(os.listdir(".")) == files
+        with open(kubectl + ".log", "r") as fp:
+            secret = [l.split()[-1] for l in fp if l.startswith("apply")][-1]
+        assert not os.path.exists(secret)
+    finally:
+        apic.stop()
+        for fname in [inpfile, certfile, keyfile, output, kubectl,
+                      kubectl + ".log"]:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+
+def test_fake_apic_queries():
+    from apic_provision import Apic
+    from fake_apic import FakeApic
+
+    apic = FakeApic().start()
+    try:
+        client = Apic(apic.addr, "admin", "noir0123", ssl=False)
+        tag = "kube-" + "0" * 32
+        client.post("/api/mo/uni/tn-common.json", json.dumps(
+            {"fvTenant": {"attributes": {"name": "common"}, "children": [
+                {"vzFilter": {"attributes": {"name": "f%d" % i},
+                              "children": [{"tagInst": {"attributes": {
+                                  "name": tag}}}]}}
+                for i in range(5)]}}))
+        resp = json.loads(client.get(
+            "/api/class/vzFilter.json?page=1&page-size=2").text)
+        assert resp["totalCount"] == "5"
+        assert [f["vzFilter"]["attributes"]["name"]
+                for f in resp["imdata"]] == ["f2", "f3"]
+
+        client.clean_tagged_resources("kube", "common")
+        assert apic.get("uni/tn-common/flt-f0") is None
+        assert apic.get("uni/tn-common")
+
+        # Expired sessions log in again, requests fail without a token
+        apic.tokens.clear()
+        assert client.get("/api/mo/uni.json").status_code == 200
+        client.cookies = None
+        assert client.get("/api/mo/uni.json").status_code == 403
+
+        apic.error_rate = 1
+        assert client.login().status_code == 500
+    finally:
+        apic.stop()
+
+
+@in_testdir
+def test_server():
+    import requests
+    import threading
+    import server
+    from fake_apic import FakeApic
+
+    apic = FakeApic(use_ssl=True).start()
+    inpfile = fake_apic_input(apic, "base_case.inp.yaml")
+    with open(inpfile, "r") as fp:
+        config = yaml.safe_load(fp)
+    os.remove(inpfile)
+    with_files = yaml.safe_dump(config)
+    del config["aci_config"]["sync_login"]
+    body = yaml.safe_dump(config)
+
+    acc_provision.apic_preflight = {}
+    key_dir = tempfile.mkdtemp()
+    httpd = server.make_server(get_args(serve="127.0.0.1:0"), key_dir)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:%d/" % httpd.server_address[1]
+    try:
+        resp = requests.post(url + "render?version_token=dummy", data=body)
+        assert resp.status_code == 200
+        ret = resp.json()
+        with open("base_case.apic.txt", "r") as fp:
+            paths = [l.strip() for l in fp if l.startswith("/api/")]
+        assert [c["path"] for c in ret["apic_config"]] == paths
+        assert 'aci-containers-config-version: "dummy"' in ret["output"]
+
+        # Preflight lookups are made once
+        for i in range(2):
+            ret = requests.post(url + "plan", data=body).json()
+            assert ret["ok"]
+            assert apic.get("uni/tn-kube") is None
+        gets = [path for method, path in apic.requests if method == "GET"]
+        assert len(gets) == 4
+
+        assert requests.post(url + "apply", data=body).json()["ok"]
+        assert apic.get("uni/tn-kube")
+        assert requests.post(url + "delete", data=body).json()["ok"]
+        assert apic.get("uni/tn-kube") is None
+
+        resp = requests.post(url + "render", data="aci_config: {}")
+        assert resp.status_code == 400
+        assert "ERR:  Please fix configuration and retry." in \
+            resp.json()["messages"]
+        assert requests.post(url + "render?flavor=x", data=body).json() == {
+            "ok": False, "messages": ["Invalid configuration flavor: x"]}
+
+        # The key is kept by the server, requests can't name files
+        ret = requests.post(url + "render", data=body).json()
+        with open(os.path.join(key_dir, "kube", "user.key"), "r") as fp:
+            key_data = fp.read()
+        secret = dict(acc_provision.split_kube_objects(ret["output"]))[
+            "secret-aci-user-cert.yaml"]
+        assert base64.b64decode(
+            yaml.safe_load(secret)["data"]["user.key"]) == key_data
+        resp = requests.post(url + "render", data=with_files)
+        assert resp.status_code == 400
+        assert resp.json()["messages"] == [
+            "aci_config/sync_login certfile and keyfile can't be set in "
+            "a request"]
+        config["aci_config"]["system_id"] = "../kube"
+        resp = requests.post(url + "render", data=yaml.safe_dump(config))
+        assert resp.status_code == 400
+        assert not os.path.exists(os.path.join(key_dir, "..", "kube"))
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        apic.stop()
+        acc_provision.apic_preflight = None
+        shutil.rmtree(key_dir)
+
+
+@in_testdir
+def test_api():
+    import api
+    from apic_provision import Apic
+    from fake_apic import FakeApic
+
+    with open("base_case.inp.yaml", "r") as fp:
+        config = yaml.safe_load(fp)
+    result = api.render(config, no_random=True, version_token="dummy")
+    with open("base_case.kube.yaml", "r") as fp:
+        assert result.output == fp.read()
+    with open("base_case.apic.txt", "r") as fp:
+        paths = [l.strip() for l in fp if l.startswith("/api/")]
+    assert [path for path, data in result.apic_config] == paths
+    assert "secret-aci-user-cert.yaml" in dict(result.objects)
+    assert "INFO: Using configuration flavor kubernetes-1.8" in \
+        result.messages
+    assert "render" in [p["name"] for p in result.phases]
+    assert result.requests == [] and result.errors == []
+
+    bad = copy.deepcopy(config)
+    del bad["net_config"]["node_subnet"]
+    for kwargs, error in [({}, api.ConfigError),
+                          ({"flavor": "x"}, api.ConfigError),
+                          ({"snapshot": "missing"}, api.ProvisionError)]:
+        try:
+            api.render(bad if not kwargs else config, **kwargs)
+            assert False
+        except error as e:
+            assert isinstance(e, api.ProvisionError)
+    try:
+        api.render(config, bogus=True)
+        assert False
+    except TypeError:
+        pass
+
+    # With a session of the caller
+    fake = FakeApic(use_ssl=True).start()
+    inpfile = fake_apic_input(fake, "base_case.inp.yaml")
+    with open(inpfile, "r") as fp:
+        config = yaml.safe_load(fp)
+    os.remove(inpfile)
+    config["aci_config"]["apic_hosts"] = ["192.0.2.1"]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        apic = Apic(fake.addr, "admin", "noir0123")
+        result = api.apply(config, apic=apic, no_random=True)
+        assert fake.get("uni/tn-kube")
+        assert not [m for m in result.messages if "--rollback" in m]
+
+        # Caching and run records only in the given dirs
+        cache_dir = os.path.join(tmpdir, "cache")
+        run_dir = os.path.join(tmpdir, "runs")
+        result = api.apply(config, apic=apic, no_random=True,
+                           cache_dir=cache_dir, run_dir=run_dir)
+        assert len(os.listdir(cache_dir)) == 1
+        assert len(os.listdir(run_dir)) == 1
+        assert all(r["status"] == 200 for r in result.requests)
+        assert ("POST", "/api/mo/uni/tn-kube.json") in [
+            (r["method"], r["path"]) for r in result.requests]
+        api.delete(config, apic=apic)
+        assert fake.get("uni/tn-kube") is None
+
+        # Rejected objects are in the result, nothing is printed
+        fake.mit.remove("uni/tn-common/out-l3out")
+        tmperr = os.path.join(tmpdir, "stderr")
+        with open(tmperr, "w") as sys.stderr:
+            try:
+                result = api.apply(config, apic=apic, no_random=True)
+            finally:
+                sys.stderr = sys.__stderr__
+        assert [m for m in result.errors if "does not exist" in m]
+        assert os.path.getsize(tmperr) == 0
+        api.delete(config, apic=apic)
+        try:
+            apic.check_resp(apic.post("/api/mo/uni/x.json", "{}"))
+            assert False
+        except api.ApicError:
+            pass
+    finally:
+        fake.stop()
+        shutil.rmtree(tmpdir)
+
+
+@in_testdir
+def test_watcher():
+    import watcher
+
+    fname = os.tempnam(".", "tmp-watch-")
+    with open(fname, "w") as fp:
+        fp.write("a")
+    for poll in [False, True]:
+        files = watcher.Watcher([fname], poll=poll)
+        assert files.backend == ("poll" if poll else "inotify")
+        assert files.wait(0.01) == []
+        with open(fname, "w") as fp:
+            fp.write("ab")
+        assert files.wait(0.5) == [os.path.abspath(fname)]
+        files.close()
+    os.remove(fname)
+
+
+@in_testdir
+def test_reconcile():
+    from fake_apic import FakeApic
+
+    apic = FakeApic(use_ssl=True).start()
+    inpfile = fake_apic_input(apic, "base_case.inp.yaml")
+    apic.add("uni/tn-common/out-l3out/instP-ext2", "l3extInstP", name="ext2")
+    args = get_args(config=inpfile, output=os.tempnam(".", "tmp-kube-"),
+                    apic=True)
+
+    def update_input(external_networks):
+        with open(inpfile, "r") as fp:
+            config = yaml.safe_load(fp)
+        config["aci_config"]["l3out"]["external_networks"] = external_networks
+        with open(inpfile, "w") as fp:
+            yaml.safe_dump(config, fp)
+
+    def posts():
+        ret = [p for m, p in apic.requests if m == "POST" and
+               p != "/api/aaaLogin.json"]
+        del apic.requests[:]
+        return ret
+
+    try:
+        apic_config = acc_provision.reconcile(args, None, True, None)
+        assert len(posts()) == len([c for p, c in apic_config if c])
+
+        # Nothing is pushed until the input changes
+        apic_config = acc_provision.reconcile(args, None, True, apic_config)
+        assert posts() == []
+
+        update_input(["default", "ext2"])
+        apic_config = acc_provision.reconcile(args, None, True, apic_config)
+        assert posts() == ["/api/mo/uni/tn-common/out-l3out/instP-ext2.json"]
+        rsprov = "/rsprov-kube-l3out-allow-all"
+        assert apic.get("uni/tn-common/out-l3out/instP-ext2" + rsprov)
+
+        update_input(["ext2"])
+        acc_provision.reconcile(args, None, True, apic_config)
+        assert posts() == []
+        assert apic.get("uni/tn-common/out-l3out/instP-default")
+        assert apic.get("uni/tn-common/out-l3out/instP-default" +
+                        rsprov) is None
+    finally:
+        apic.stop()
+        os.remove(inpfile)
+        os.remove(args.output)
+
+
+@in_testdir
+def test_check_drift():
+    from fake_apic import FakeApic
+
+    apic = FakeApic(use_ssl=True).start()
+    inpfile = fake_apic_input(apic, "base_case.inp.yaml")
+    args = get_args(config=inpfile, check_drift=True)
+    tmpout = os.tempnam(".", "tmp-stdout-")
+
+    def check():
+        origout = sys.stdout
+        with open(tmpout, "w") as sys.stdout:
+            try:
+                ret = acc_provision.main(args, no_random=True)
+            finally:
+                sys.stdout = origout
+        with open(tmpout, "r") as fp:
+            return ret, json.load(fp)
+
+    try:
+        ret, report = check()
+        assert ret == 1
+        assert report["system_id"] == "kube"
+        assert {"dn": "uni/tn-kube", "class": "fvTenant",
+                "change": "missing"} in report["drift"]
+
+        run_provision(inpfile, overrides={"apic": True})
+        requests = len(apic.requests)
+        ret, report = check()
+        assert ret == 0
+        assert report["drift"] == []
+        assert len(apic.requests) - requests < report["objects"] / 4
+
+        # Hand made changes
+        bd = "uni/tn-kube/BD-kube-node-bd"
+        apic.get(bd)["attributes"]["arpFlood"] = "no"
+        apic.mit.remove("uni/tn-common/flt-allow-all-filter")
+        ret, report = check()
+        assert ret == 1
+        assert sorted(report["drift"]) == sorted([
+            {"dn": bd, "class": "fvBD", "change": "modified",
+             "attributes": {"arpFlood": {"desired": "yes", "actual": "no"}}},
+            {"dn": "uni/tn-common/flt-allow-all-filter",
+             "class": "vzFilter", "change": "missing"},
+        ])
+    finally:
+        apic.stop()
+        os.remove(inpfile)
+        os.remove(tmpout)
+
+
+@in_testdir
+def test_snapshot():
+    from fake_apic import FakeApic
+
+    apic = FakeApic(use_ssl=True).start()
+    inpfile = fake_apic_input(apic, "base_case.inp.yaml")
+    snapfile = os.tempnam(".", "tmp-snap-")
+    tmpout = os.tempnam(".", "tmp-stdout-")
+
+    def check():
+        args = get_args(config=inpfile, check_drift=True, snapshot=snapfile)
+        origout = sys.stdout
+        with open(tmpout, "w") as sys.stdout:
+            try:
+                ret = acc_provision.main(args, no_random=True)
+            finally:
+                sys.stdout = origout
+        with open(tmpout, "r") as fp:
+            return ret, json.load(fp)
+
+    try:
+        run_provision(inpfile, overrides={"apic": True})
+        del apic.requests[:]
+        args = get_args(config=inpfile, export_snapshot=snapfile)
+        assert acc_provision.main(args, no_random=True) == 0
+        gets = [p for m, p in apic.requests if m == "GET"]
+        # One query per subtree we use
+        assert not [p for p in gets if "target-subtree-class" in p]
+        subtrees = [p for p in gets if p.endswith("?rsp-subtree=full")]
+        assert subtrees and len(subtrees) == len(set(subtrees))
+    finally:
+        apic.stop()
+
+    try:
+        with open(snapfile, "r") as fp:
+            header = json.loads(fp.readline())
+            lines = fp.readlines()
+        assert header["system_ids"] == ["kube"]
+        assert header["apic"] == apic.addr
+
+        # No APIC is needed from here on
+        ret, report = check()
+        assert ret == 0
+        assert report["drift"] == []
+        assert report["plan"] == []
+
+        filt = "uni/tn-common/flt-allow-all-filter"
+        with open(snapfile, "w") as fp:
+            fp.write(json.dumps(header) + "\n")
+            fp.writelines(l for l in lines if filt not in l)
+        ret, report = check()
+        assert ret == 1
+        assert report["drift"] == [
+            {"dn": filt, "class": "vzFilter", "change": "missing"}]
+        assert report["plan"] == ["/api/mo/uni/tn-common.json"]
+
+        args = get_args(config=inpfile, snapshot=snapfile, apic=True)
+        assert acc_provision.main(args, no_random=True) == 1
+    finally:
+        os.remove(inpfile)
+        os.remove(snapfile)
+        os.remove(tmpout)
+
+
+@in_testdir
+def test_replay():
+    from apic_provision import ApicKubeConfig
+    from fake_apic import FakeApic
+
+    apic = FakeApic(use_ssl=True).start()
+    inpfile = fake_apic_input(apic, "base_case.inp.yaml")
+    apicfile = os.tempnam(".", "tmp-apic-")
+    linesfile = os.tempnam(".", "tmp-apic-") + ".jsonl"
+    try:
+        for fname in [apicfile, linesfile]:
+            args = get_args(config=inpfile, output="/dev/null",
+                            apicfile=fname)
+            acc_provision.main(args, no_random=True)
+        with open(apicfile, "r") as fp:
+            header, pairs = ApicKubeConfig.load_config(fp)
+            assert header == {}
+            expected = list(pairs)
+        with open("base_case.apic.txt", "r") as fp:
+            paths = [l.strip() for l in fp if l.startswith("/api/")]
+        assert [path for path, data in expected] == paths
+        with open(linesfile, "r") as fp:
+            header, pairs = ApicKubeConfig.load_config(fp)
+            assert header["aci_config"]["system_id"] == "kube"
+            assert list(pairs) == expected
+
+        # The JSON lines file needs no input file
+        args = get_args(config="-", replay=linesfile, password="noir0123")
+        assert acc_provision.main(args) == 0
+        assert apic.get("uni/tn-kube")
+        del apic.requests[:]
+        assert acc_provision.main(args) == 0
+        posts = [urllib.unquote(p) for m, p in apic.requests
+                 if m == "POST" and p != "/api/aaaLogin.json"]
+        assert posts == [p for p, data in expected if data is not None]
+
+        args = get_args(config=inpfile, replay=apicfile, delete=True)
+        assert acc_provision.main(args) == 0
+        assert apic.get("uni/tn-kube") is None
+    finally:
+        apic.stop()
+        os.remove(inpfile)
+        os.remove(apicfile)
+        os.remove(linesfile)
+
+
+@in_testdir
+def test_rollback():
+    import shutil
+    import tempfile
+    from fake_apic import FakeApic
+
+    apic = FakeApic(use_ssl=True).start()
+    inpfile = fake_apic_input(apic, "base_case.inp.yaml")
+    run_dir = tempfile.mkdtemp()
+    bd = "uni/tn-kube/BD-kube-node-bd"
+    filt = "uni/tn-common/flt-allow-all-filter"
+
+    def provision():
+        runs = set(os.listdir(run_dir))
+        args = get_args(config=inpfile, output="/dev/null", apic=True,
+                        run_dir=run_dir)
+        acc_provision.main(args, no_random=True)
+        run, = set(os.listdir(run_dir)) - runs
+        return run[:-len(".jsonl")]
+
+    def rollback(run_id):
+        args = get_args(config=inpfile, rollback=run_id, run_dir=run_dir)
+        assert acc_provision.main(args) == 0
+
+    try:
+        first = provision()
+        assert apic.get(bd)["attributes"]["arpFlood"] == "yes"
+        apic.get(bd)["attributes"]["arpFlood"] = "no"
+        apic.mit.remove(filt)
+        users = len(apic.mit.subtree("uni/userext"))
+
+        del apic.requests[:]
+        second = provision()
+        assert apic.get(bd)["attributes"]["arpFlood"] == "yes"
+        assert apic.get(filt)
+        # The record holds the sync user's password
+        mode = os.stat(os.path.join(run_dir, second + ".jsonl")).st_mode
+        assert mode & 0o777 == 0o600
+        # Only the changed subtrees are read
+        assert not [p for m, p in apic.requests if "subtree-class" in p]
+        del apic.requests[:]
+        rollback(second)
+        assert apic.get(bd)["attributes"]["arpFlood"] == "no"
+        assert apic.get(filt) is None
+        assert apic.get("uni/tn-common/flt-allow-all-filter/e-allow-all") \
+            is None
+        assert len(apic.mit.subtree("uni/userext")) == users
+        changes = [m for m, p in apic.requests if m in ["POST", "DELETE"]]
+        assert len(changes) <= 12
+
+        # Objects created by the run are removed
+        rollback(first)
+        assert apic.get("uni/tn-kube") is None
+        assert apic.get("uni/infra/attentp-kube-aep")
+        assert apic.get("uni/tn-common/out-l3out/instP-default")
+    finally:
+        apic.stop()
+        os.remove(inpfile)
+        shutil.rmtree(run_dir)
+
+
 def get_args(**overrides):
     arg = {
         "config": None,
         "output": None,
+        "output_dir": None,
         "apicfile": None,
         "apic": False,
         "delete": False,
@@ -157,6 +1566,30 @@ def get_args(**overrides):
         "list_flavors": False,
         "flavor": None,
         "version_token": "dummy",
+        "hash_version_token": False,
+        "no_cache": True,
+        "trace": None,
+        "profile": None,
+        "key_type": "rsa-2048",
+        "key_pool": None,
+        "fill_key_pool": None,
+        "batch": None,
+        "jobs": 1,
+        "batch_report": None,
+        "cache_dir": None,
+        "serve": None,
+        "check_drift": False,
+        "watch": False,
+        "watch_interval": 2.0,
+        "export_snapshot": None,
+        "snapshot": None,
+        "replay": None,
+        "run_dir": None,
+        "rollback": None,
+        "fleet": None,
+        "allocate": None,
+        "fleet_state": None,
+        "rotate_cert": False,
     }
     argc = collections.namedtuple('argc', arg.keys())
     args = argc(**arg)
@@ -0,0 +1,151 @@
+from __future__ import print_function
+
+import contextlib
+import json
+import threading
+import time
+
+# Active tracer, None unless tracing was enabled for this run
+tracer = None
+# context.tracer also records the phases and requests of a thread
+context = threading.local()
+# Returns the resident memory in KiB when the growth of each phase is
+# recorded, set while profiling
+memory = None
+
+
+class Tracer(object):
+    def __init__(self):
+        self.start = time.time()
+        self.phases = []
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def record(self, records, record):
+        label = getattr(context, "label", None)
+        if label is not None:
+            record["cluster"] = label
+        with self.lock:
+            records.append(record)
+
+    def add_phase(self, name, start, elapsed, rss_kib=None):
+        record = {
+            "name": name,
+            "start": round(start - self.start, 6),
+            "elapsed": round(elapsed, 6),
+        }
+        if rss_kib is not None:
+            record["rss_kib"] = rss_kib
+        self.record(self.phases, record)
+
+    def add_request(self, method, path, status, elapsed, request_bytes,
+                    response_bytes, retries):
+        self.record(self.requests, {
+            "method": method,
+            "path": path,
+            "status": status,
+            "elapsed": round(elapsed, 6),
+            "request_bytes": request_bytes,
+            "response_bytes": response_bytes,
+            "retries": retries,
+        })
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "elapsed": round(time.time() - self.start, 6),
+                "phases": list(self.phases),
+                "requests": list(self.requests),
+            }
+
+    def save(self, fname):
+        with open(fname, "w") as fp:
+            json.dump(self.to_dict(), fp, indent=4, sort_keys=True)
+
+    def summary(self):
+        # Returns the lines of a table with the time spent per phase and
+        # per APIC request path, slowest first
+        data = self.to_dict()
+        lines = ["%-40s %6s %10s %10s" % ("Phase", "Count", "Total ms",
+                                          "Max ms")]
+        for name, count, total, peak in aggregate(
+                data["phases"], lambda p: p["name"]):
+            lines.append("%-40s %6d %10.1f %10.1f" %
+                         (name, count, total * 1000, peak * 1000))
+
+        if data["requests"]:
+            lines.append("%-40s %6s %10s %10s %6s %10s %10s" % (
+                "APIC request", "Count", "Total ms", "Max ms", "Errors",
+                "Sent", "Received"))
+            key = lambda r: "%s %s" % (r["method"], r["path"].split("?")[0])
+            for name, count, total, peak in aggregate(data["requests"], key):
+                reqs = [r for r in data["requests"] if key(r) == name]
+                errors = len([r for r in reqs if r["status"] != 200])
+                sent = sum(r["request_bytes"] for r in reqs)
+                received = sum(r["response_bytes"] for r in reqs)
+                lines.append("%-40s %6d %10.1f %10.1f %6d %10d %10d" % (
+                    name[-40:], count, total * 1000, peak * 1000, errors,
+                    sent, received))
+        lines.append("Total: %.1f ms" % (data["elapsed"] * 1000))
+        return lines
+
+
+def aggregate(records, key):
+    totals = {}
+    for r in records:
+        count, total, peak = totals.get(key(r), (0, 0.0, 0.0))
+        totals[key(r)] = (count + 1, total + r["elapsed"],
+                          max(peak, r["elapsed"]))
+    return sorted(((k,) + v for k, v in totals.items()),
+                  key=lambda x: x[2], reverse=True)
+
+
+def enable():
+    global tracer
+    tracer = Tracer()
+    return tracer
+
+
+def disable():
+    global tracer
+    ret, tracer = tracer, None
+    return ret
+
+
+def set_label(label):
+    context.label = label
+
+
+def tracers():
+    ret = [tracer, getattr(context, "tracer", None)]
+    return [t for t in ret if t is not None]
+
+
+@contextlib.contextmanager
+def collect():
+    # Records the phases and requests of this thread in a new tracer
+    prev = getattr(context, "tracer", None)
+    context.tracer = Tracer()
+    try:
+        yield context.tracer
+    finally:
+        context.tracer = prev
+
+
+@contextlib.contextmanager
+def phase(name):
+    start = time.time()
+    rss = memory() if memory is not None else None
+    try:
+        yield
+    finally:
+        grown = memory() - rss if rss is not None else None
+        for t in tracers():
+            t.add_phase(name, start, time.time() - start, grown)
+
+
+def request(method, path, status, elapsed, request_bytes=0,
+            response_bytes=0, retries=0):
+    for t in tracers():
+        t.add_request(method, path, status, elapsed, request_bytes,
+                      response_bytes, retries)
@@ -0,0 +1,105 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+# inotify(7) events that can change the content of a file in a directory
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO |
+           IN_CREATE | IN_DELETE)
+EVENT = struct.Struct("iIII")
+
+# Time to wait for the rest of the writes of an editor save
+SETTLE = 0.1
+
+
+def load_inotify():
+    # Returns libc if it has inotify, None otherwise
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class Watcher(object):
+    """Waits for changes of a set of files.
+
+    Uses inotify on the directories of the files when available, editors
+    often replace a file instead of writing it, and polls the mtime and
+    size of the files otherwise.
+    """
+
+    def __init__(self, files, poll=False):
+        self.files = [os.path.abspath(f) for f in files]
+        self.fd = None
+        libc = None if poll else load_inotify()
+        if libc is not None:
+            fd = libc.inotify_init()
+            if fd >= 0:
+                self.fd = fd
+                self.wds = {}
+                for d in set(os.path.dirname(f) for f in self.files):
+                    wd = libc.inotify_add_watch(fd, d.encode("utf-8"),
+                                                IN_MASK)
+                    self.wds[wd] = d
+        self.stats = self.stat()
+
+    @property
+    def backend(self):
+        return "poll" if self.fd is None else "inotify"
+
+    def stat(self):
+        ret = {}
+        for f in self.files:
+            try:
+                st = os.stat(f)
+                ret[f] = (st.st_mtime, st.st_size, st.st_ino)
+            except OSError:
+                ret[f] = None
+        return ret
+
+    def read_events(self, timeout):
+        # Returns the paths of the files with events within timeout
+        ret = set()
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if not r:
+            return ret
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if wd in self.wds:
+                ret.add(os.path.join(self.wds[wd], name.decode("utf-8")))
+        return ret
+
+    def wait(self, timeout):
+        # Returns the list of watched files changed within timeout
+        if self.fd is not None:
+            events = self.read_events(timeout)
+            if not events.intersection(self.files):
+                return []
+            while self.read_events(SETTLE):
+                pass
+        else:
+            time.sleep(timeout)
+        stats = self.stat()
+        changed = [f for f in self.files if stats[f] != self.stats[f]]
+        self.stats = stats
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+#
+# Benchmarks for the provisioning pipeline
+#
+# Scales up the testdata inputs (external networks, namespace EPG
+# mappings and IP pool lists) and times each stage of the pipeline
+# separately, including a push to a local fake APIC. Results are written
+# as JSON and compared against a baseline recorded on the same machine,
+# which the first run saves; a stage that got slower than the baseline by
+# more than the tolerance and the noise of its repeated runs fails the
+# run.
+#
+from __future__ import print_function
+
+import argparse
+import contextlib
+import copy
+import gc
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TESTDATA = os.path.join(HERE, "..", "testdata")
+sys.path.insert(0, os.path.join(HERE, "..", "acc_provision"))
+
+import acc_provision  # noqa: E402
+from acc_provision import (  # noqa: E402
+    FLAVORS, DEFAULT_FLAVOR_OPTIONS, ApicKubeConfig, config_adjust,
+    config_default, config_user, config_validate, deep_merge)
+from apic_provision import Apic  # noqa: E402
+from fake_apic import FakeApic  # noqa: E402
+from profiling import current_rss  # noqa: E402
+
+try:
+    import tracemalloc
+except ImportError:
+    # Not available before python 3.4
+    tracemalloc = None
+
+DEFAULT_BASELINE = os.path.join(HERE, "baseline.json")
+
+INPUTS = [
+    ("kube", "base_case.inp.yaml", "kubernetes-1.8"),
+    ("cf", "flavor_cf_10.inp.yaml", "cloudfoundry-1.0"),
+]
+
+STAGES = [
+    "config_user", "deep_merge", "config_validate", "config_adjust",
+    "get_config", "generate_yaml", "push",
+]
+
+
+def ip_range(i):
+    # Distinct /24 ranges in 20.0.0.0/8
+    prefix = "20.%d.%d" % (i // 256 % 256, i % 256)
+    return {"start": prefix + ".1", "end": prefix + ".254"}
+
+
+def scale_config(config, args):
+    # Scale up a testdata input with synthetic entries
+    config = copy.deepcopy(config)
+    aci_config = config["aci_config"]
+    aci_config["l3out"]["external_networks"] = [
+        "ext-net-%d" % i for i in range(args.external_networks)]
+    aci_config["sync_login"] = {
+        "certfile": os.path.join(TESTDATA, "user.crt"),
+        "keyfile": os.path.join(TESTDATA, "user.key"),
+    }
+    system_id = aci_config["system_id"]
+
+    pools = [ip_range(i) for i in range(args.pool_ranges)]
+    config["kube_config"] = deep_merge(config.get("kube_config", {}), {
+        "namespace_default_endpoint_group": dict(
+            ("namespace-%d" % i, {
+                "tenant": system_id,
+                "app_profile": "kubernetes",
+                "group": "epg-%d" % (i % 50),
+            }) for i in range(args.namespaces)),
+        "pod_ip_pool": pools,
+        "service_ip_pool": pools,
+        "static_service_ip_pool": pools,
+    })
+    config["cf_config"] = deep_merge(config.get("cf_config", {}), {
+        "app_ip_pool": pools,
+        "dynamic_ext_ip_pool": pools,
+        "static_ext_ip_pool": pools,
+    })
+    return config
+
+
+@contextlib.contextmanager
+def quiet(enabled):
+    # The pipeline functions log to stderr
+    if not enabled:
+        yield
+        return
+    stderr = sys.stderr
+    with open(os.devnull, "w") as devnull:
+        sys.stderr = devnull
+        try:
+            yield
+        finally:
+            sys.stderr = stderr
+
+
+class RssSampler(object):
+    """Samples the resident memory in a thread to find its peak.
+
+    The peak RSS of the process only grows when a stage needs more memory
+    than any stage before it, so without tracemalloc the growth of the
+    sampled RSS over its value at the start is used instead.
+    """
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.start_rss = self.peak = current_rss()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak - self.start_rss
+
+
+def measure(fn):
+    # Returns (value, seconds, KiB); memory is the peak of the traced
+    # allocations when available, otherwise the peak growth of the
+    # resident memory
+    gc.collect()
+    sampler = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+    elif current_rss() is not None:
+        sampler = RssSampler()
+    else:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    try:
+        ret = fn()
+    finally:
+        elapsed = time.time() - start
+        if tracemalloc is not None:
+            memory = tracemalloc.get_traced_memory()[1] / 1024.0
+            tracemalloc.stop()
+        elif sampler is not None:
+            memory = sampler.stop()
+        else:
+            memory = float(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss)
+    return ret, elapsed, memory
+
+
+def seed_apic(apic, config):
+    # Objects the provisioning expects to find in the fabric
+    aci_config = config["aci_config"]
+    tenant = aci_config["vrf"]["tenant"]
+    l3out = aci_config["l3out"]["name"]
+    if tenant not in ["common", "infra"]:
+        apic.add("uni/tn-%s" % tenant, "fvTenant", name=tenant)
+    apic.add("uni/tn-%s/out-%s" % (tenant, l3out), "l3extOut", name=l3out)
+    for net in aci_config["l3out"]["external_networks"]:
+        apic.add("uni/tn-%s/out-%s/instP-%s" % (tenant, l3out, net),
+                 "l3extInstP", name=net)
+    nested = aci_config["vmm_domain"].get("nested_inside", {})
+    if nested.get("name"):
+        apic.add("uni/vmmp-%s/dom-%s" % (nested["type"], nested["name"]),
+                 "vmmDomP", name=nested["name"])
+
+
+def run_pipeline(name, user_file, flavor, args, workdir):
+    # Runs each stage once, returns {stage: (seconds, KiB)}
+    results = {}
+
+    def stage(stage_name, fn):
+        ret, elapsed, memory = measure(fn)
+        results[stage_name] = (elapsed, memory)
+        return ret
+
+    flavor_opts = FLAVORS[flavor].get("options", DEFAULT_FLAVOR_OPTIONS)
+    user_config = stage("config_user", lambda: config_user(user_file))
+
+    def merge():
+        config = {"provision": {"prov_apic": None, "debug_apic": False}}
+        deep_merge(config, user_config)
+        deep_merge(config, FLAVORS[flavor].get("config", {}))
+        if "default_version" in FLAVORS[flavor]:
+            deep_merge(config, {"registry": {
+                "version": FLAVORS[flavor]["default_version"]}})
+        deep_merge(config, config_default())
+        version = config["registry"]["version"]
+        if version in acc_provision.VERSIONS:
+            deep_merge(config, {"registry": acc_provision.VERSIONS[version]})
+        return config
+    config = stage("deep_merge", merge)
+
+    if not stage("config_validate",
+                 lambda: config_validate(flavor_opts, config)):
+        raise Exception("Invalid benchmark input %s" % name)
+
+    adj_args = argparse.Namespace(version_token="benchmark")
+    stage("config_adjust", lambda: deep_merge(
+        config, config_adjust(adj_args, config, None, True)))
+    sync_login = config["aci_config"]["sync_login"]
+    for k in ["key", "cert"]:
+        with open(sync_login[k + "file"], "r") as fp:
+            sync_login[k + "_data"] = fp.read()
+
+    def get_config():
+        configurator = ApicKubeConfig(config)
+        for k, v in flavor_opts.get("apic", {}).items():
+            setattr(configurator, k, v)
+        return configurator.get_config()
+    apic_config = stage("get_config", get_config)
+
+    gen = flavor_opts.get("template_generator",
+                          acc_provision.generate_kube_yaml)
+    output = os.path.join(workdir, name + ".yaml")
+    stage("generate_yaml", lambda: gen(config, output))
+
+    apic = FakeApic(latency=args.latency).start()
+    try:
+        seed_apic(apic, config)
+        client = Apic(apic.addr, "admin", "noir0123", ssl=False)
+        stage("push", lambda: client.provision(
+            apic_config, sync_login["username"]))
+    finally:
+        apic.stop()
+    return results
+
+
+def run(args):
+    workdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for name, inpfile, flavor in INPUTS:
+            with open(os.path.join(TESTDATA, inpfile), "r") as fp:
+                config = scale_config(yaml.safe_load(fp), args)
+            user_file = os.path.join(workdir, inpfile)
+            with open(user_file, "w") as fp:
+                yaml.safe_dump(config, fp)
+
+            # Keep the fastest run of each stage and the spread of the
+            # runs as its noise, the memory of the first
+            runs = []
+            for i in range(args.repeat):
+                with quiet(not args.verbose):
+                    runs.append(run_pipeline(name, user_file, flavor, args,
+                                             workdir))
+            for stage_name in STAGES:
+                seconds = [r[stage_name][0] for r in runs]
+                results["%s/%s" % (name, stage_name)] = {
+                    "seconds": round(min(seconds), 6),
+                    "spread": round(max(seconds) - min(seconds), 6),
+                    "memory_kib": round(runs[0][stage_name][1], 1),
+                }
+    finally:
+        shutil.rmtree(workdir)
+
+    return {
+        "python": platform.python_version(),
+        "memory": ("tracemalloc" if tracemalloc is not None else
+                   "rss" if current_rss() is not None else "maxrss"),
+        "params": {
+            "external_networks": args.external_networks,
+            "namespaces": args.namespaces,
+            "pool_ranges": args.pool_ranges,
+            "latency": args.latency,
+        },
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+
+def compare(report, baseline, tolerance, min_delta):
+    # Returns the lines describing the regressions against the baseline. A
+    # slowdown counts if it's over min_delta, the tolerance and the spread
+    # of the repeated runs of both reports.
+    regressions = []
+    if baseline.get("params") != report["params"]:
+        return ["Baseline was recorded with different parameters: %s" %
+                baseline.get("params")]
+    for name, result in sorted(report["results"].items()):
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        delta = result["seconds"] - base["seconds"]
+        noise = result["spread"] + base.get("spread", 0)
+        if delta > max(min_delta, base["seconds"] * tolerance, noise):
+            regressions.append(
+                "%s: %.1f ms, baseline %.1f ms (+%.0f%%)" % (
+                    name, result["seconds"] * 1000, base["seconds"] * 1000,
+                    100.0 * delta / max(base["seconds"], 1e-6)))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the provisioning pipeline')
+    parser.add_argument('--external-networks', type=int, default=300,
+                        help='external networks in the l3out')
+    parser.add_argument('--namespaces', type=int, default=2000,
+                        help='namespace EPG mappings')
+    parser.add_argument('--pool-ranges', type=int, default=500,
+                        help='ranges in each IP pool list')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='fake APIC latency per request in seconds')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each stage, the fastest is kept')
+    parser.add_argument('-o', '--output', default=None,
+                        help='write the results as JSON to this file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='results to compare against, saved by the '
+                        'first run (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        default=False,
+                        help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed slowdown relative to the baseline')
+    parser.add_argument('--min-delta', type=float, default=0.01,
+                        help='slowdowns below this many seconds are ignored')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        default=False, help='show the pipeline output')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    report = run(args)
+
+    print("%-30s %12s %12s" % ("Stage", "ms", "KiB"))
+    for name, result in sorted(report["results"].items()):
+        print("%-30s %12.1f %12.1f" % (name, result["seconds"] * 1000,
+                                       result["memory_kib"]))
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=4, sort_keys=True,
+                      separators=(",", ": "))
+
+    # Timings only compare on the same machine, the baseline isn't shipped
+    # and the first run records it
+    if args.save_baseline or not os.path.exists(args.baseline):
+        with open(args.baseline, "w") as fp:
+            json.dump(report, fp, indent=4, sort_keys=True,
+                      separators=(",", ": "))
+        print("Saved baseline to %s" % args.baseline)
+        return 0
+
+    with open(args.baseline, "r") as fp:
+        baseline = json.load(fp)
+    regressions = compare(report, baseline, args.tolerance, args.min_delta)
+    if regressions:
+        print("Performance regressions:")
+        for line in regressions:
+            print("  " + line)
+        return 1
+    print("No regressions against %s" % args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())